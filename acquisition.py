@@ -0,0 +1,233 @@
+'''Ways of getting a steady reading out of the pH pin.
+
+The pH electrode is high impedance and picks up mains hum. Sampling every ~2ms
+plus loop overhead aliases the hum into the average, which is why
+read_ph_meter() used to need 500 samples.
+
+SyncSampler takes samples at a fixed rate off a hardware timer, over a whole
+number of mains cycles. Averaging each cycle is a boxcar filter one mains
+period long, which has nulls at the mains frequency and all its harmonics, so
+the hum cancels out instead of being averaged down. The per cycle means are
+kept so the spread between them shows how much noise is left.
+
+SequentialSampler doesn't take a fixed number of samples. It keeps a running
+variance and stops as soon as the standard error of the mean is small enough,
+so a quiet signal is read quickly. It gives up straight away if the ADC is
+stuck at either end of its range, which means the probe is disconnected or
+saturated.
+
+Switching a pump through its freewheeling diode puts a spike on the analogue
+ground, and a running pump's PWM is noisy too. PumpBlanking is told about
+every pump edge, and SequentialSampler with one waits until WINDOW ms after
+the last edge before sampling. A sample taken while a pump ran, or with an
+edge during it, is thrown away and counted in rejected, it doesn't count
+towards the samples of the read.
+'''
+
+import time
+from array import array
+
+
+class ProbeError(Exception):
+    '''The pH probe reading is stuck at the end of the ADC range'''
+    pass
+
+
+class SyncSampler:
+    MAINS_HZ = 50 # 60 in the US
+    CYCLES = 10 # number of mains cycles to average over
+    SAMPLES_PER_CYCLE = 20
+
+    def __init__(self, adc, timer=None,
+                 mains_hz=MAINS_HZ, cycles=CYCLES,
+                 samples_per_cycle=SAMPLES_PER_CYCLE):
+        '''timer is a pyb.Timer for ADC.read_timed. Without one the samples
+        are timed in software, which is fine off the board but jittery on it.'''
+        self.adc = adc
+        self.timer = timer
+        self.cycles = cycles
+        self.samples_per_cycle = samples_per_cycle
+        self.rate = mains_hz * samples_per_cycle
+        self.buf = array('H', [0] * (cycles * samples_per_cycle))
+        self.cycle_buf = array('H', [0] * samples_per_cycle)
+        self.cycle_means = array('f', [0.0] * cycles)
+        if timer is not None:
+            timer.init(freq=self.rate)
+
+    def duration(self):
+        '''ms taken by one read'''
+        return len(self.buf) * 1000 // self.rate
+
+    def _fill(self, buf):
+        if self.timer is not None:
+            self.adc.read_timed(buf, self.timer)
+            return
+        period = 1000000 // self.rate
+        deadline = time.ticks_us()
+        for i in range(len(buf)):
+            while time.ticks_diff(deadline, time.ticks_us()) > 0:
+                pass
+            buf[i] = self.adc.read()
+            deadline = time.ticks_add(deadline, period)
+
+    def fill(self):
+        '''Sample into buf'''
+        self._fill(self.buf)
+
+    def decimate(self):
+        '''Average each mains cycle in buf, return the mean of the cycles'''
+        n = self.samples_per_cycle
+        buf = self.buf
+        total = 0
+        for cycle in range(self.cycles):
+            cycle_total = 0
+            for i in range(cycle * n, cycle * n + n):
+                cycle_total += buf[i]
+            self.cycle_means[cycle] = cycle_total / n
+            total += cycle_total
+        return total / len(buf)
+
+    def read(self):
+        '''Return the mean ADC value over the mains cycles'''
+        self.fill()
+        return self.decimate()
+
+    def sample(self):
+        '''Return the mean ADC value over one mains cycle'''
+        buf = self.cycle_buf
+        self._fill(buf)
+        total = 0
+        for value in buf:
+            total += value
+        return total / len(buf)
+
+    def noise(self):
+        '''Standard deviation of the cycle means from the last read, in
+        ADC counts'''
+        n = self.cycles
+        if n < 2:
+            return 0.0
+        mean = sum(self.cycle_means) / n
+        return (sum((x - mean) ** 2 for x in self.cycle_means) / (n - 1)) ** 0.5
+
+
+class PinSource:
+    '''Single ADC reads a fixed time apart, for SequentialSampler when
+    there is no SyncSampler'''
+
+    def __init__(self, adc, interval=2):
+        self.adc = adc
+        self.interval = interval # (ms)
+
+    def sample(self):
+        value = self.adc.read()
+        time.sleep_ms(self.interval)
+        return value
+
+
+class PumpBlanking:
+    WINDOW = 100 # (ms) after a pump switches on or off
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.running = 0 # a bit for each pump that is on
+        self.edges = 0 # pump edges so far
+        self.clear_at = time.ticks_ms() # end of the window after the last edge
+        self.rejected = 0 # samples thrown away, since power up
+        self.waited = 0 # (ms) spent waiting for the window to pass, since power up
+
+    def edge(self, pump, on):
+        '''pump (0 or 1) has just been switched on or off'''
+        bit = 1 << pump
+        if bool(self.running & bit) == bool(on):
+            return # no change, nothing switched
+        self.running ^= bit
+        self.edges += 1
+        self.clear_at = time.ticks_add(time.ticks_ms(), self.window)
+
+    def wait(self):
+        '''Sleep out what is left of the window after the last edge. Doesn't
+        wait while a pump is running, there's no telling when it'll stop.'''
+        if self.running:
+            return
+        left = time.ticks_diff(self.clear_at, time.ticks_ms())
+        if left > 0:
+            time.sleep_ms(left)
+            self.waited += left
+
+    def clean(self, edges):
+        '''True if a sample started when there had been edges edges is clear
+        of the pumps'''
+        return edges == self.edges and not self.running
+
+
+class SequentialSampler:
+    TOLERANCE = 1.6 # ADC counts, about 0.01 pH
+    MIN_SAMPLES = 3
+    MAX_SAMPLES = 25
+    ADC_MAX = 4095
+    RAIL_MARGIN = 2 # counts from either end which count as stuck
+    FAIL_FAST = 3 # stuck samples in a row from the start before giving up
+
+    def __init__(self, source, tolerance=TOLERANCE,
+                 min_samples=MIN_SAMPLES, max_samples=MAX_SAMPLES, blanking=None):
+        '''source is anything with a sample() method returning an ADC
+        value, e.g. a SyncSampler (one mains cycle per sample) or a
+        PinSource. tolerance is the standard error of the mean to stop at, in
+        ADC counts. blanking is a PumpBlanking to keep the samples clear of
+        the pumps.'''
+        self.source = source
+        self.tolerance = tolerance
+        self.min_samples = max(min_samples, 2)
+        self.max_samples = max_samples
+        self.blanking = blanking
+        self.samples = 0 # taken by the last read
+        self.rejected = 0 # thrown away by the last read
+        self.sem = None # standard error of the mean of the last read
+
+    def _stuck(self, value):
+        return (value <= self.RAIL_MARGIN or
+                value >= self.ADC_MAX - self.RAIL_MARGIN)
+
+    def read(self):
+        '''Return the mean ADC value, raises ProbeError if the ADC is stuck
+        at either end of its range'''
+        n = 0
+        mean = 0.0
+        m2 = 0.0
+        stuck = 0
+        rejected = 0
+        limit = self.tolerance * self.tolerance
+        blanking = self.blanking
+        while n < self.max_samples:
+            # A pump left running would blank everything, so after
+            # max_samples rejects take the samples as they come
+            blanked = blanking is not None and rejected < self.max_samples
+            if blanked:
+                blanking.wait()
+                edges = blanking.edges
+            value = self.source.sample()
+            if blanked and not blanking.clean(edges):
+                rejected += 1
+                blanking.rejected += 1
+                continue
+            if self._stuck(value):
+                stuck += 1
+                if stuck == n + 1 and stuck >= self.FAIL_FAST:
+                    self.samples = stuck
+                    self.rejected = rejected
+                    self.sem = None
+                    raise ProbeError(value)
+            n += 1
+            delta = value - mean
+            mean += delta / n
+            m2 += delta * (value - mean)
+            # standard error squared = variance / n
+            if n >= self.min_samples and m2 / (n - 1) / n <= limit:
+                break
+        self.samples = n
+        self.rejected = rejected
+        self.sem = (m2 / (n - 1) / n) ** 0.5 if n > 1 else None
+        if self._stuck(mean):
+            raise ProbeError(mean)
+        return mean
@@ -0,0 +1,174 @@
+'''Records the raw ADC reads of the pH and button pins, for replaying later.
+
+When a unit does something odd in the field the readings that caused it are
+gone. With a trace the same reads can be fed back through PH_Monitor on a PC
+(host/replay.py) as often as needed, e.g. to check a fix or see where two
+versions of the code dose differently.
+
+RecordingADC wraps an ADC and passes every value it reads, from read() or
+read_timed(), to a TraceRecorder. The recorder packs each one into 4 bytes:
+
+    uint16  ms since the previous record
+    uint16  channel << 12 | value
+
+Every pH read is kept, so a replay can hand them out again in order. The
+button pin is only recorded when its value changes, so while nothing is
+pressed it costs next to nothing. The pH is worked out with the water
+temperature, so RecordingWater records every new reading of the DS18B20 too,
+in 1/16 C steps on the WATER channel. A replay holds the button and water
+values from one record to the next. A gap of more than 65535 ms is bridged
+with GAP records, which only move the time on.
+
+The file starts with a header of MAGIC, VERSION and the time.time() the trace
+started at. Time spent in stop mode, which ticks_ms() misses, is passed on
+with time_jump() so the trace keeps to the real time. Records are kept in a
+buffer and written out when it fills up, or at least every FLUSH_INTERVAL, so
+a crash loses at most that much.
+'''
+
+import struct
+import time
+
+MAGIC = b'PHTR'
+VERSION = 2 # 1 had no water temperature
+HEADER = '<4sBxxxI' # magic, version, start time (s, the board's epoch)
+RECORD = '<HH'
+RECORD_SIZE = 4
+MAX_DELTA = 0xffff
+VALUE_MASK = 0xfff # 12 bit ADC
+
+# Channels
+PH = 0
+BUTTONS = 1
+WATER = 2 # water temperature, see water_value()
+GAP = 15 # not a reading, only moves the time on
+CHANGES_ONLY = (BUTTONS,) # channels only recorded when the value changes
+HELD = (BUTTONS, WATER) # channels that keep their value between records
+NO_VALUE = VALUE_MASK # a held channel that hasn't been recorded yet
+
+WATER_SCALE = 16 # steps per C, the DS18B20's resolution
+WATER_OFFSET = 40 # (C) so temperatures down to -40 C fit
+
+
+def water_value(temperature):
+    '''A water temperature (C) as a WATER record value'''
+    value = int(round((temperature + WATER_OFFSET) * WATER_SCALE))
+    return min(NO_VALUE - 1, max(0, value))
+
+
+def water_temperature(value):
+    '''The water temperature (C) from a WATER record value, None for
+    NO_VALUE'''
+    if value == NO_VALUE:
+        return None
+    return value / WATER_SCALE - WATER_OFFSET
+
+
+class TraceRecorder:
+    BUFFER = 4096 # (bytes) records kept before writing them out
+    FLUSH_INTERVAL = 60000 # (ms) longest a record waits to be written
+
+    def __init__(self, file):
+        '''file is opened for writing in binary, e.g. open('/sd/trace/0.bin', 'wb')'''
+        self.file = file
+        self.buf = bytearray(self.BUFFER)
+        self.used = 0
+        self.last_values = [-1] * GAP # for the CHANGES_ONLY channels
+        self.records = 0
+        self.start = time.ticks_ms()
+        self.last = self.start # ticks_ms of the last record
+        self.next_flush = time.ticks_add(self.start, self.FLUSH_INTERVAL)
+        file.write(struct.pack(HEADER, MAGIC, VERSION, int(time.time())))
+
+    def _put(self, delta, word):
+        if self.used + RECORD_SIZE > len(self.buf):
+            self.flush()
+        struct.pack_into(RECORD, self.buf, self.used, delta, word)
+        self.used += RECORD_SIZE
+        self.records += 1
+
+    def add(self, channel, value, ms=None):
+        '''Record a value read from channel at ticks_ms ms (now by default)'''
+        if ms is None:
+            ms = time.ticks_ms()
+        if channel in CHANGES_ONLY:
+            if value == self.last_values[channel]:
+                return
+            self.last_values[channel] = value
+        delta = time.ticks_diff(ms, self.last)
+        if delta < 0:
+            delta = 0 # read_timed samples are stamped after the fact
+        else:
+            self.last = ms
+        while delta > MAX_DELTA:
+            self._put(MAX_DELTA, GAP << 12)
+            delta -= MAX_DELTA
+        self._put(delta, channel << 12 | (value & VALUE_MASK))
+        if time.ticks_diff(ms, self.next_flush) >= 0:
+            self.flush()
+
+    def time_jump(self, ms):
+        '''ticks_ms stood still for ms (the board was stopped). The next
+        record is that much further on, bridged with GAP records if need be.'''
+        self.last = time.ticks_add(self.last, -ms)
+
+    def flush(self):
+        '''Write out the buffered records'''
+        if self.used:
+            self.file.write(memoryview(self.buf)[:self.used])
+            self.used = 0
+        self.file.flush()
+        self.next_flush = time.ticks_add(time.ticks_ms(), self.FLUSH_INTERVAL)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class RecordingADC:
+    '''An ADC whose reads are also recorded on a channel of a TraceRecorder'''
+
+    def __init__(self, adc, recorder, channel):
+        self.adc = adc
+        self.recorder = recorder
+        self.channel = channel
+
+    def read(self):
+        value = self.adc.read()
+        self.recorder.add(self.channel, value)
+        return value
+
+    def read_timed(self, buf, timer):
+        start = time.ticks_ms()
+        self.adc.read_timed(buf, timer)
+        freq = timer.freq()
+        add = self.recorder.add
+        for i in range(len(buf)):
+            add(self.channel, buf[i], time.ticks_add(start, i * 1000 // freq))
+
+
+class RecordingWater:
+    '''A water_temp.WaterTemperature whose new readings are also recorded on
+    the WATER channel of a TraceRecorder'''
+
+    def __init__(self, water, recorder):
+        self.water = water
+        self.recorder = recorder
+
+    def poll(self):
+        new = self.water.poll()
+        if new:
+            self.recorder.add(WATER, water_value(self.water.read()))
+        return new
+
+    def read(self):
+        return self.water.read()
+
+    def due_in(self):
+        return self.water.due_in()
+
+    def time_jump(self, ms):
+        self.water.time_jump(ms)
+
+    def age(self):
+        return self.water.age()
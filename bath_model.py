@@ -0,0 +1,136 @@
+'''Learns how the bath responds to each pump, and plans doses from that.
+
+The change in pH between two adjustments is modelled as
+
+    dpH = a1*d1 + a2*d2 + b1*p1 + b2*p2 + c*hours
+
+where d1, d2 are the drips from pump 1 (acid) and 2 (base) at the last
+adjustment, p1, p2 the drips at the one before (the part of a dose that hasn't
+mixed in or has been soaked up by the buffer by the next reading), and c is
+drift per hour. The coefficients are fitted with recursive least squares as
+readings come in, with a forgetting factor so the model follows the bath as it
+changes. Forgetting only happens when there were doses to learn from, and the
+trace of the covariance is capped at max_trace (p0 for each coefficient), or
+the long spells in band with no doses would blow it up until one noisy reading
+threw the gains right off.
+
+Nothing here touches the hardware, so it can be used off the board as well.
+'''
+
+PUMP_1 = 0 # acid
+PUMP_2 = 1 # base
+NO_PUMP = -1
+
+
+class Rls:
+    '''Recursive least squares with exponential forgetting'''
+
+    def __init__(self, theta, p0=100.0, forget=0.98):
+        n = len(theta)
+        self.n = n
+        self.theta = list(theta)
+        self.P = [[p0 if i == j else 0.0 for j in range(n)] for i in range(n)]
+        self.forget = forget
+        self.max_trace = p0 * n # P is never let grow past where it started
+        self.updates = 0
+
+    def predict(self, phi):
+        return sum(t * x for t, x in zip(self.theta, phi))
+
+    def update(self, phi, y, forget=True):
+        '''Fit one more observation y of the regressors phi, returns the
+        prediction error before the update. forget=False keeps the old
+        observations at full weight, for when phi has little new in it.'''
+        n = self.n
+        P = self.P
+        factor = self.forget if forget else 1.0
+        Pphi = [sum(P[i][j] * phi[j] for j in range(n)) for i in range(n)]
+        denom = factor + sum(phi[i] * Pphi[i] for i in range(n))
+        gain = [x / denom for x in Pphi]
+        error = y - self.predict(phi)
+        for i in range(n):
+            self.theta[i] += gain[i] * error
+        for i in range(n):
+            row = P[i]
+            for j in range(n):
+                row[j] = (row[j] - gain[i] * Pphi[j]) / factor
+        trace = sum(P[i][i] for i in range(n))
+        if trace > self.max_trace:
+            # Directions that aren't being excited would grow without end
+            scale = self.max_trace / trace
+            for row in P:
+                for j in range(n):
+                    row[j] *= scale
+        self.updates += 1
+        return error
+
+
+class BathModel:
+    FORGET = 0.98
+    MIN_UPDATES = 3 # observations before the model is trusted
+    # Starting guess of the pH change per drip, from watching the bath
+    DRIP_GAIN = (-0.05, 0.05)
+
+    def __init__(self, forget=FORGET, drip_gain=DRIP_GAIN):
+        self.rls = Rls((drip_gain[0], drip_gain[1], 0.0, 0.0, 0.0), forget=forget)
+        self.restart()
+
+    def restart(self):
+        '''Forget the last reading and doses, e.g. after the monitor has been
+        stopped. What has been learnt is kept.'''
+        self.last_ph = None
+        self.doses = [0, 0] # since the last reading
+        self.previous = [0, 0] # the interval before that
+
+    def dosed(self, pump, drips):
+        '''Record drips given by a pump'''
+        self.doses[pump] += drips
+
+    def observe(self, pH, hours):
+        '''Record a reading taken hours after the previous one and learn from
+        the change. Returns the prediction error, None for the first reading.'''
+        error = None
+        if self.last_ph is not None:
+            phi = (self.doses[0], self.doses[1],
+                   self.previous[0], self.previous[1], hours)
+            # Nothing to learn the gains from without doses, so don't forget them
+            dosed = any(phi[:4])
+            error = self.rls.update(phi, pH - self.last_ph, dosed)
+        self.last_ph = pH
+        self.previous = self.doses
+        self.doses = [0, 0]
+        return error
+
+    def gain(self, pump):
+        '''Total pH change per drip, including the delayed part'''
+        theta = self.rls.theta
+        return theta[pump] + theta[pump + 2]
+
+    def trusted(self, pump):
+        '''True if there's enough data and the gain has the right sign'''
+        if self.rls.updates < self.MIN_UPDATES:
+            return False
+        gain = self.gain(pump)
+        return gain < 0 if pump == PUMP_1 else gain > 0
+
+    def plan(self, pH, target, error, hours, max_drips, resolution=1):
+        '''Return (pump, drips) for a reading of pH, given hours until the
+        next reading. The dose is the most drips, in steps of resolution,
+        that doesn't take the predicted pH past the target. Returns
+        (NO_PUMP, 0) if the predicted pH is in band, and (pump, 0) if the
+        smallest dose would overshoot the band.'''
+        theta = self.rls.theta
+        # Where the bath is heading without another dose
+        expected = (pH + theta[2] * self.previous[0] + theta[3] * self.previous[1]
+                    + theta[4] * hours)
+        if abs(expected - target) <= error:
+            return NO_PUMP, 0
+        pump = PUMP_1 if expected > target else PUMP_2
+        if not self.trusted(pump):
+            return pump, 1 # fall back to one drip at a time
+        step = abs(self.gain(pump))
+        distance = abs(expected - target)
+        drips = int(distance / step / resolution) * resolution
+        if not drips and step * resolution <= distance + error:
+            drips = resolution # overshoots the target but stays in band
+        return pump, min(drips, max_drips)
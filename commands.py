@@ -0,0 +1,98 @@
+'''Line based command interface over a stream, e.g. the USB serial port.
+
+Each line is a command name followed by space separated arguments. poll() is
+called every pass of the loop and never blocks: it only reads what has
+already arrived, into a preallocated buffer, and runs any complete lines.
+
+Handlers are registered with on(name, handler) and are called as
+handler(args) with a list of the argument strings. A handler returns the
+reply, or None for a plain OK. A ValueError from a handler (e.g. from a bad
+float()) is replied to as an error rather than stopping the loop. While busy
+is set every command is turned away with ERR busy.
+'''
+
+import select
+
+
+class CommandInterface:
+    BUFFER_SIZE = 64 # longest line, longer lines are thrown away
+
+    def __init__(self, stream, buffer_size=BUFFER_SIZE):
+        self.stream = stream
+        self.poller = select.poll()
+        self.poller.register(stream, select.POLLIN)
+        self.buf = bytearray(buffer_size)
+        self.view = memoryview(self.buf)
+        self.length = 0
+        self.overflow = False # dropping the rest of a line that was too long
+        self.handlers = {}
+        self.lines = 0 # number of lines run
+        self.busy = False # e.g. an export is using the stream
+        self.on('help', self._help)
+
+    def on(self, name, handler):
+        self.handlers[name] = handler
+
+    def _help(self, args):
+        return ' '.join(sorted(self.handlers))
+
+    def connected(self):
+        '''False if the stream can tell nothing is on the other end, e.g. a
+        USB_VCP with no host'''
+        if hasattr(self.stream, 'isconnected'):
+            return self.stream.isconnected()
+        return True
+
+    def reply(self, line):
+        self.stream.write(line)
+        self.stream.write('\n')
+
+    def poll(self):
+        '''Read whatever has arrived and run any complete lines'''
+        while self.poller.poll(0):
+            if self.length == len(self.buf):
+                self.length = 0 # line too long, throw it away
+                self.overflow = True
+            n = self.stream.readinto(self.view[self.length:])
+            if not n:
+                return
+            i = self.length
+            self.length += n
+            # Run every complete line in the buffer
+            while i < self.length:
+                if self.buf[i] != 10: # '\n'
+                    i += 1
+                    continue
+                if self.overflow:
+                    self.overflow = False
+                    self.reply('ERR line too long')
+                else:
+                    self.run(bytes(self.view[:i]))
+                rest = self.length - i - 1
+                self.buf[:rest] = self.buf[i + 1:self.length]
+                self.length = rest
+                i = 0
+
+    def run(self, line):
+        '''Run one line, a bytes object without the newline'''
+        try:
+            words = line.decode().split()
+        except UnicodeError:
+            self.reply('ERR bad characters')
+            return
+        if not words:
+            return
+        self.lines += 1
+        if self.busy:
+            self.reply('ERR busy')
+            return
+        handler = self.handlers.get(words[0])
+        if handler is None:
+            self.reply('ERR unknown command ' + words[0])
+            return
+        try:
+            result = handler(words[1:])
+        except (ValueError, IndexError) as e:
+            self.reply('ERR ' + str(e))
+            return
+        self.reply('OK' if result is None else result)
@@ -0,0 +1,75 @@
+'''Reads a DHT22 on its own schedule and keeps the last good reading.
+
+The DHT22 can only be measured about every 2 seconds, the read blocks while the
+pin is bit banged, and every so often it fails with an OSError. None of that
+should get into the control loop, so poll() is called every pass and only
+measures when one is due. Failures are retried with a growing back off and
+never raised. The last good reading is only given out for MAX_AGE, after that
+the DHT counts as missing until it reads again.
+'''
+
+import time
+
+
+class DhtService:
+    MIN_INTERVAL = 2000 # (ms) the DHT22 can't be measured faster than this
+    INTERVAL = 10000 # (ms) time between measurements when all is well
+    MAX_BACKOFF = 60000 # (ms) longest wait between retries after failures
+    MAX_AGE = 300000 # (ms) a reading older than this is no longer used
+
+    def __init__(self, dht, interval=INTERVAL):
+        self.dht = dht
+        self.interval = max(interval, self.MIN_INTERVAL)
+        self.temperature = None
+        self.humidity = None
+        self.measured_at = None # ticks_ms of the last good reading
+        self.failures = 0 # in a row
+        self.total_failures = 0
+        self._next = time.ticks_ms() # measure on the first poll
+
+    def poll(self):
+        '''Measure if one is due. Returns True if a new reading was taken.'''
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self._next) < 0:
+            return False
+        try:
+            self.dht.measure()
+            temperature = self.dht.temperature()
+            humidity = self.dht.humidity()
+        except OSError: # timeout or bad checksum
+            self.failures += 1
+            self.total_failures += 1
+            backoff = min(self.MIN_INTERVAL << min(self.failures - 1, 8), self.MAX_BACKOFF)
+            self._next = time.ticks_add(now, backoff)
+            return False
+        self.temperature = temperature
+        self.humidity = humidity
+        self.measured_at = now
+        self.failures = 0
+        self._next = time.ticks_add(now, self.interval)
+        return True
+
+    def due_in(self):
+        '''ms until the next measurement'''
+        return max(0, time.ticks_diff(self._next, time.ticks_ms()))
+
+    def time_jump(self, ms):
+        '''ticks_ms stood still for ms (the board was stopped), move the
+        schedule to match'''
+        self._next = time.ticks_add(self._next, -ms)
+        if self.measured_at is not None:
+            self.measured_at = time.ticks_add(self.measured_at, -ms)
+
+    def age(self):
+        '''ms since the last good reading, None if there hasn't been one'''
+        if self.measured_at is None:
+            return None
+        return time.ticks_diff(time.ticks_ms(), self.measured_at)
+
+    def read(self):
+        '''Return the last good (temperature, humidity), (None, None) if
+        nothing has been read yet or the reading is older than MAX_AGE'''
+        age = self.age()
+        if age is None or age > self.MAX_AGE:
+            return None, None
+        return self.temperature, self.humidity
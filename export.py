@@ -0,0 +1,100 @@
+'''CSV export of the history, a row at a time.
+
+The history can be far bigger than the RAM, so nothing here builds the whole
+file. csv_rows() is a generator that formats one record at a time as it is
+read from the store, CsvStream turns that into a file like object that can be
+read into a fixed buffer, and SerialExport writes it to a stream a chunk per
+call so the loop can carry on in between. Chunks end at the end of a row
+where they can, so anything else written between them doesn't split one.
+'''
+
+import time
+
+COLUMNS = 'time,ph_min,ph_mean,ph_max,temperature,humidity,water_temperature,dose_1,dose_2\n'
+END_OF_TIME = 0xffffffff
+
+
+def format_row(record):
+    '''One history record as a CSV line, empty fields for missing values'''
+    year, month, day, hh, mm, ss = time.localtime(record[0])[:6]
+    parts = ['{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}'.format(year, month, day, hh, mm, ss)]
+    for value in record[1:]:
+        parts.append('' if value is None else '{:g}'.format(value))
+    return ','.join(parts) + '\n'
+
+
+def csv_rows(store, tier, start=0, end=END_OF_TIME):
+    '''Yield the CSV lines for the records in a tier between start and end (s),
+    starting with the column names'''
+    yield COLUMNS
+    for record in store.query(tier, start, end):
+        yield format_row(record)
+
+
+class CsvStream:
+    '''Read only file like object over an iterator of lines'''
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.line = b'' # what is left of the current line
+        self.done = False
+
+    def readinto(self, buf):
+        '''Fill buf with as much as there is, returns the number of bytes. 0
+        means the end.'''
+        size = len(buf)
+        n = 0
+        while n < size:
+            if not self.line:
+                if self.done:
+                    break
+                try:
+                    self.line = next(self.rows).encode()
+                except StopIteration:
+                    self.done = True
+                    break
+                if n and len(self.line) > size - n:
+                    break # won't fit, start the next read with it
+            take = min(size - n, len(self.line))
+            buf[n:n + take] = self.line[:take]
+            self.line = self.line[take:]
+            n += take
+        return n
+
+    def read(self, size=256):
+        buf = bytearray(size)
+        n = self.readinto(buf)
+        return bytes(buf[:n])
+
+
+class SerialExport:
+    '''Writes a CsvStream to a stream in fixed size chunks'''
+    CHUNK_SIZE = 256
+
+    def __init__(self, stream, source, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.source = source
+        self.buf = bytearray(chunk_size)
+        self.view = memoryview(self.buf)
+        self.length = 0 # bytes in buf
+        self.sent = 0 # of those, bytes written so far
+        self.total = 0
+
+    def poll(self):
+        '''Write the next chunk, or what is left of it if the stream only took
+        part last time. Returns False once everything has been written.'''
+        if self.sent == self.length:
+            self.length = self.source.readinto(self.buf)
+            self.sent = 0
+            if not self.length:
+                return False
+        n = self.stream.write(self.view[self.sent:self.length])
+        if n: # None or 0 if the stream timed out, try again next time
+            self.sent += n
+            self.total += n
+        return True
+
+    def between_rows(self):
+        '''True if the last row started has been written in full, so a line
+        written to the stream now won't land in the middle of it'''
+        return self.sent == self.length and (not self.length or self.buf[self.length - 1] == 10)
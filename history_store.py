@@ -0,0 +1,338 @@
+'''Long term history of the readings, kept in flash at several resolutions.
+
+Samples are rolled up into tiers as they arrive: minute records are made from
+the samples, hour records from the minute records and day records from the
+hour records. Each record has the min/mean/max pH, mean air temperature,
+humidity and water temperature and the drips given by each pump.
+
+Each tier is a file of fixed size blocks used as a ring, so the oldest block is
+overwritten once the file is full. A block starts with a header giving the
+time range it covers, then its records. The first record in a block is stored
+as is and the rest as the difference from the one before, all as zigzag
+varints, which is a byte or two per field. Blocks decode on their own, so a
+range query only reads the blocks whose header overlaps the range.
+
+Values are stored as integers scaled by the factor in FIELDS, MISSING stands in
+for a value that wasn't available.
+'''
+
+import os
+import struct
+from array import array
+
+# (name, scale) of the fields after the timestamp
+FIELDS = (('ph_min', 100), ('ph_mean', 100), ('ph_max', 100),
+          ('temperature', 10), ('humidity', 10), ('water_temperature', 10),
+          ('dose_1', 10), ('dose_2', 10))
+MISSING = -32768
+
+HEADER = '<IIHH' # start time, end time, record count, bytes used
+HEADER_SIZE = struct.calcsize(HEADER)
+
+
+def put_varint(buf, pos, value):
+    '''Write a zigzag varint into buf at pos, returns the new pos or -1 if
+    it doesn't fit'''
+    value = (value << 1) ^ (value >> 31) # zigzag, small negatives stay small
+    value &= 0xffffffff
+    end = len(buf)
+    while True:
+        if pos >= end:
+            return -1
+        if value < 0x80:
+            buf[pos] = value
+            return pos + 1
+        buf[pos] = (value & 0x7f) | 0x80
+        value >>= 7
+        pos += 1
+
+
+def get_varint(buf, pos):
+    '''Return (value, new pos) for the zigzag varint in buf at pos'''
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    return (value >> 1) ^ -(value & 1), pos
+
+
+class Aggregate:
+    '''Running min/mean/max and totals for one record being built'''
+
+    def __init__(self):
+        self.reset(0)
+
+    def reset(self, start):
+        self.start = start
+        self.n = 0
+        self.ph_min = None
+        self.ph_max = None
+        self.ph_total = 0.0
+        self.ph_n = 0
+        self.temperature_total = 0.0
+        self.temperature_n = 0
+        self.humidity_total = 0.0
+        self.humidity_n = 0
+        self.water_total = 0.0
+        self.water_n = 0
+        self.doses = [0.0, 0.0]
+
+    def add(self, ph_min, ph_mean, ph_max, temperature, humidity, water_temperature,
+            dose_1, dose_2, weight=1):
+        '''Add a sample (min, mean and max all the same) or a finished
+        record from the tier below, weighted by how many samples it covers'''
+        self.n += weight
+        if ph_mean is not None:
+            if self.ph_min is None or ph_min < self.ph_min:
+                self.ph_min = ph_min
+            if self.ph_max is None or ph_max > self.ph_max:
+                self.ph_max = ph_max
+            self.ph_total += ph_mean * weight
+            self.ph_n += weight
+        if temperature is not None:
+            self.temperature_total += temperature * weight
+            self.temperature_n += weight
+        if humidity is not None:
+            self.humidity_total += humidity * weight
+            self.humidity_n += weight
+        if water_temperature is not None:
+            self.water_total += water_temperature * weight
+            self.water_n += weight
+        self.doses[0] += dose_1
+        self.doses[1] += dose_2
+
+    def values(self):
+        '''The record as a tuple in FIELDS order, None for missing values'''
+        return (self.ph_min,
+                self.ph_total / self.ph_n if self.ph_n else None,
+                self.ph_max,
+                self.temperature_total / self.temperature_n if self.temperature_n else None,
+                self.humidity_total / self.humidity_n if self.humidity_n else None,
+                self.water_total / self.water_n if self.water_n else None,
+                self.doses[0], self.doses[1])
+
+
+class Tier:
+    '''One resolution of history, a ring of blocks in one file'''
+    BLOCK_SIZE = 256
+    FLUSH_RECORDS = 10 # write the current block out after this many records...
+    FLUSH_AGE = 1800 # (s) ...or this much time's worth, whichever is fewer
+
+    def __init__(self, path, period, blocks):
+        self.path = path
+        self.period = period # (s) covered by one record
+        self.blocks = blocks
+        self.starts = array('L', [0] * blocks)
+        self.ends = array('L', [0] * blocks)
+        self.counts = array('H', [0] * blocks)
+        self.buf = bytearray(self.BLOCK_SIZE)
+        self.used = HEADER_SIZE
+        self.current = 0 # block being filled
+        self.last = None # last record written to the current block, as ints
+        self.unflushed = 0
+        # Hour and day records go straight out, a reset would lose too much
+        self.flush_records = max(1, min(self.FLUSH_RECORDS, self.FLUSH_AGE // period))
+        self.aggregate = Aggregate()
+        self.weight = 0 # samples covered by the aggregate
+        self._open()
+
+    def _open(self):
+        size = self.BLOCK_SIZE * self.blocks
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(0, 2)
+                if f.tell() != size:
+                    raise OSError('wrong size')
+                newest = -1
+                for i in range(self.blocks):
+                    f.seek(i * self.BLOCK_SIZE)
+                    start, end, count, _ = struct.unpack(HEADER, f.read(HEADER_SIZE))
+                    self.starts[i], self.ends[i], self.counts[i] = start, end, count
+                    if count and (newest < 0 or start > self.starts[newest]):
+                        newest = i
+                if newest < 0:
+                    return # nothing stored yet
+                self.current = newest
+                f.seek(newest * self.BLOCK_SIZE)
+                f.readinto(self.buf)
+        except OSError: # no file yet, or not one of ours
+            self._create()
+            return
+        # Carry on appending to the newest block
+        _, _, count, used = struct.unpack_from(HEADER, self.buf)
+        self.used = used
+        last = None
+        for record in self._decode(self.buf):
+            last = record
+        self.last = last
+
+    def _create(self):
+        '''Write the file out full size. If there isn't room it is removed
+        again, so it isn't mistaken for a tier next time, and the OSError is
+        passed on.'''
+        try:
+            with open(self.path, 'wb') as f:
+                empty = bytearray(self.BLOCK_SIZE)
+                for _ in range(self.blocks):
+                    f.write(empty)
+        except OSError:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            raise
+
+    def _write_block(self):
+        struct.pack_into(HEADER, self.buf, 0, self.starts[self.current],
+                         self.ends[self.current], self.counts[self.current], self.used)
+        with open(self.path, 'r+b') as f:
+            f.seek(self.current * self.BLOCK_SIZE)
+            f.write(self.buf)
+        self.unflushed = 0
+
+    def flush(self):
+        if self.unflushed:
+            self._write_block()
+
+    def _encode(self, ints):
+        '''Append a record to buf, returns False if it doesn't fit'''
+        pos = self.used
+        last = self.last
+        for i, value in enumerate(ints):
+            pos = put_varint(self.buf, pos, value if last is None else value - last[i])
+            if pos < 0:
+                return False
+        self.used = pos
+        return True
+
+    def append(self, ts, values):
+        '''Add a finished record, values in FIELDS order'''
+        ints = [ts]
+        for (_, scale), value in zip(FIELDS, values):
+            ints.append(MISSING if value is None else int(round(value * scale)))
+        if not self._encode(ints):
+            # Block is full, write it and start the next one
+            self._write_block()
+            self.current = (self.current + 1) % self.blocks
+            for i in range(len(self.buf)):
+                self.buf[i] = 0
+            self.used = HEADER_SIZE
+            self.last = None
+            self.counts[self.current] = 0
+            self._encode(ints)
+        if not self.counts[self.current]:
+            self.starts[self.current] = ts
+        self.ends[self.current] = ts
+        self.counts[self.current] += 1
+        self.last = ints
+        self.unflushed += 1
+        if self.unflushed >= self.flush_records:
+            self._write_block()
+
+    def _decode(self, buf):
+        '''Yield the records in a block as lists of ints'''
+        count = struct.unpack_from(HEADER, buf)[2]
+        pos = HEADER_SIZE
+        last = None
+        for _ in range(count):
+            ints = []
+            for i in range(len(FIELDS) + 1):
+                value, pos = get_varint(buf, pos)
+                ints.append(value if last is None else last[i] + value)
+            last = ints
+            yield ints
+
+    def query(self, start, end):
+        '''Yield (ts, values...) for records from start to end (s), oldest
+        first. Only blocks overlapping the range are read. The records are
+        the ones there when the query started, appends while it is being
+        read, e.g. by SerialExport over many passes of the loop, don't
+        show up in it.'''
+        # Which blocks to read, and the current one as it is now, as the
+        # ring moves on under a slow reader
+        current = self.current
+        struct.pack_into(HEADER, self.buf, 0, self.starts[current], self.ends[current],
+                         self.counts[current], self.used)
+        current_block = bytes(self.buf)
+        wanted = []
+        for n in range(1, self.blocks + 1):
+            i = (current + n) % self.blocks # oldest block first
+            if self.counts[i] and self.ends[i] >= start and self.starts[i] <= end:
+                wanted.append(i)
+        buf = bytearray(self.BLOCK_SIZE)
+        f = None
+        try:
+            for i in wanted:
+                if i == current:
+                    block = current_block
+                else:
+                    if f is None:
+                        f = open(self.path, 'rb')
+                    f.seek(i * self.BLOCK_SIZE)
+                    f.readinto(buf)
+                    block = buf
+                for ints in self._decode(block):
+                    if start <= ints[0] <= end:
+                        record = [ints[0]]
+                        for (_, scale), value in zip(FIELDS, ints[1:]):
+                            record.append(None if value == MISSING else value / scale)
+                        yield tuple(record)
+        finally:
+            if f is not None:
+                f.close()
+
+
+class HistoryStore:
+    # (name, seconds per record, blocks in the file). A minute record is
+    # about 10 bytes, so this is about a day of minutes, a year of hours and
+    # six years of days in 124 KB. That wants an SD card rather than the
+    # internal flash.
+    TIERS = (('minute', 60, 64),
+             ('hour', 3600, 360),
+             ('day', 86400, 64))
+
+    def __init__(self, directory, tiers=TIERS):
+        '''Raises OSError if the files can't be made, e.g. no room'''
+        self.names = [name for name, _, _ in tiers]
+        self.tiers = [Tier('{}/history_{}.dat'.format(directory, name), period, blocks)
+                      for name, period, blocks in tiers]
+
+    def add(self, ts, pH, temperature=None, humidity=None, dose_1=0, dose_2=0,
+            water_temperature=None):
+        '''Add a sample taken at ts (s). Rolls finished records up through
+        the tiers.'''
+        self._add(0, ts, pH, pH, pH, temperature, humidity, water_temperature,
+                  dose_1, dose_2, 1)
+
+    def _add(self, level, ts, ph_min, ph_mean, ph_max, temperature, humidity,
+             water_temperature, dose_1, dose_2, weight):
+        tier = self.tiers[level]
+        bucket = ts - ts % tier.period
+        agg = tier.aggregate
+        if tier.weight and bucket != agg.start:
+            # The record being built is finished, store it and pass it up
+            values = agg.values()
+            tier.append(agg.start, values)
+            if level + 1 < len(self.tiers):
+                self._add(level + 1, agg.start, *values, weight=tier.weight)
+            tier.weight = 0
+        if not tier.weight:
+            agg.reset(bucket)
+        agg.add(ph_min, ph_mean, ph_max, temperature, humidity, water_temperature,
+                dose_1, dose_2, weight)
+        tier.weight += weight
+
+    def flush(self):
+        for tier in self.tiers:
+            tier.flush()
+
+    def query(self, name, start, end):
+        '''Yield records from a tier between start and end (s) as tuples of
+        (ts, ph_min, ph_mean, ph_max, temperature, humidity, water_temperature,
+        dose_1, dose_2)'''
+        return self.tiers[self.names.index(name)].query(start, end)
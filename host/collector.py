@@ -0,0 +1,346 @@
+'''Collects the status of a fleet of pH monitors into a SQLite database.
+
+Runs on a PC with the units plugged in over USB. Every INTERVAL seconds each
+unit is sent "status" over its serial port and the STATUS line it replies
+with is decoded and stored. All the ports are read from one asyncio event
+loop with add_reader(), so hundreds of units don't need hundreds of threads.
+
+Rows are queued and written by one task in batches, each batch in a single
+transaction, on a thread of its own so the event loop never waits on the
+disk. A unit that is unplugged, or stops answering, is closed and opened
+again with a growing back off.
+
+    python3 collector.py --db fleet.db /dev/ttyACM*
+
+fake_device.py makes pty based units to try it against.
+'''
+
+import argparse
+import asyncio
+import concurrent.futures
+import os
+import random
+import sqlite3
+import termios
+import time
+import tty
+
+INTERVAL = 10.0 # (s) between status requests
+TIMEOUT = 5.0 # (s) to wait for a reply
+MAX_MISSED = 3 # replies missed in a row before the port is reopened
+MIN_BACKOFF = 1.0 # (s)
+MAX_BACKOFF = 60.0 # (s)
+BATCH = 500 # most rows in one transaction
+FLUSH_INTERVAL = 1.0 # (s) longest a row waits to be written
+MAX_LINE = 1024 # a line longer than this is thrown away
+
+# STATUS fields that get a column, everything else is kept in extra
+COLUMNS = (('mode', 'TEXT'),
+           ('running', 'INTEGER'),
+           ('locked', 'INTEGER'),
+           ('titrating', 'INTEGER'),
+           ('probe_fault', 'INTEGER'),
+           ('ph', 'REAL'),
+           ('temperature', 'REAL'),
+           ('humidity', 'REAL'),
+           ('water_temperature', 'REAL'),
+           ('next', 'INTEGER'),
+           ('drips_1', 'REAL'), # totals since the unit powered up
+           ('drips_2', 'REAL'),
+           ('hour_mean', 'REAL'),
+           ('hour_sd', 'REAL'),
+           ('hour_slope', 'REAL'),
+           ('day_mean', 'REAL'),
+           ('day_sd', 'REAL'),
+           ('day_slope', 'REAL'))
+NAMES = tuple(name for name, _ in COLUMNS)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS readings (
+    device TEXT NOT NULL,
+    ts REAL NOT NULL,
+    {},
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS readings_device_ts ON readings (device, ts);
+CREATE TABLE IF NOT EXISTS events (
+    device TEXT NOT NULL,
+    ts REAL NOT NULL,
+    event TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_device_ts ON events (device, ts);
+'''.format(',\n    '.join('{} {}'.format(name, kind) for name, kind in COLUMNS))
+
+
+def parse_value(text):
+    '''A STATUS value: None for -, a number if it looks like one, else the
+    text'''
+    if text == '-':
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def parse_status(line):
+    '''Decode a "STATUS key=value ..." line from PH_Monitor.status_line()
+    into a dict, None if it isn't one'''
+    words = line.split()
+    if not words or words[0] != 'STATUS':
+        return None
+    status = {}
+    for word in words[1:]:
+        key, sep, value = word.partition('=')
+        if sep:
+            status[key] = parse_value(value)
+    return status
+
+
+class Database:
+    '''Batched writes to SQLite on a thread of their own'''
+
+    def __init__(self, path, batch=BATCH, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue()
+        # One thread so the connection is only ever used from it
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.conn = None
+        self.rows_written = 0
+        self.transactions = 0
+
+    def _open(self):
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('PRAGMA journal_mode=WAL') # the dashboard can read while this writes
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+
+    def _write(self, readings, events):
+        with self.conn: # one transaction
+            if readings:
+                self.conn.executemany(
+                    'INSERT INTO readings (device, ts, {}, extra) VALUES ({})'.format(
+                        ', '.join(NAMES), ', '.join('?' * (len(NAMES) + 3))),
+                    readings)
+            if events:
+                self.conn.executemany('INSERT INTO events VALUES (?, ?, ?)', events)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def open(self):
+        await self._run(self._open)
+
+    def add_reading(self, device, ts, status):
+        extra = ' '.join('{}={}'.format(key, '-' if value is None else value)
+                         for key, value in status.items() if key not in NAMES)
+        row = (device, ts) + tuple(status.get(name) for name in NAMES) + (extra,)
+        self.queue.put_nowait(('reading', row))
+
+    def add_event(self, device, ts, event):
+        self.queue.put_nowait(('event', (device, ts, event)))
+
+    async def writer(self):
+        '''Write whatever has been queued, a batch at a time'''
+        loop = asyncio.get_running_loop()
+        while True:
+            kind, row = await self.queue.get()
+            readings, events = [], []
+            deadline = loop.time() + self.flush_interval
+            while True:
+                (readings if kind == 'reading' else events).append(row)
+                if len(readings) + len(events) >= self.batch:
+                    break
+                try:
+                    kind, row = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        kind, row = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+            await self._run(self._write, readings, events)
+            self.rows_written += len(readings)
+            self.transactions += 1
+
+    async def close(self):
+        if self.conn is not None:
+            await self._run(self.conn.close)
+        self.executor.shutdown()
+
+
+class Device:
+    '''One unit on a serial port'''
+
+    def __init__(self, path, db, interval=INTERVAL, timeout=TIMEOUT):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.db = db
+        self.interval = interval
+        self.timeout = timeout
+        self.fd = None
+        self.buf = bytearray()
+        self.waiting = None # future for the STATUS reply
+        self.missed = 0
+        self.backoff = MIN_BACKOFF
+        self.last_status = None
+        self.connected = False
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            tty.setraw(fd)
+            attrs = termios.tcgetattr(fd)
+            attrs[4] = attrs[5] = termios.B115200 # ignored over USB, but set it anyway
+            termios.tcsetattr(fd, termios.TCSANOW, attrs)
+            termios.tcflush(fd, termios.TCIOFLUSH)
+        except termios.error:
+            pass # not a tty, e.g. a fifo while testing
+        return fd
+
+    def _close(self):
+        if self.fd is not None:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+        if self.waiting is not None and not self.waiting.done():
+            self.waiting.set_exception(ConnectionError('closed'))
+
+    def _readable(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError: # EIO when the other end goes away
+            data = b''
+        if not data:
+            self.db.add_event(self.name, time.time(), 'port closed')
+            self._close()
+            return
+        self.buf += data
+        while True:
+            end = self.buf.find(b'\n')
+            if end < 0:
+                if len(self.buf) > MAX_LINE:
+                    del self.buf[:]
+                return
+            line = bytes(self.buf[:end]).decode('ascii', 'replace').strip()
+            del self.buf[:end + 1]
+            self._line(line)
+
+    def _line(self, line):
+        status = parse_status(line)
+        if status is not None:
+            if self.waiting is not None and not self.waiting.done():
+                self.waiting.set_result(status)
+        elif line.startswith('CAL ') or line.startswith('ERR'):
+            self.db.add_event(self.name, time.time(), line)
+
+    def _send(self, text):
+        data = text.encode()
+        while data:
+            try:
+                n = os.write(self.fd, data)
+            except BlockingIOError:
+                raise ConnectionError('port not taking data')
+            data = data[n:]
+
+    async def request(self):
+        '''Ask for the status, returns the decoded dict'''
+        self.waiting = asyncio.get_running_loop().create_future()
+        self._send('status\n')
+        return await asyncio.wait_for(self.waiting, self.timeout)
+
+    async def run(self):
+        '''Poll the unit for ever, reopening the port whenever it goes'''
+        loop = asyncio.get_running_loop()
+        # Spread the first requests out so they don't all land at once
+        await asyncio.sleep(random.uniform(0, self.interval))
+        while True:
+            if self.fd is None:
+                try:
+                    self.fd = self._open()
+                except OSError as e:
+                    await self._wait_to_retry('open failed: {}'.format(e))
+                    continue
+                loop.add_reader(self.fd, self._readable)
+                del self.buf[:]
+                self.missed = 0
+            start = loop.time()
+            try:
+                status = await self.request()
+            except (asyncio.TimeoutError, ConnectionError, OSError) as e:
+                self.missed += 1
+                if self.fd is None or self.missed >= MAX_MISSED:
+                    self._close()
+                    await self._wait_to_retry('lost: {}'.format(e or 'no reply'))
+                    continue
+            else:
+                if not self.connected:
+                    self.db.add_event(self.name, time.time(), 'connected')
+                self.connected = True
+                self.missed = 0
+                self.backoff = MIN_BACKOFF
+                self.last_status = status
+                self.db.add_reading(self.name, time.time(), status)
+            await asyncio.sleep(max(0, self.interval - (loop.time() - start)))
+
+    async def _wait_to_retry(self, reason):
+        if self.connected or self.backoff == MIN_BACKOFF:
+            self.db.add_event(self.name, time.time(), reason)
+        self.connected = False
+        await asyncio.sleep(self.backoff * random.uniform(0.5, 1.5))
+        self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+
+
+async def collect(paths, db_path, interval=INTERVAL, until=None):
+    '''Poll every unit in paths into db_path. Runs for ever unless until (s)
+    is given. Returns the Database, for its counters.'''
+    db = Database(db_path)
+    await db.open()
+    devices = [Device(path, db, interval) for path in paths]
+    tasks = [asyncio.ensure_future(device.run()) for device in devices]
+    writer = asyncio.ensure_future(db.writer())
+    try:
+        if until is None:
+            await asyncio.gather(*tasks)
+        else:
+            await asyncio.sleep(until)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for device in devices:
+            device._close()
+        # Let the writer finish what is queued
+        while not db.queue.empty():
+            await asyncio.sleep(db.flush_interval)
+        await asyncio.sleep(db.flush_interval)
+        writer.cancel()
+        await db.close()
+    return db
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('ports', nargs='+', help='serial ports of the units')
+    parser.add_argument('--db', default='fleet.db', help='SQLite database to write to')
+    parser.add_argument('--interval', type=float, default=INTERVAL,
+                        help='seconds between status requests')
+    parser.add_argument('--for', dest='until', type=float,
+                        help='stop after this many seconds')
+    args = parser.parse_args()
+    db = asyncio.run(collect(args.ports, args.db, args.interval, args.until))
+    print('wrote', db.rows_written, 'readings in', db.transactions, 'transactions')
+
+
+if __name__ == '__main__':
+    main()
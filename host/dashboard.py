@@ -0,0 +1,430 @@
+'''Live dashboard for the fleet, served from the collector's database.
+
+One task tails the readings table for new rows and does two things with
+them. It fans each unit's latest status out to every browser through
+server-sent events: the event is encoded once and put on each client's
+queue, so a hundred open pages cost no more reads than one. It also folds
+the rows into per unit aggregates at several resolutions (min/mean/max pH,
+mean temperatures and humidity, drips given), kept in their own table. A
+chart is drawn from the coarsest resolution that still gives enough points,
+a week is 672 fifteen minute buckets, so the raw readings are never scanned
+to draw one. Chart responses are cached for a short while on top of that.
+
+    python3 dashboard.py --db fleet.db --port 8080
+
+Only the standard library is used, the HTTP handling is the bare minimum
+for a browser on the local network.
+'''
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import sqlite3
+import time
+from urllib.parse import parse_qs, urlsplit
+
+POLL_INTERVAL = 1.0 # (s) between looks at the readings table
+POLL_ROWS = 5000 # most rows read per look
+RESOLUTIONS = (60, 900, 3600, 86400) # (s) aggregate bucket sizes
+MAX_POINTS = 800 # a chart uses the finest resolution with no more than this
+CACHE_TIME = 30.0 # (s) a chart response is reused for this long
+CACHE_SIZE = 256
+CLIENT_QUEUE = 100 # events a slow client can fall behind before it is dropped
+KEEPALIVE = 15.0 # (s) between SSE comments on a quiet connection
+
+# Fields that are averaged, the first also gets a min and max
+MEANS = ('ph', 'temperature', 'humidity', 'water_temperature')
+# Fields that are running totals on the unit, the buckets get the increase
+TOTALS = ('drips_1', 'drips_2')
+LIVE = ('mode', 'running', 'locked', 'titrating', 'probe_fault', 'ph', 'temperature',
+        'humidity', 'water_temperature', 'next', 'drips_1', 'drips_2', 'hour_slope')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS aggregates (
+    device TEXT NOT NULL,
+    resolution INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    ph_min REAL,
+    ph_max REAL,
+    {},
+    {},
+    PRIMARY KEY (device, resolution, ts)
+);
+CREATE TABLE IF NOT EXISTS dashboard_state (
+    key TEXT PRIMARY KEY,
+    value
+);
+'''.format(',\n    '.join('{0}_sum REAL, {0}_n INTEGER'.format(name) for name in MEANS),
+           ',\n    '.join('{} REAL'.format(name) for name in TOTALS))
+BUCKET_COLUMNS = (('ph_min', 'ph_max') +
+                  tuple(column for name in MEANS for column in (name + '_sum', name + '_n')) +
+                  TOTALS)
+
+
+class Bucket:
+    '''One aggregate being added to'''
+
+    def __init__(self, row=None):
+        if row is None:
+            row = (None, None) + (0,) * (len(BUCKET_COLUMNS) - 2)
+        self.values = list(row) # in BUCKET_COLUMNS order
+
+    def add(self, reading, increases):
+        values = self.values
+        ph = reading.get('ph')
+        if ph is not None:
+            values[0] = ph if values[0] is None else min(values[0], ph)
+            values[1] = ph if values[1] is None else max(values[1], ph)
+        for i, name in enumerate(MEANS):
+            value = reading.get(name)
+            if value is not None:
+                values[2 + 2 * i] += value
+                values[3 + 2 * i] += 1
+        start = 2 + 2 * len(MEANS)
+        for i, increase in enumerate(increases):
+            values[start + i] += increase
+
+
+class Aggregator:
+    '''Folds readings into buckets and keeps the table up to date'''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.open = {} # (device, resolution): (ts, Bucket) being filled
+        self.dirty = set()
+        self.last_totals = {} # device: the TOTALS last seen
+
+    def _bucket(self, device, resolution, ts):
+        key = (device, resolution)
+        current = self.open.get(key)
+        if current is not None and current[0] == ts:
+            return current[1]
+        if current is not None:
+            self._save(key) # finished with the old one
+        # It may already be part filled, from before a restart
+        row = self.conn.execute(
+            'SELECT {} FROM aggregates WHERE device=? AND resolution=? AND ts=?'.format(
+                ', '.join(BUCKET_COLUMNS)), (device, resolution, ts)).fetchone()
+        bucket = Bucket(row)
+        self.open[key] = (ts, bucket)
+        return bucket
+
+    def add(self, device, ts, reading):
+        increases = []
+        last = self.last_totals.get(device)
+        totals = [reading.get(name) for name in TOTALS]
+        for i, total in enumerate(totals):
+            if total is None or last is None or last[i] is None:
+                increases.append(0)
+            elif total >= last[i]:
+                increases.append(total - last[i])
+            else:
+                increases.append(total) # the unit was restarted
+        self.last_totals[device] = totals
+        for resolution in RESOLUTIONS:
+            bucket_ts = int(ts) - int(ts) % resolution
+            self._bucket(device, resolution, bucket_ts).add(reading, increases)
+            self.dirty.add((device, resolution))
+
+    def _save(self, key):
+        ts, bucket = self.open[key]
+        self.conn.execute(
+            'INSERT OR REPLACE INTO aggregates (device, resolution, ts, {}) VALUES ({})'.format(
+                ', '.join(BUCKET_COLUMNS), ', '.join('?' * (len(BUCKET_COLUMNS) + 3))),
+            key + (ts,) + tuple(bucket.values))
+        self.dirty.discard(key)
+
+    def flush(self):
+        for key in list(self.dirty):
+            self._save(key)
+
+
+class Hub:
+    '''Fans events out to every connected client'''
+
+    def __init__(self):
+        self.clients = set()
+        self.latest = {} # device: encoded status event, sent to new clients first
+        self.dropped = 0
+
+    def subscribe(self):
+        queue = asyncio.Queue(CLIENT_QUEUE + len(self.latest))
+        for event in self.latest.values():
+            queue.put_nowait(event)
+        self.clients.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.clients.discard(queue)
+
+    def publish(self, device, status):
+        event = 'event: status\ndata: {}\n\n'.format(
+            json.dumps(dict(status, device=device))).encode()
+        self.latest[device] = event
+        for queue in list(self.clients):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Too slow to keep up, it can reconnect and start again
+                self.clients.discard(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+                self.dropped += 1
+
+
+class Dashboard:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.conn = None
+        self.aggregator = None
+        self.hub = Hub()
+        self.last_rowid = 0
+        self.cache = {} # key: (expires, body)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _open(self):
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA busy_timeout=5000') # the collector writes too
+        self.conn.executescript(SCHEMA)
+        row = self.conn.execute(
+            "SELECT value FROM dashboard_state WHERE key='last_rowid'").fetchone()
+        self.last_rowid = row[0] if row else 0
+        self.aggregator = Aggregator(self.conn)
+
+    def _poll(self):
+        '''New readings since the last look, folded into the aggregates'''
+        try:
+            rows = self.conn.execute(
+                'SELECT rowid, device, ts, {} FROM readings WHERE rowid > ? '
+                'ORDER BY rowid LIMIT ?'.format(', '.join(LIVE)),
+                (self.last_rowid, POLL_ROWS)).fetchall()
+        except sqlite3.OperationalError: # the collector hasn't made the table yet
+            return []
+        if not rows:
+            return []
+        readings = []
+        with self.conn:
+            for row in rows:
+                reading = dict(zip(LIVE, row[3:]))
+                self.aggregator.add(row[1], row[2], reading)
+                readings.append((row[1], row[2], reading))
+            self.aggregator.flush()
+            self.last_rowid = rows[-1][0]
+            self.conn.execute("INSERT OR REPLACE INTO dashboard_state VALUES ('last_rowid', ?)",
+                              (self.last_rowid,))
+        return readings
+
+    async def poller(self):
+        while True:
+            readings = await self._run(self._poll)
+            latest = {}
+            for device, ts, reading in readings:
+                latest[device] = dict(reading, ts=ts)
+            for device, status in latest.items():
+                self.hub.publish(device, status)
+            if len(readings) < POLL_ROWS:
+                await asyncio.sleep(POLL_INTERVAL)
+
+    def _history(self, device, start, end):
+        span = max(1, end - start)
+        resolution = RESOLUTIONS[-1]
+        for r in RESOLUTIONS:
+            if span / r <= MAX_POINTS:
+                resolution = r
+                break
+        rows = self.conn.execute(
+            'SELECT ts, {} FROM aggregates WHERE device=? AND resolution=? AND ts BETWEEN ? AND ? '
+            'ORDER BY ts'.format(', '.join(BUCKET_COLUMNS)),
+            (device, resolution, start - start % resolution, end)).fetchall()
+        points = []
+        for row in rows:
+            point = {'ts': row[0], 'ph_min': row[1], 'ph_max': row[2]}
+            for i, name in enumerate(MEANS):
+                total, n = row[3 + 2 * i], row[4 + 2 * i]
+                point[name] = total / n if n else None
+            for i, name in enumerate(TOTALS):
+                point[name] = row[3 + 2 * len(MEANS) + i]
+            points.append(point)
+        return {'device': device, 'resolution': resolution, 'points': points}
+
+    async def history(self, device, start, end):
+        '''JSON for a chart, from the cache if it was asked for recently'''
+        now = time.time()
+        key = (device, start // 60, end // 60) # a minute either way is the same chart
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        body = json.dumps(await self._run(self._history, device, start, end)).encode()
+        if len(self.cache) >= CACHE_SIZE:
+            self.cache = {k: v for k, v in self.cache.items() if v[0] > now}
+            if len(self.cache) >= CACHE_SIZE:
+                self.cache.clear()
+        self.cache[key] = (now + CACHE_TIME, body)
+        return body
+
+    # HTTP
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b'\r\n', b'\n', b''):
+                pass # headers aren't needed
+            parts = request.decode('latin-1').split()
+            if len(parts) < 2 or parts[0] != 'GET':
+                await self.respond(writer, 405, b'GET only\n', 'text/plain')
+                return
+            url = urlsplit(parts[1])
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if url.path == '/':
+                await self.respond(writer, 200, PAGE.encode(), 'text/html; charset=utf-8')
+            elif url.path == '/events':
+                await self.events(writer)
+            elif url.path == '/history' and 'device' in query:
+                end = int(float(query.get('end', time.time())))
+                start = int(float(query.get('start', end - float(query.get('hours', 24)) * 3600)))
+                body = await self.history(query['device'], start, end)
+                await self.respond(writer, 200, body, 'application/json')
+            else:
+                await self.respond(writer, 404, b'not found\n', 'text/plain')
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, code, body, content_type):
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n'
+                     'Connection: close\r\n\r\n'.format(
+                         code, {200: 'OK', 404: 'Not Found'}.get(code, 'Error'),
+                         content_type, len(body)).encode())
+        writer.write(body)
+        await writer.drain()
+
+    async def events(self, writer):
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+                     b'Cache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n')
+        queue = self.hub.subscribe()
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    event = b': keepalive\n\n'
+                if event is None: # dropped for falling behind
+                    return
+                writer.write(event)
+                await writer.drain()
+        finally:
+            self.hub.unsubscribe(queue)
+
+    async def serve(self, host, port):
+        await self._run(self._open)
+        poller = asyncio.ensure_future(self.poller())
+        server = await asyncio.start_server(self.handle, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            poller.cancel()
+
+
+PAGE = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>pH monitors</title>
+<style>
+body { font-family: sans-serif; margin: 1em; }
+table { border-collapse: collapse; }
+td, th { padding: 0.2em 0.8em; border-bottom: 1px solid #ccc; text-align: right; }
+tr { cursor: pointer; }
+tr.fault { background: #fdd; }
+canvas { border: 1px solid #ccc; margin-top: 1em; }
+</style></head>
+<body>
+<h1>pH monitors</h1>
+<table><thead><tr><th>unit</th><th>mode</th><th>pH</th><th>trend /h</th><th>water &deg;C</th>
+<th>air &deg;C</th><th>humidity %</th><th>next dose</th><th>drips 1</th><th>drips 2</th>
+<th>seen</th></tr></thead><tbody id="units"></tbody></table>
+<p>
+<select id="span"><option value="24">day</option><option value="168">week</option>
+<option value="720">month</option><option value="8760">year</option></select>
+<span id="title"></span></p>
+<canvas id="chart" width="900" height="300"></canvas>
+<script>
+var units = {}, chosen = null;
+function fmt(v, d) { return v === null || v === undefined ? '-' : Number(v).toFixed(d); }
+function hms(s) {
+  if (s < 0) return '-';
+  var h = Math.floor(s / 3600), m = Math.floor(s / 60) % 60;
+  return h + ':' + (m < 10 ? '0' : '') + m;
+}
+function draw() {
+  var body = document.getElementById('units'), rows = '';
+  Object.keys(units).sort().forEach(function (name) {
+    var u = units[name];
+    rows += '<tr onclick="choose(\\'' + name + '\\')" class="' +
+      (u.probe_fault || u.mode == 'FAULT' ? 'fault' : '') + '"><td>' + name + '</td><td>' + u.mode +
+      '</td><td>' + fmt(u.ph, 2) + '</td><td>' + fmt(u.hour_slope, 3) + '</td><td>' +
+      fmt(u.water_temperature, 1) + '</td><td>' + fmt(u.temperature, 1) + '</td><td>' +
+      fmt(u.humidity, 0) + '</td><td>' + hms(u.next) + '</td><td>' + fmt(u.drips_1, 1) +
+      '</td><td>' + fmt(u.drips_2, 1) + '</td><td>' +
+      new Date(u.ts * 1000).toLocaleTimeString() + '</td></tr>';
+  });
+  body.innerHTML = rows;
+}
+function choose(name) { chosen = name; chart(); }
+function chart() {
+  if (!chosen) return;
+  var hours = document.getElementById('span').value;
+  fetch('/history?device=' + encodeURIComponent(chosen) + '&hours=' + hours)
+    .then(function (r) { return r.json(); }).then(function (h) {
+      document.getElementById('title').textContent = chosen + ', ' + h.points.length +
+        ' points of ' + h.resolution + ' s';
+      var c = document.getElementById('chart'), g = c.getContext('2d');
+      g.clearRect(0, 0, c.width, c.height);
+      var p = h.points.filter(function (p) { return p.ph !== null; });
+      if (!p.length) return;
+      var t0 = p[0].ts, t1 = p[p.length - 1].ts || t0 + 1, lo = 14, hi = 0;
+      p.forEach(function (q) { lo = Math.min(lo, q.ph_min); hi = Math.max(hi, q.ph_max); });
+      hi += 0.05; lo -= 0.05;
+      function x(t) { return (t - t0) / Math.max(1, t1 - t0) * (c.width - 40) + 35; }
+      function y(v) { return c.height - 10 - (v - lo) / (hi - lo) * (c.height - 20); }
+      g.fillStyle = '#cde';
+      p.forEach(function (q) { g.fillRect(x(q.ts), y(q.ph_max), 2, y(q.ph_min) - y(q.ph_max)); });
+      g.strokeStyle = '#036'; g.beginPath();
+      p.forEach(function (q, i) { i ? g.lineTo(x(q.ts), y(q.ph)) : g.moveTo(x(q.ts), y(q.ph)); });
+      g.stroke();
+      g.fillStyle = '#c00';
+      p.forEach(function (q) { if (q.drips_1 || q.drips_2) g.fillRect(x(q.ts), c.height - 8, 2, 6); });
+      g.fillStyle = '#000';
+      g.fillText(hi.toFixed(2), 0, 12); g.fillText(lo.toFixed(2), 0, c.height - 12);
+    });
+}
+document.getElementById('span').onchange = chart;
+var source = new EventSource('/events');
+source.addEventListener('status', function (e) {
+  var u = JSON.parse(e.data);
+  units[u.device] = u;
+  draw();
+});
+setInterval(chart, 60000);
+</script></body></html>
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--db', default='fleet.db', help="the collector's database")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+    try:
+        asyncio.run(Dashboard(args.db).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
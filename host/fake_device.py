@@ -0,0 +1,118 @@
+'''Pretend pH monitors on ptys, for trying the collector without hardware.
+
+Each FakeDevice opens a pty and answers the serial commands the way
+PH_Monitor does, with a pH that wanders about the target. path is the end
+to give the collector. unplug() and plug() close and reopen it, to see the
+collector reconnect.
+
+    python3 fake_device.py 200      # prints the paths, runs until ^C
+'''
+
+import argparse
+import asyncio
+import os
+import random
+import tty
+
+
+class FakeDevice:
+    def __init__(self, seed=None, reply_delay=0.01):
+        self.random = random.Random(seed)
+        self.reply_delay = reply_delay # (s) how long a reading takes
+        self.ph = self.random.uniform(5.6, 6.0)
+        self.temperature = self.random.uniform(18, 24)
+        self.humidity = self.random.uniform(40, 60)
+        self.water_temperature = self.temperature + 2
+        self.requests = 0
+        self.drips = [0.0, 0.0]
+        self.master = self.slave = None
+        self.path = None
+        self.buf = bytearray()
+        self.plug()
+
+    def plug(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        os.set_blocking(self.master, False)
+        asyncio.get_running_loop().add_reader(self.master, self._readable)
+
+    def unplug(self):
+        '''Close the pty, the collector sees EIO. plug() makes a new one,
+        with a new path.'''
+        asyncio.get_running_loop().remove_reader(self.master)
+        os.close(self.master)
+        os.close(self.slave)
+        self.master = self.slave = None
+
+    def status_line(self):
+        self.ph += self.random.gauss(0, 0.01)
+        if abs(self.ph - 5.8) > 0.2 and self.random.random() < 0.1:
+            pump = 0 if self.ph > 5.8 else 1
+            self.drips[pump] += 1
+            self.ph += -0.05 if pump == 0 else 0.05
+        parts = ['STATUS', 'mode=RUNNING', 'running=1', 'locked=0', 'titrating=0',
+                 'probe_fault=0',
+                 'ph={:.2f}'.format(self.ph),
+                 'temperature={:.2f}'.format(self.temperature),
+                 'humidity={:.2f}'.format(self.humidity),
+                 'water_temperature={:.2f}'.format(self.water_temperature),
+                 'drips_1={:.2f}'.format(self.drips[0]),
+                 'drips_2={:.2f}'.format(self.drips[1]),
+                 'next={:d}'.format(self.random.randrange(7200))]
+        for name in ('hour', 'day'):
+            parts.append('{}_mean={:.3f} {}_sd={:.3f} {}_min={:.3f} {}_max={:.3f} {}_slope={:.3f}'.format(
+                name, self.ph, name, 0.02, name, self.ph - 0.05, name, self.ph + 0.05,
+                name, self.random.gauss(0, 0.01)))
+        return ' '.join(parts)
+
+    def _readable(self):
+        try:
+            data = os.read(self.master, 1024)
+        except OSError:
+            return
+        self.buf += data
+        while b'\n' in self.buf:
+            line, _, rest = bytes(self.buf).partition(b'\n')
+            self.buf = bytearray(rest)
+            asyncio.get_running_loop().call_later(self.reply_delay, self._reply,
+                                                  line.decode().strip())
+
+    def _reply(self, line):
+        if self.master is None:
+            return
+        words = line.split()
+        if not words:
+            return
+        if words[0] == 'status':
+            self.requests += 1
+            reply = self.status_line()
+        elif words[0] == 'help':
+            reply = 'band cal export help interval prime start status stop target'
+        else:
+            reply = 'OK'
+        try:
+            os.write(self.master, (reply + '\n').encode())
+        except OSError:
+            pass
+
+
+async def serve(count, seed=0):
+    devices = [FakeDevice(seed + i) for i in range(count)]
+    for device in devices:
+        print(device.path, flush=True)
+    await asyncio.Event().wait() # for ever
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('count', type=int, nargs='?', default=1)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.count))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+'''Replays a trace of ADC reads (adc_trace.py) through PH_Monitor on a PC.
+
+The monitor is built the way main.py builds it, but on virtual time
+(virtual.py) and with the traced pH and button pins standing in for the
+ADCs, so it reads what the unit read and presses what was pressed. Nothing
+in PH_Monitor is changed for it. A day of trace replays in seconds.
+
+Every dose is noted with its time, pump, volume and the pH it was given at.
+With --against the same trace is also run through another copy of the code,
+e.g. a git worktree of an older version, both at once, and the two lists of
+doses are compared:
+
+    python3 replay.py trace.bin
+    git worktree add /tmp/old v1.4
+    python3 replay.py trace.bin --against /tmp/old
+
+Reads are matched up with the trace by time. A pH read gets the next traced
+value if that was read within SLACK ms of now, otherwise the last one again.
+Traced values more than SLACK ms old are passed over, so a version that
+reads more or less often than the one traced stays in step. The button pin
+was only traced when it changed, and reads whatever it was last traced as.
+The water temperature is played back the same way through a stand in for
+the DS18B20, so the pH is worked out from the counts as it was on the unit.
+A version 1 trace has no water temperature, if the unit had a probe its
+replay won't dose the same, and a warning says so.
+'''
+
+import argparse
+import concurrent.futures
+import multiprocessing
+import os
+import struct
+import sys
+import time
+from array import array
+
+import virtual
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Only for the file format, and not left on the path where it could stand
+# in for modules missing from the version under --against
+sys.path.insert(0, ROOT)
+import adc_trace
+sys.path.remove(ROOT)
+
+EPOCH_2000 = 946684800 # the pyboard's time.time() counts from 2000
+SLACK = 250 # (ms)
+FLOW = 0.05 / 20 # (ml/ms) pump flow at full speed
+MATCH_TIME = 5000 # (ms) doses this close together with the same volume are the same decision
+
+
+def read_trace(path):
+    '''Returns (start time, version, {channel: (times, values)}), times in
+    ms from the start of the trace'''
+    with open(path, 'rb') as f:
+        data = f.read()
+    header = struct.calcsize(adc_trace.HEADER)
+    magic, version, start = struct.unpack_from(adc_trace.HEADER, data)
+    if magic != adc_trace.MAGIC or not 1 <= version <= adc_trace.VERSION:
+        raise ValueError('{} is not a version 1 to {} trace'.format(path, adc_trace.VERSION))
+    end = header + (len(data) - header) // adc_trace.RECORD_SIZE * adc_trace.RECORD_SIZE
+    words = array('H')
+    words.frombytes(data[header:end]) # a crash can leave half a record on the end
+    if sys.byteorder != 'little':
+        words.byteswap()
+    channels = {}
+    ms = 0
+    deltas = words[0::2]
+    kinds = words[1::2]
+    for delta, word in zip(deltas, kinds):
+        ms += delta
+        channel = word >> 12
+        if channel == adc_trace.GAP:
+            continue
+        if channel not in channels:
+            channels[channel] = (array('q'), array('H'))
+        times, values = channels[channel]
+        times.append(ms)
+        values.append(word & adc_trace.VALUE_MASK)
+    return start + EPOCH_2000, version, channels
+
+
+class TraceADC:
+    '''Plays back one channel of a trace as an ADC. held is for a channel
+    that was only traced when it changed.'''
+
+    def __init__(self, clock, times, values, slack=SLACK, held=False, idle=4095):
+        self.clock = clock
+        self.times = times
+        self.values = values
+        self.slack = 0 if held else slack
+        self.held = held
+        self.next = 0 # index of the next traced value
+        self.value = idle if held or not values else values[0]
+
+    def read(self):
+        now = self.clock.ms # ticks_ms() would wrap on a long trace
+        times = self.times
+        i = self.next
+        n = len(times)
+        if self.held:
+            while i < n and times[i] <= now:
+                i += 1
+            if i > self.next:
+                self.value = self.values[i - 1]
+                self.next = i
+            return self.value
+        while i < n and times[i] < now - self.slack:
+            i += 1
+        if i > self.next:
+            self.value = self.values[i - 1] # passed over, but it was the value then
+        if i < n and times[i] <= now + self.slack:
+            self.value = self.values[i]
+            i += 1
+        self.next = i
+        return self.value
+
+    def read_timed(self, buf, timer):
+        period = 1000000 // timer.freq()
+        for i in range(len(buf)):
+            buf[i] = self.read()
+            time.sleep_us(period)
+
+
+class TraceWater:
+    '''Stands in for water_temp.WaterTemperature, reading the WATER channel
+    of a trace through a held TraceADC'''
+
+    def __init__(self, adc):
+        self.adc = adc
+
+    def poll(self):
+        return False
+
+    def due_in(self):
+        return 10000 # nothing to do, the trace changes it
+
+    def time_jump(self, ms):
+        pass
+
+    def age(self):
+        return None if self.read() is None else 0
+
+    def read(self):
+        return adc_trace.water_temperature(self.adc.read())
+
+
+def replay(path, root=ROOT, hours=None, sampler='sync', slack=SLACK):
+    '''Run the trace through the PH_Monitor in root. Returns a dict with the
+    doses as (ms, pump, ml, pH) tuples.'''
+    started = time.time()
+    start, version, channels = read_trace(path)
+    empty = (array('q'), array('H'))
+    ph_times, ph_values = channels.get(adc_trace.PH, empty)
+    button_times, button_values = channels.get(adc_trace.BUTTONS, empty)
+    end = max(ph_times[-1] if ph_times else 0, button_times[-1] if button_times else 0)
+    if hours is not None:
+        end = min(end, hours * 3600000)
+    clock = virtual.Clock(end=end)
+    virtual.install(clock, root)
+    from pH_monitor import PH_Monitor
+    import acquisition
+
+    ph_pin = TraceADC(clock, ph_times, ph_values, slack, adc_trace.PH in adc_trace.HELD)
+    button_pin = TraceADC(clock, button_times, button_values, slack,
+                          adc_trace.BUTTONS in adc_trace.HELD)
+    water = None
+    if adc_trace.WATER in channels:
+        water_times, water_values = channels[adc_trace.WATER]
+        water = TraceWater(TraceADC(clock, water_times, water_values, slack,
+                                    adc_trace.WATER in adc_trace.HELD, adc_trace.NO_VALUE))
+    doses = []
+    monitor = None
+
+    def on_dose(pump):
+        def note(ml):
+            doses.append((int(clock.ms), pump, round(ml, 4), monitor.ph))
+        return note
+
+    pump_1 = virtual.DosePump(clock, FLOW, on_dose(1))
+    pump_2 = virtual.DosePump(clock, FLOW, on_dose(2))
+    if sampler == 'sync':
+        source = acquisition.SyncSampler(ph_pin, virtual.Timer())
+        if hasattr(acquisition, 'PumpBlanking'):
+            ph_sampler = acquisition.SequentialSampler(source, blanking=acquisition.PumpBlanking())
+        else: # older code, from before the pH samples kept clear of the pumps
+            ph_sampler = acquisition.SequentialSampler(source)
+    else:
+        ph_sampler = None # PH_Monitor's own
+    monitor = PH_Monitor(ph_pin, button_pin, pump_1, pump_2, virtual.Dht(), virtual.Lcd(),
+                         ph_sampler, power=virtual.FastForward(clock), water=water)
+    try:
+        monitor.loop()
+    except virtual.Finished:
+        pass
+    return {'root': os.path.abspath(root),
+            'start': start,
+            'version': version,
+            'ms': int(clock.ms),
+            'reads': len(ph_values) + len(button_values),
+            'doses': doses,
+            'ml': (pump_1.total_ml, pump_2.total_ml),
+            'seconds': time.time() - started}
+
+
+def compare(a, b, match_time=MATCH_TIME):
+    '''Line the doses of two replays up. Returns a list of (a dose or None,
+    b dose or None), None where the other version didn't give it.'''
+    pairs = []
+    i = j = 0
+    doses_a, doses_b = a['doses'], b['doses']
+    while i < len(doses_a) or j < len(doses_b):
+        dose_a = doses_a[i] if i < len(doses_a) else None
+        dose_b = doses_b[j] if j < len(doses_b) else None
+        if (dose_a is not None and dose_b is not None and dose_a[1:3] == dose_b[1:3]
+                and abs(dose_a[0] - dose_b[0]) <= match_time):
+            pairs.append((dose_a, dose_b))
+            i += 1
+            j += 1
+        elif dose_b is None or (dose_a is not None and dose_a[0] <= dose_b[0]):
+            pairs.append((dose_a, None))
+            i += 1
+        else:
+            pairs.append((None, dose_b))
+            j += 1
+    return pairs
+
+
+def hhmmss(ms):
+    s = ms // 1000
+    return '{:d}:{:02d}:{:02d}'.format(s // 3600, s // 60 % 60, s % 60)
+
+
+def describe(dose):
+    if dose is None:
+        return '-'
+    pH = '?' if dose[3] is None else '{:.2f}'.format(dose[3])
+    return 'pump {} {:.3f} ml at pH {}'.format(dose[1], dose[2], pH)
+
+
+def summary(result):
+    return '{}: {} doses, {:.2f} + {:.2f} ml over {}, replayed in {:.1f} s'.format(
+        result['root'], len(result['doses']), result['ml'][0], result['ml'][1],
+        hhmmss(result['ms']), result['seconds'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('trace')
+    parser.add_argument('--root', default=ROOT, help='code to replay through, this one by default')
+    parser.add_argument('--against', help='another copy of the code to compare with')
+    parser.add_argument('--hours', type=float, help='only replay this much of the trace')
+    parser.add_argument('--sampler', choices=('sync', 'pin'), default='sync',
+                        help='SyncSampler on a timer as in main.py, or single reads')
+    parser.add_argument('--slack', type=int, default=SLACK, help='ms a read can be off the trace by')
+    parser.add_argument('--show', type=int, default=20, help='differences to list')
+    args = parser.parse_args()
+
+    roots = [args.root] + ([args.against] if args.against else [])
+    # A process each, so the two versions' modules can't get mixed up
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(len(roots), mp_context=context) as pool:
+        futures = [pool.submit(replay, args.trace, root, args.hours, args.sampler, args.slack)
+                   for root in roots]
+        results = [future.result() for future in futures]
+    print('trace from', time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(results[0]['start'])))
+    if results[0]['version'] < 2:
+        print('warning: a version {} trace has no water temperature, if the unit had a '
+              'probe its pH readings and doses won\'t be replayed the same'.format(
+                  results[0]['version']), file=sys.stderr)
+    for result in results:
+        print(summary(result))
+    if len(results) == 1:
+        for dose in results[0]['doses'][:args.show]:
+            print('{:>10} {}'.format(hhmmss(dose[0]), describe(dose)))
+        return
+
+    pairs = compare(*results)
+    differences = [(a, b) for a, b in pairs if a is None or b is None]
+    if not differences:
+        print('same doses, {} of them'.format(len(pairs)))
+        return
+    first = differences[0]
+    print('{} of {} doses differ, first at {}'.format(
+        len(differences), len(pairs), hhmmss((first[0] or first[1])[0])))
+    print('{:>10}  {:<32} {}'.format('time', 'root', 'against'))
+    for a, b in differences[:args.show]:
+        print('{:>10}  {:<32} {}'.format(hhmmss((a or b)[0]), describe(a), describe(b)))
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
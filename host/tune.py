@@ -0,0 +1,234 @@
+'''Searches for good control settings by simulation, on every core.
+
+Each run puts the real PH_Monitor, unchanged, on virtual time (virtual.py)
+in front of a simulated bath: a pH that drifts, doses that take a while to
+mix in, pumps with a fixed flow rate and a noisy electrode. The pumps are
+given doses by volume, like the PwmPumps in main.py, so DRIP_TIME doesn't
+come into it. The settings tried are the band (PH_ERROR), DRIP_VOLUME,
+ADJUSTMENT_INTERVAL and the number of ADC reads averaged per pH reading.
+
+Every setting is run against the same set of baths, drawn from --seed, so
+they are compared on equal terms and the whole table can be reproduced.
+Runs are spread over a ProcessPoolExecutor. Settings are ranked by the
+fraction of time the bath was within EVAL_BAND of the target, then by
+reagent used and pump actuations, and the table is written out as CSV.
+
+    python3 tune.py --hours 48 --baths 4 --out results.csv
+    python3 tune.py --random 200 --seed 7
+'''
+
+import argparse
+import concurrent.futures
+import csv
+import itertools
+import math
+import os
+import random
+import sys
+import time
+
+import virtual
+
+# What is searched over, (name, values for a grid search, (low, high) for a random one)
+PARAMETERS = (('band', (0.1, 0.2, 0.3), (0.05, 0.4)),
+              ('drip_volume', (0.025, 0.05, 0.1), (0.01, 0.2)),
+              ('interval_min', (30, 60, 120), (15, 240)),
+              ('repeats', (10, 50, 200), (5, 300)))
+
+EVAL_BAND = 0.2 # (pH) every setting is judged on this band, whatever its own
+FLOW = 0.05 / 20 # (ml/ms) PwmPump's flow at 100% duty
+
+
+class Bath:
+    '''A bath whose pH drifts, changed by doses that mix in over tau'''
+
+    def __init__(self, rng, target):
+        self.rng = rng
+        self.ph = target + rng.uniform(-1.0, 1.0)
+        self.drift = rng.uniform(-0.05, 0.05) # (pH/h)
+        self.acid_gain = -rng.uniform(0.3, 0.6) # (pH/ml)
+        self.base_gain = rng.uniform(0.3, 0.6)
+        self.tau = rng.uniform(60, 300) * 1000 # (ms) mixing time constant
+        self.noise = rng.uniform(0.005, 0.03) # (pH) electrode noise on each read
+        self.unmixed = 0.0 # pH change still to mix in
+
+    def advance(self, ms):
+        self.ph += self.drift * ms / 3600000
+        mixed = self.unmixed * (1 - math.exp(-ms / self.tau))
+        self.ph += mixed
+        self.unmixed -= mixed
+
+    def acid(self, ml):
+        self.unmixed += self.acid_gain * ml
+
+    def base(self, ml):
+        self.unmixed += self.base_gain * ml
+
+    def probe(self, gradient, offset):
+        '''ADC counts for the pH the electrode sees now'''
+        ph = self.ph + self.rng.gauss(0, self.noise)
+        return min(4095, max(0, int(round((ph - offset) / gradient))))
+
+
+class RepeatSampler:
+    '''PH_Monitor.read_ph_meter(repeats) as a sampler: repeats reads 2 ms
+    apart, averaged'''
+
+    def __init__(self, adc, repeats):
+        self.adc = adc
+        self.repeats = repeats
+
+    def read(self):
+        total = 0
+        for _ in range(self.repeats):
+            total += self.adc.read()
+            time.sleep_ms(2)
+        return total / self.repeats
+
+
+def simulate(settings, seed, hours):
+    '''One run of PH_Monitor against the bath made from seed. Returns a dict
+    of the results.'''
+    clock = virtual.Clock(end=hours * 3600000)
+    virtual.install(clock)
+    from pH_monitor import PH_Monitor
+
+    rng = random.Random(seed)
+    target = PH_Monitor.PH_TARGET
+    bath = Bath(rng, target)
+    score = {'in_band_ms': 0.0, 'abs_error_ms': 0.0}
+
+    def listen(ms):
+        bath.advance(ms)
+        error = abs(bath.ph - target)
+        if error <= EVAL_BAND:
+            score['in_band_ms'] += ms
+        score['abs_error_ms'] += error * ms
+    clock.listeners.append(listen)
+
+    adc = virtual.AnalogueIn(lambda: bath.probe(PH_Monitor.PH_GRADIENT, PH_Monitor.PH_OFFSET))
+    pump_1 = virtual.DosePump(clock, FLOW, bath.acid)
+    pump_2 = virtual.DosePump(clock, FLOW, bath.base)
+    monitor = PH_Monitor(adc, virtual.AnalogueIn(lambda: 4095), pump_1, pump_2,
+                         virtual.Dht(), virtual.Lcd(),
+                         sampler=RepeatSampler(adc, settings['repeats']),
+                         power=virtual.FastForward(clock))
+    monitor.PH_ERROR = settings['band']
+    monitor.DRIP_VOLUME = settings['drip_volume']
+    monitor.ADJUSTMENT_INTERVAL = int(settings['interval_min'] * 60000)
+    monitor.start()
+    try:
+        monitor.loop()
+    except virtual.Finished:
+        pass
+    ms = clock.ms
+    return dict(settings,
+                seed=seed,
+                in_band=score['in_band_ms'] / ms,
+                mean_error=score['abs_error_ms'] / ms,
+                reagent_ml=pump_1.total_ml + pump_2.total_ml,
+                actuations=pump_1.actuations + pump_2.actuations,
+                titration_min=(monitor.titration_time / 60000
+                               if monitor.titration_time is not None else None))
+
+
+def grid():
+    names = [name for name, _, _ in PARAMETERS]
+    for values in itertools.product(*(values for _, values, _ in PARAMETERS)):
+        yield dict(zip(names, values))
+
+
+def random_settings(count, rng):
+    for _ in range(count):
+        settings = {}
+        for name, values, (low, high) in PARAMETERS:
+            if isinstance(values[0], int):
+                settings[name] = rng.randint(low, high)
+            else:
+                settings[name] = round(rng.uniform(low, high), 3)
+        yield settings
+
+
+def summarise(runs):
+    '''Average each setting's runs, best first'''
+    by_settings = {}
+    names = [name for name, _, _ in PARAMETERS]
+    for run in runs:
+        by_settings.setdefault(tuple(run[name] for name in names), []).append(run)
+    table = []
+    for key, group in by_settings.items():
+        n = len(group)
+        titrations = [run['titration_min'] for run in group if run['titration_min'] is not None]
+        row = dict(zip(names, key))
+        row.update(runs=n,
+                   in_band=sum(run['in_band'] for run in group) / n,
+                   worst_in_band=min(run['in_band'] for run in group),
+                   mean_error=sum(run['mean_error'] for run in group) / n,
+                   reagent_ml=sum(run['reagent_ml'] for run in group) / n,
+                   actuations=sum(run['actuations'] for run in group) / n,
+                   titration_min=sum(titrations) / len(titrations) if titrations else None,
+                   titrated=len(titrations))
+        table.append(row)
+    # Time in band to the nearest 0.1% first, so near ties go to the thriftier one
+    table.sort(key=lambda row: (-round(row['in_band'], 3), row['reagent_ml'], row['actuations']))
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--hours', type=float, default=48, help='simulated hours per run')
+    parser.add_argument('--baths', type=int, default=4, help='baths each setting is run against')
+    parser.add_argument('--seed', type=int, default=1, help='makes the baths and random settings')
+    parser.add_argument('--random', type=int, metavar='N',
+                        help='try N random settings instead of the grid')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out', default='tune_results.csv', help='CSV of every setting')
+    parser.add_argument('--runs-out', help='CSV of every single run as well')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.random:
+        candidates = list(random_settings(args.random, rng))
+    else:
+        candidates = list(grid())
+    seeds = [args.seed * 1000 + i for i in range(args.baths)]
+    jobs = [(settings, seed) for settings in candidates for seed in seeds]
+    print('{} settings x {} baths x {} h on {} workers'.format(
+        len(candidates), len(seeds), args.hours, args.workers), file=sys.stderr)
+
+    started = time.time()
+    runs = []
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+        futures = [pool.submit(simulate, settings, seed, args.hours) for settings, seed in jobs]
+        for i, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            runs.append(future.result())
+            if not i % 50 or i == len(futures):
+                print('{}/{} runs, {:.0f} s'.format(i, len(futures), time.time() - started),
+                      file=sys.stderr)
+    # as_completed order depends on timing, sort so the files come out the same every time
+    runs.sort(key=lambda run: tuple(run[name] for name, _, _ in PARAMETERS) + (run['seed'],))
+    table = summarise(runs)
+
+    with open(args.out, 'w', newline='') as f:
+        writer = csv.DictWriter(f, list(table[0]))
+        writer.writeheader()
+        writer.writerows(table)
+    if args.runs_out:
+        with open(args.runs_out, 'w', newline='') as f:
+            writer = csv.DictWriter(f, list(runs[0]))
+            writer.writeheader()
+            writer.writerows(runs)
+
+    print('{:>6} {:>11} {:>12} {:>7} {:>8} {:>6} {:>9} {:>9} {:>6}'.format(
+        'band', 'drip_volume', 'interval_min', 'repeats', 'in_band', 'worst', 'error',
+        'ml', 'pumps'))
+    for row in table[:args.top]:
+        print('{band:>6} {drip_volume:>11} {interval_min:>12} {repeats:>7} {in_band:>8.3f} '
+              '{worst_in_band:>6.3f} {mean_error:>9.3f} {reagent_ml:>9.2f} {actuations:>6.0f}'.format(
+                  **row))
+    print('written to', args.out)
+
+
+if __name__ == '__main__':
+    main()
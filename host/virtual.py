@@ -0,0 +1,222 @@
+'''Virtual time and pretend hardware for running PH_Monitor on a PC.
+
+install() gives the time module MicroPython's ticks_ms(), ticks_diff() and
+friends, driven by a Clock that only moves when the code sleeps. A day of
+the loop runs in a second or two, and the same inputs always give the same
+run. Anything that changes with time, like the bath, listens to the clock.
+
+The hardware classes are just enough of the pyb ones for PH_Monitor:
+AnalogueIn for an ADC, PumpPin for a pump on a GPIO, DosePump for a PwmPump,
+and stand ins for the timer, DHT22, LCD and power manager. FastForward is
+passed as the power manager so that idle time is skipped rather than slept
+through.
+'''
+
+import os
+import sys
+import time
+
+TICKS_PERIOD = 1 << 30 # ticks_ms() and ticks_us() wrap at this on the pyboard
+
+
+class Finished(Exception):
+    '''Raised by the clock when the run is over'''
+
+
+def ticks_diff(a, b):
+    return ((a - b + TICKS_PERIOD // 2) & (TICKS_PERIOD - 1)) - TICKS_PERIOD // 2
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & (TICKS_PERIOD - 1)
+
+
+class Clock:
+    def __init__(self, end=None):
+        self.ms = 0.0 # since the start of the run
+        self.end = end # (ms) Finished is raised once the clock gets here
+        self.listeners = [] # called with the ms about to pass
+
+    def ticks_ms(self):
+        return int(self.ms) & (TICKS_PERIOD - 1)
+
+    def ticks_us(self):
+        return int(self.ms * 1000) & (TICKS_PERIOD - 1)
+
+    def advance(self, ms):
+        if ms <= 0:
+            return
+        for listener in self.listeners:
+            listener(ms)
+        self.ms += ms
+        if self.end is not None and self.ms >= self.end:
+            raise Finished()
+
+    def sleep_ms(self, ms):
+        self.advance(ms)
+
+    def sleep_us(self, us):
+        self.advance(us / 1000)
+
+    def sleep(self, s):
+        self.advance(s * 1000)
+
+
+def install(clock, root=None):
+    '''Point the time module's MicroPython functions at the clock. Also
+    puts root, this repository by default, on the path so pH_monitor etc
+    can be imported from it.'''
+    time.ticks_ms = clock.ticks_ms
+    time.ticks_us = clock.ticks_us
+    time.ticks_diff = ticks_diff
+    time.ticks_add = ticks_add
+    time.sleep_ms = clock.sleep_ms
+    time.sleep_us = clock.sleep_us
+    time.sleep = clock.sleep
+    if root is None:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    root = os.path.abspath(root)
+    if root in sys.path:
+        sys.path.remove(root)
+    sys.path.insert(0, root)
+
+
+class AnalogueIn:
+    '''An ADC pin, read() calls value() for the counts'''
+
+    def __init__(self, value):
+        self.value = value
+
+    def read(self):
+        return self.value()
+
+    def read_timed(self, buf, timer):
+        period = 1000000 // timer.freq()
+        for i in range(len(buf)):
+            buf[i] = self.read()
+            time.sleep_us(period)
+
+
+class Timer:
+    '''Enough of a pyb.Timer for ADC.read_timed'''
+
+    def __init__(self, freq=1000):
+        self._freq = freq
+
+    def init(self, freq):
+        self._freq = freq
+
+    def freq(self):
+        return self._freq
+
+
+class PumpPin:
+    '''A pump on a GPIO pin. Tells on_dose(ml) how much it pumped each time
+    it is turned off.'''
+
+    def __init__(self, clock, flow, on_dose=None):
+        self.clock = clock
+        self.flow = flow # (ml/ms)
+        self.on_dose = on_dose
+        self.on_since = None
+        self.actuations = 0
+        self.total_ml = 0.0
+        self.on_ms = 0.0
+
+    def high(self):
+        if self.on_since is None:
+            self.on_since = self.clock.ms
+            self.actuations += 1
+
+    def low(self):
+        if self.on_since is None:
+            return
+        ms = self.clock.ms - self.on_since
+        self.on_since = None
+        ml = ms * self.flow
+        self.on_ms += ms
+        self.total_ml += ml
+        if self.on_dose is not None:
+            self.on_dose(ml)
+
+    def value(self, value=None):
+        if value is None:
+            return int(self.on_since is not None)
+        self.high() if value else self.low()
+
+
+class DosePump(PumpPin):
+    '''A pump.PwmPump, dose() runs it for as long as the volume takes'''
+
+    def dose(self, ml):
+        self.high()
+        self.clock.advance(ml / self.flow)
+        self.low()
+
+
+class Dht:
+    def __init__(self, temperature=21.0, humidity=50.0):
+        self._temperature = temperature
+        self._humidity = humidity
+
+    def measure(self):
+        pass
+
+    def temperature(self):
+        return self._temperature
+
+    def humidity(self):
+        return self._humidity
+
+
+class Lcd:
+    '''Keeps what would be on the screen'''
+
+    def __init__(self, columns=16, lines=2):
+        self.rows = [' ' * columns for _ in range(lines)]
+        self.x = self.y = 0
+        self.backlight = True
+
+    def move_to(self, x, y):
+        self.x, self.y = x, y
+
+    def putstr(self, string):
+        row = self.rows[self.y]
+        self.rows[self.y] = (row[:self.x] + string + row[self.x + len(string):])[:len(row)]
+        self.x += len(string)
+
+    def putchar(self, char):
+        self.putstr(char)
+
+    def custom_char(self, location, charmap):
+        pass
+
+    def backlight_on(self):
+        self.backlight = True
+
+    def backlight_off(self):
+        self.backlight = False
+
+    def begin_frame(self, budget=50):
+        pass
+
+    def end_frame(self):
+        return True
+
+
+class FastForward:
+    '''Stands in for power.PowerManager, idle() moves the clock on instead
+    of waiting'''
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def activity(self):
+        pass
+
+    def idle(self, ms, stop=True):
+        self.clock.advance(max(ms, 1))
+        return 0
+
+    def duty_cycle(self):
+        return 1.0
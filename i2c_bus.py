@@ -0,0 +1,163 @@
+'''One I2C bus shared by several drivers.
+
+Sets the bus up at a known baud rate and gives each device on it counters
+for transactions, bytes, errors and time spent on the bus.
+
+There are two ways to talk to a device. write() and read() happen straight
+away and are retried, they are for anything the control loop is waiting on
+such as a sensor reading. submit() queues a write to be done later by
+service(), which the loop calls when it has time to spare. Queued writes go
+out in priority order, so slow traffic like the LCD never holds up a
+reading, and consecutive small writes to the same device are sent as one
+transaction. A queued write isn't retried, the done callback is told whether
+it made it and the driver decides what to do.
+'''
+
+import heapq
+import time
+from pyb import I2C
+
+HIGH = 0
+LOW = 1
+
+
+class DeviceStats:
+    def __init__(self, name):
+        self.name = name
+        self.transactions = 0
+        self.bytes = 0
+        self.errors = 0 # failed attempts
+        self.busy_us = 0 # time spent on the bus
+
+    def throughput(self):
+        '''bytes/s while on the bus'''
+        return self.bytes * 1000000 // self.busy_us if self.busy_us else 0
+
+
+class I2cBus:
+    BAUDRATE = 100000 # the LCD's PCF8574 is only rated to 100 kHz
+    TIMEOUT = 10 # (ms) for one transaction
+    RETRIES = 2 # extra attempts at a failed write() or read()
+    MAX_BATCH = 64 # (bytes) most queued writes sent as one transaction
+
+    def __init__(self, bus_id=1, baudrate=BAUDRATE):
+        self.bus_id = bus_id
+        self.baudrate = baudrate
+        self.i2c = I2C(bus_id, I2C.MASTER, baudrate=baudrate)
+        self.devices = {} # address: DeviceStats
+        self.queue = [] # heap of (priority, seq, address, data, done)
+        self.seq = 0
+        self.batch = bytearray(self.MAX_BATCH)
+        self.view = memoryview(self.batch)
+        self._dones = [] # callbacks for the batch being sent
+        self.passes_over = 0 # service() calls that ran out of time
+
+    def device(self, address, name=None):
+        '''Stats for a device, registering it with a name the first time'''
+        stats = self.devices.get(address)
+        if stats is None:
+            stats = DeviceStats(name or hex(address))
+            self.devices[address] = stats
+        return stats
+
+    def reset(self):
+        '''Re-initialise the peripheral, e.g. after a device held the bus'''
+        self.i2c.deinit()
+        self.i2c.init(I2C.MASTER, baudrate=self.baudrate)
+
+    def _transfer(self, address, data, nbytes=0, retries=0):
+        '''One transaction with the counters kept, returns what was read'''
+        stats = self.device(address)
+        for attempt in range(retries + 1):
+            start = time.ticks_us()
+            try:
+                if nbytes:
+                    data = self.i2c.recv(nbytes, address, timeout=self.TIMEOUT)
+                else:
+                    self.i2c.send(data, address, timeout=self.TIMEOUT)
+            except OSError:
+                stats.errors += 1
+                if attempt == retries:
+                    raise
+                continue
+            finally:
+                stats.busy_us += time.ticks_diff(time.ticks_us(), start)
+            stats.transactions += 1
+            stats.bytes += nbytes or (1 if isinstance(data, int) else len(data))
+            return data
+
+    def write(self, address, data, retries=RETRIES):
+        '''Send data (an int or a buffer) now. Raises OSError if it still
+        fails after the retries.'''
+        self._transfer(address, data, retries=retries)
+
+    def read(self, address, nbytes, retries=RETRIES):
+        '''Read nbytes now, raises OSError on failure'''
+        return self._transfer(address, None, nbytes, retries)
+
+    def submit(self, address, data, priority=LOW, done=None):
+        '''Queue a write for service(). done(ok) is called once it has been
+        tried.'''
+        self.seq += 1
+        heapq.heappush(self.queue, (priority, self.seq, address, data, done))
+
+    def cancel(self, address):
+        '''Drop everything queued for a device, without calling back'''
+        self.queue[:] = [job for job in self.queue if job[2] != address]
+        heapq.heapify(self.queue)
+
+    def pending(self):
+        return len(self.queue)
+
+    def service(self, budget=20):
+        '''Send queued writes for up to budget ms, highest priority first.
+        Returns the number still queued.'''
+        start = time.ticks_ms()
+        queue = self.queue
+        dones = self._dones
+        while queue:
+            if time.ticks_diff(time.ticks_ms(), start) >= budget:
+                self.passes_over += 1
+                break
+            priority, _, address, data, done = heapq.heappop(queue)
+            dones.append(done)
+            length = self._length(data)
+            if length <= self.MAX_BATCH:
+                # Gather following small writes to the same device into one send
+                self._put(0, data)
+                while (queue and queue[0][0] == priority and queue[0][2] == address and
+                       length + self._length(queue[0][3]) <= self.MAX_BATCH):
+                    job = heapq.heappop(queue)
+                    self._put(length, job[3])
+                    length += self._length(job[3])
+                    dones.append(job[4])
+                data = self.view[:length]
+            try:
+                self._transfer(address, data)
+                ok = True
+            except OSError:
+                ok = False
+            for callback in dones:
+                if callback is not None:
+                    callback(ok) # may cancel() or submit(), the queue is looked at again
+            del dones[:]
+        return len(queue)
+
+    def _length(self, data):
+        return 1 if isinstance(data, int) else len(data)
+
+    def _put(self, at, data):
+        if isinstance(data, int):
+            self.batch[at] = data
+        else:
+            self.batch[at:at + len(data)] = data
+
+    def summary(self):
+        '''The counters as one line of key=value pairs, per device by name'''
+        parts = []
+        for address, stats in sorted(self.devices.items()):
+            parts.append('{0}_sent={1:d} {0}_bytes={2:d} {0}_errors={3:d} {0}_bps={4:d}'.format(
+                stats.name, stats.transactions, stats.bytes, stats.errors,
+                stats.throughput()))
+        parts.append('queued={:d} over_budget={:d}'.format(len(self.queue), self.passes_over))
+        return ' '.join(parts)
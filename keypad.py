@@ -0,0 +1,123 @@
+'''Driver for a set of buttons on a resistor ladder, read through one ADC pin.
+
+Each button pulls the pin to a different voltage. The reading is looked up in a
+table of upper limits sorted from low to high, so adding a button is a case of
+adding a row to the table.
+
+Events are PRESS, LONG_PRESS (held for LONG_PRESS ms), REPEAT (every REPEAT ms
+after a long press) and RELEASE. Callbacks are registered per key and event
+with on(), and are called from poll() with the key as the only argument.
+'''
+
+import time
+
+try:
+    from bisect import bisect_left
+except ImportError: # not in the MicroPython firmware
+    def bisect_left(a, x):
+        lo, hi = 0, len(a)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if a[mid] < x:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+NO_KEY = 0
+
+PRESS = 0
+LONG_PRESS = 1
+REPEAT = 2
+RELEASE = 3
+
+
+class Keypad:
+    DEBOUNCE = 2 # (ms) time between the two reads which must agree
+    HYSTERESIS = 30 # ADC counts a held key's band is widened by
+    LONG_PRESS = 1500 # (ms)
+    REPEAT = 500 # (ms) 0 turns repeat off
+
+    def __init__(self, adc, table):
+        '''table is an iterable of (upper, key) pairs. A reading belongs to
+        the first row whose upper limit it doesn't exceed. Readings above the
+        last upper limit mean nothing is pressed. Keys must not be 0.'''
+        table = sorted(table)
+        self.adc = adc
+        self.uppers = [upper for upper, _ in table]
+        self.keys = [key for _, key in table]
+        self.callbacks = {key: [None, None, None, None] for key in self.keys}
+        self.key = NO_KEY
+        self._index = -1
+        self._pressed_at = 0
+        self._long = False
+        self._next_repeat = 0
+
+    def on(self, key, event, callback):
+        '''Call callback(key) when event happens to key'''
+        self.callbacks[key][event] = callback
+
+    def held_for(self):
+        '''ms the current key has been held for, 0 if nothing is pressed'''
+        if self.key == NO_KEY:
+            return 0
+        return time.ticks_diff(time.ticks_ms(), self._pressed_at)
+
+    def time_jump(self, ms):
+        '''ticks_ms stood still for ms (the board was stopped)'''
+        self._pressed_at = time.ticks_add(self._pressed_at, -ms)
+        self._next_repeat = time.ticks_add(self._next_repeat, -ms)
+
+    def was_long(self):
+        '''True if the key held, or just let go, was held past LONG_PRESS.
+        For RELEASE callbacks that shouldn't act after a long press.'''
+        return self._long
+
+    def _lookup(self, value):
+        '''Return the table index for an ADC reading, -1 for no key'''
+        index = self._index
+        if index >= 0:
+            # Stick with the held key unless the reading is well outside it
+            lower = self.uppers[index - 1] if index else -self.HYSTERESIS
+            if lower - self.HYSTERESIS < value <= self.uppers[index] + self.HYSTERESIS:
+                return index
+        index = bisect_left(self.uppers, value)
+        if index == len(self.uppers):
+            return -1
+        return index
+
+    def decode(self, value):
+        '''Return the key for an ADC reading'''
+        index = self._lookup(value)
+        return self.keys[index] if index >= 0 else NO_KEY
+
+    def _fire(self, key, event):
+        callback = self.callbacks[key][event]
+        if callback is not None:
+            callback(key)
+
+    def poll(self):
+        '''Read the pin and fire any events. Doesn't wait for release.'''
+        index = self._lookup(self.adc.read())
+        if index != self._index:
+            time.sleep_ms(self.DEBOUNCE)
+            if self._lookup(self.adc.read()) != index:
+                return # still bouncing, catch it next time
+            if self.key != NO_KEY:
+                self._fire(self.key, RELEASE)
+            self._index = index
+            self.key = self.keys[index] if index >= 0 else NO_KEY
+            if self.key != NO_KEY:
+                self._pressed_at = time.ticks_ms()
+                self._long = False
+                self._fire(self.key, PRESS)
+        elif self.key != NO_KEY:
+            now = time.ticks_ms()
+            if not self._long:
+                if time.ticks_diff(now, self._pressed_at) >= self.LONG_PRESS:
+                    self._long = True
+                    self._next_repeat = time.ticks_add(now, self.REPEAT)
+                    self._fire(self.key, LONG_PRESS)
+            elif self.REPEAT and time.ticks_diff(now, self._next_repeat) >= 0:
+                self._next_repeat = time.ticks_add(self._next_repeat, self.REPEAT)
+                self._fire(self.key, REPEAT)
@@ -1,29 +1,82 @@
+from pyb import Pin
+# After a reset the pump pins float until PwmPump sets them up, which is a
+# while yet, so hold them low first
+Pin('Y9', Pin.OUT_PP).low()
+Pin('Y10', Pin.OUT_PP).low()
+
+import os
 import time
-from pyb import Pin, I2C, ADC
+from pyb import ADC, Timer, USB_VCP
 import dht
+import onewire
+import ds18x20
 
 from pyb_i2c_lcd import I2cLcd
+from i2c_bus import I2cBus
 from pH_monitor import PH_Monitor
+from acquisition import PumpBlanking, SyncSampler, SequentialSampler
+from pump import PwmPump
+from power import PowerManager
+from history_store import HistoryStore
+from water_temp import WaterTemperature
+from watchdog import Watchdog
+from adc_trace import TraceRecorder, RecordingADC, RecordingWater, PH, BUTTONS
 
 LCD_ADDRESS = 0x27
 
-pump_1 = Pin('Y9', mode=Pin.OUT_PP)
-pump_2 = Pin('Y10', mode = Pin.OUT_PP)
+# Both pumps run off PWM on timer 2
+pump_timer = Timer(2, freq=1000)
+pump_1 = PwmPump(pump_timer, 3, Pin('Y9'))
+pump_2 = PwmPump(pump_timer, 4, Pin('Y10'))
 
 button_pin = ADC('X11')
 ph_pin = ADC('X7')
+# DS18B20 in the bath for temperature compensation, 4.7k pull up on X5
+water_temp = WaterTemperature(ds18x20.DS18X20(onewire.OneWire(Pin('X5'))))
+# Make a trace folder on the SD card to record every ADC read, for replaying
+# on a PC with host/replay.py. Up to about 20MB a day.
+if 'sd' in os.listdir('/') and 'trace' in os.listdir('/sd'):
+    trace = TraceRecorder(open('/sd/trace/{:d}.bin'.format(len(os.listdir('/sd/trace'))), 'wb'))
+    button_pin = RecordingADC(button_pin, trace, BUTTONS)
+    ph_pin = RecordingADC(ph_pin, trace, PH)
+    water_temp = RecordingWater(water_temp, trace) # the pH depends on it
+# Samples whole mains cycles until the reading is steady, clear of the pumps
+# switching
+ph_sampler = SequentialSampler(SyncSampler(ph_pin, Timer(6)), blanking=PumpBlanking())
 
 d_temp_humid = dht.DHT22(Pin('X6'))
 
 
-i2c = I2C(1, I2C.MASTER)
-lcd = I2cLcd(i2c, LCD_ADDRESS, 2, 16)
+# Anything else on the bus should go through i2c_bus too, so the LCD's
+# queued writes can't get in its way
+i2c_bus = I2cBus(1)
+lcd = I2cLcd(i2c_bus, LCD_ADDRESS, 2, 16)
+
+usb = USB_VCP()
+# The history wants an SD card, the internal flash is too small for a year.
+# Without one, or if the card is full, the unit runs without a history.
+history = None
+if 'sd' in os.listdir('/'):
+    try:
+        history = HistoryStore('/sd')
+    except OSError:
+        pass
+power = PowerManager(lcd, Pin('X11'), usb)
+# Reports a watchdog reset from last time, then starts when the loop does
+watchdog = Watchdog(PH_Monitor.PHASE_NAMES, PH_Monitor.PHASE_DEADLINES)
 
 ph_monitor = PH_Monitor(ph_pin,
                         button_pin,
                         pump_1,
                         pump_2,
                         d_temp_humid,
-                        lcd)
+                        lcd,
+                        ph_sampler,
+                        usb, # commands over the USB serial port
+                        power,
+                        history,
+                        i2c_bus,
+                        water_temp,
+                        watchdog)
 
 ph_monitor.loop()
@@ -0,0 +1,86 @@
+'''Keeps track of heap use in each phase of the main loop, and runs the garbage
+collector at times we choose rather than whenever the heap happens to fill up.
+
+A collection takes a few ms on the pyboard. If that lands while a pump is on or
+while the pH pin is being sampled the drip size or the reading gets skewed, so
+the loop calls idle_collect() when nothing time critical is going on.
+'''
+
+import gc
+from array import array
+
+
+def _mem_alloc():
+    try:
+        return gc.mem_alloc()
+    except AttributeError: # Not running on MicroPython
+        return 0
+
+
+def _mem_free():
+    try:
+        return gc.mem_free()
+    except AttributeError:
+        return 0
+
+
+class MemMonitor:
+    COLLECT_BYTES = 4096 # collect in the idle window once this much is allocated
+
+    def __init__(self, phases, collect_bytes=COLLECT_BYTES):
+        self.phases = phases # tuple of phase names, phases are referred to by index
+        self.collect_bytes = collect_bytes
+        n = len(phases)
+        # Preallocated so that the bookkeeping doesn't allocate itself
+        self.last = array('l', [0] * n)     # bytes allocated on the last pass
+        self.peak = array('l', [0] * n)     # most bytes allocated in one pass
+        self.total = array('l', [0] * n)    # bytes allocated over all passes
+        self.passes = array('l', [0] * n)
+        self.min_free = array('l', [-1] * n) # lowest gc.mem_free() seen
+        self.collections = 0
+        self._phase = -1
+        self._start = 0
+        self._collected_at = _mem_alloc()
+
+    def start(self, phase):
+        '''Start counting allocations for a phase'''
+        self._phase = phase
+        self._start = _mem_alloc()
+
+    def stop(self):
+        '''Record the allocations since start()'''
+        phase = self._phase
+        if phase < 0:
+            return
+        used = _mem_alloc() - self._start
+        if used < 0:
+            used = 0 # the gc ran mid phase, it shouldn't have but don't count it
+        self.last[phase] = used
+        if used > self.peak[phase]:
+            self.peak[phase] = used
+        self.total[phase] += used
+        self.passes[phase] += 1
+        free = _mem_free()
+        if self.min_free[phase] < 0 or free < self.min_free[phase]:
+            self.min_free[phase] = free
+        self._phase = -1
+
+    def idle_collect(self, force=False):
+        '''Call when nothing time critical is happening. Collects if enough
+        has been allocated since the last collection.'''
+        if force or _mem_alloc() - self._collected_at > self.collect_bytes:
+            gc.collect()
+            self.collections += 1
+            self._collected_at = _mem_alloc()
+
+    def summary(self):
+        '''The stats as one line of key=value pairs, bytes allocated on the
+        last pass, the most on one pass and the lowest free for each phase,
+        - for a phase that hasn't run yet'''
+        parts = []
+        for i, name in enumerate(self.phases):
+            free = self.min_free[i]
+            parts.append('{0}_last={1:d} {0}_peak={2:d} {0}_min_free={3}'.format(
+                name, self.last[i], self.peak[i], '-' if free < 0 else str(free)))
+        parts.append('collections={:d}'.format(self.collections))
+        return ' '.join(parts)
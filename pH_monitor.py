@@ -17,15 +17,26 @@ The button pin out is:
 #(1)##(2)#(5)#
 ########(4)###
 where:
-1. START:     Begin monitoring the process. The first adjustment won't be made
-              until frequency has elapsed.
-2. STOP:      Stop monitoring and adjusting the pH.
+1. START:     Begin monitoring the process. If the pH is out of band it is
+              titrated straight away: a few drips, 3 minutes to mix, measure,
+              repeat until the pH is in band. After that an adjustment is
+              made every 2 hours. Holding START for 1.5s swaps the status
+              screen for a graph of the pH over the last 4 hours, and back.
+2. STOP:      Stop monitoring and adjusting the pH. Holding STOP for 1.5s
+              locks out all dosing (the screen shows LOCKED), hold it again
+              to unlock.
 3. PRIME 1:   Run pump 1 to allow it to be primed with fluid.
 4. PRIME 2:   Run pump 2 to allow it to be primed with fluid.
-5. CALIBRATE: Calibrate the pH meter to a known value
+5. CALIBRATE: Calibrate the pH meter to a known value. It waits for the
+              reading to settle, up to 3 minutes, then shows CALIBRATED.
 
 Note that pressing multiple buttons at the same time is not supported and will
-default to the higher button number.
+default to the higher button number. START, STOP and CALIBRATE act when the
+button is let go, PRIME runs the pump for as long as the button is held, up to
+a minute. If a PRIME button is still held after a minute the pump is stopped
+and the screen shows PRIME TIMEOUT until it is let go. No dosing is done while priming
+or calibrating, or while the screen shows a fault, dosing picks up again
+afterwards.
 
 PUMP 1: Green/Red
 Place in the acidic reservoir to lower the pH when needed
@@ -67,15 +78,35 @@ notes:
     (corresponding to 20ms pulse of the pumps). This can be increased if needed,
     I haven't worked out how much you will need to dilute the solutions. At the
     moment I have it making a change every 2 hours.
+ -  If the program gets stuck the watchdog resets the board after 8 seconds,
+    with both pumps off. The screen shows WATCHDOG RESET and the part of the
+    loop it was stuck in, /flash/watchdog.log has the details.
+ -  If the pH reading follows doses much more slowly or less far than it
+    used to, dosing is slowed down, and after 3 in a row the screen shows
+    SLOW PROBE or WEAK RESPONSE until STOP is pressed.
 '''
 
 import time
+from array import array
 from collections import namedtuple
 
+import bath_model
+import keypad
+from acquisition import PinSource, ProbeError, PumpBlanking, SequentialSampler
+from commands import CommandInterface
+from dht_service import DhtService
+from export import CsvStream, SerialExport, csv_rows
+from mem_monitor import MemMonitor
+from probe_response import ProbeResponse
+from rolling_stats import RollingStats
+from trend import ReadingHistory, TrendGraph
+
 limits = namedtuple('limit', 'lower upper')
 
 class PH_Monitor:
     DRIP_TIME = 20 # (ms), time it takes to deliver one drip
+    DRIP_VOLUME = 0.05 # (ml)
+    DOSE_RESOLUTION = 0.1 # (drips) smallest dose step with PWM pumps
     ADJUSTMENT_INTERVAL = 1000 * 60 * 60 * 2# (ms) time between pH measurements
     SLEEP = 200 # (ms), time between checking for button presses
     DEBOUNCE = 2 # (ms) button debounce time
@@ -84,6 +115,31 @@ class PH_Monitor:
     PH_OFFSET = -7.7 # From measurements
     PH_TARGET = 5.8 # Hold bath at PH_TARGET
     PH_ERROR = 0.2 # allow the pH to move 0.2 around the target value
+    PH_TOLERANCE = 0.01 # stop sampling when the reading is this certain
+    CALIBRATION_TEMPERATURE = 25.0 # (C) water temperature PH_GRADIENT was measured at
+    MAX_DRIPS = 10 # most drips the bath model can ask for in one adjustment
+    REFRESH = 10000 # (ms) time between screen updates
+    MAX_PRIME = 60000 # (ms) longest a pump can be primed for, button or serial
+    FAST_REFRESH = 1000 # (ms) time between screen updates while priming or calibrating
+    MESSAGE_TIME = 2000 # (ms) a message stays on the screen at least this long
+    I2C_BUDGET = 20 # (ms) per pass for queued i2c writes, e.g. the LCD
+    MAX_IDLE = 2000 # (ms) longest the power manager is allowed to idle for
+    TREND_PERIOD = 1000 * 60 * 15 # (ms) each column of the trend graph
+    TREND_COLUMNS = 16
+    TREND_MIN_SPAN = 0.1 # (pH) the graph is never scaled tighter than this
+
+    # Titration, after START dose -> mix -> measure until the pH is in band
+    MIXING_DELAY = 1000 * 60 * 3 # (ms) time for a dose to mix in before measuring
+    TITRATION_MAX_DRIPS = 5 # most drips in one titration cycle
+    # While the probe responds badly to doses, wait this many times as long
+    # between them and give at most 1/this of the drips
+    DEGRADED_SLOWDOWN = 2
+
+    # Calibration, readings of the buffer until they stop moving
+    CALIBRATION_INTERVAL = 2000 # (ms) between readings
+    CALIBRATION_READINGS = 5 # readings in a row that have to agree
+    CALIBRATION_SPREAD = 0.02 # (pH) how closely they have to agree
+    CALIBRATION_TIMEOUT = 1000 * 60 * 3 # (ms) give up if it hasn't settled by then
 
     # These values are the analogue reads of the button pin
     BUTTON_THRESHOLD = 2000
@@ -92,44 +148,298 @@ class PH_Monitor:
     BUTTON_3 = limits(250, 500)                 # Button 3 ~ 370
     BUTTON_4 = limits(80, 250)                  # Button 4 ~ 140
     BUTTON_5 = limits(0, 80)                    # Button 5 ~ 0
-    
+
+    START = 1
+    STOP = 2
+    PRIME_1 = 3
+    PRIME_2 = 4
+    CALIBRATE = 5
+    # (upper, key) lookup table for the Keypad
+    BUTTONS = ((BUTTON_1.upper, START),
+               (BUTTON_2.upper, STOP),
+               (BUTTON_3.upper, PRIME_1),
+               (BUTTON_4.upper, PRIME_2),
+               (BUTTON_5.upper, CALIBRATE))
+
+    # Screens shown while running, long press START to swap
+    PAGE_STATUS = 0
+    PAGE_TREND = 1
+
+    # Loop phases, used to index the memory stats and for the watchdog
+    PHASE_BUTTONS = 0
+    PHASE_DISPLAY = 1
+    PHASE_ADJUST = 2
+    PHASE_IDLE = 3
+    PHASE_NAMES = ('buttons', 'display', 'adjust', 'idle')
+    # (ms) longest each phase can take before the watchdog resets the board.
+    # Reading the pH, dosing or writing the history to the card all happen
+    # inside one. They have to add up to less than the watchdog's TIMEOUT,
+    # or a pass with nothing late could still time it out.
+    PHASE_DEADLINES = (1000, 1500, 1500, MAX_IDLE + 500)
+
+    # Modes, moved between by events through TRANSITIONS. Each mode has a
+    # tick_ method which gets a slice of every pass of the loop.
+    IDLE = 0
+    RUNNING = 1
+    PRIMING = 2
+    CALIBRATING = 3
+    FAULT = 4
+    MODE_NAMES = ('IDLE', 'RUNNING', 'PRIMING', 'CALIBRATING', 'FAULT')
+    RESUME = -1 # back to IDLE or RUNNING, whichever it was in before
+
+    EV_START = 0
+    EV_STOP = 1
+    EV_PRIME = 2
+    EV_CALIBRATE = 3
+    EV_DONE = 4 # priming or calibration finished
+    EV_FAULT = 5
+    EV_CLEAR = 6 # the fault has gone
+
+    # (mode, event): new mode. Events not in here are refused.
+    TRANSITIONS = {(IDLE, EV_START): RUNNING,
+                   (IDLE, EV_PRIME): PRIMING,
+                   (IDLE, EV_CALIBRATE): CALIBRATING,
+                   (RUNNING, EV_STOP): IDLE,
+                   (RUNNING, EV_PRIME): PRIMING,
+                   (RUNNING, EV_CALIBRATE): CALIBRATING,
+                   (RUNNING, EV_FAULT): FAULT,
+                   (PRIMING, EV_PRIME): PRIMING, # the other pump, or the same one again
+                   (PRIMING, EV_DONE): RESUME,
+                   (PRIMING, EV_STOP): IDLE,
+                   (PRIMING, EV_FAULT): FAULT,
+                   (CALIBRATING, EV_DONE): RESUME,
+                   (CALIBRATING, EV_STOP): IDLE,
+                   (FAULT, EV_CLEAR): RESUME,
+                   (FAULT, EV_STOP): IDLE}
+    FAULT_HINTS = {'PROBE FAULT': 'CHECK PH PROBE',
+                   'PRIME TIMEOUT': 'LET GO OF PRIME',
+                   'SLOW PROBE': 'CLEAN PH PROBE',
+                   'WEAK RESPONSE': 'CHECK PROBE+PUMP'}
+    # Faults from the probe's response to doses, these stay until STOP
+    RESPONSE_FAULTS = ('SLOW PROBE', 'WEAK RESPONSE')
+
+    STATUS_ROW_0 = u'{:.1f}\xdfC   {:d}%'
+    STATUS_ROW_0_NO_DHT = u'--.-\xdfC   --%'
+    STATUS_ROW_0_WATER = u'A{:.0f} {:d}% W{:.1f}\xdfC'
+    STATUS_ROW_0_WATER_NO_DHT = u'A-- --% W{:.1f}\xdfC'
+    STATUS_ROW_0_TREND = '{:+.2f}/h sd{:.2f}'
+    STATUS_ROW_1 = 'pH {:.1f}  {:02d}:{:02d}:{:02d}'
+    STATUS_ROW_1_LOCKED = 'pH {:.1f}  LOCKED'
+    TREND_ROW_0 = '{:.2f}-{:.2f} {:d}h'
+
+    # (name, number of values, ms each value covers) for the pH statistics
+    STATS_WINDOWS = (('hour', 60, 60 * 1000),
+                     ('day', 96, 15 * 60 * 1000))
+
     def __init__(self,
                  ph_pin, # ADC pin
                  button_pin, # ADC pin
-                 pump_1, # GPIO
-                 pump_2, # GPIO
+                 pump_1, # GPIO or pump.PwmPump
+                 pump_2, # GPIO or pump.PwmPump
                  dht, # DHT22 class
-                 lcd): # I2cLcd class
+                 lcd, # I2cLcd class
+                 sampler=None, # acquisition sampler for the ph_pin
+                 serial=None, # stream for the command interface, e.g. USB_VCP
+                 power=None, # power.PowerManager
+                 history=None, # history_store.HistoryStore
+                 bus=None, # i2c_bus.I2cBus the lcd queues its writes on
+                 water=None, # water_temp.WaterTemperature
+                 watchdog=None): # watchdog.Watchdog, with PHASE_NAMES and PHASE_DEADLINES
 
         self.ph_pin = ph_pin
+        if sampler is None:
+            # Single reads 2ms apart, stopping once the mean is steady
+            sampler = SequentialSampler(PinSource(ph_pin),
+                                        tolerance=self.PH_TOLERANCE / self.PH_GRADIENT,
+                                        min_samples=50, max_samples=500,
+                                        blanking=PumpBlanking())
+        self.sampler = sampler
+        # Told about every pump edge, if the sampler keeps clear of them
+        self.blanking = getattr(sampler, 'blanking', None)
         self.button_pin = button_pin
         self.pump_1 = pump_1
         self.pump_2 = pump_2
         self.dht = dht # digital humidity and temperature
+        self.dht_service = DhtService(dht)
+        self.water = water
         self.lcd = lcd
+        self.mode = self.IDLE
+        self.resume_mode = self.IDLE
+        self.mode_since = time.ticks_ms()
+        self.mode_ticks = (self.tick_idle, self.tick_running, self.tick_priming,
+                           self.tick_calibrating, self.tick_fault)
+        self.fault = None # what went wrong, shown on the screen
+        self.next_fault_check = 0
+        self.titrating = False
+        self.titration_started = 0
+        self.titration_time = None # (ms) from START to the first in band reading
+        self.last_adjustment = None # ticks_ms
+        self.next_adjustment = time.ticks_ms()
+        self.dosing_locked = False # long press STOP to stop any dosing
+        self.keypad = keypad.Keypad(button_pin, self.BUTTONS)
+        self.keypad.DEBOUNCE = self.DEBOUNCE
+        self.keypad.on(self.START, keypad.RELEASE, self.on_start)
+        self.keypad.on(self.START, keypad.LONG_PRESS, self.on_page)
+        self.keypad.on(self.STOP, keypad.RELEASE, self.on_stop)
+        self.keypad.on(self.STOP, keypad.LONG_PRESS, self.on_lock)
+        self.keypad.on(self.PRIME_1, keypad.PRESS, self.on_prime)
+        self.keypad.on(self.PRIME_1, keypad.RELEASE, self.on_prime_release)
+        self.keypad.on(self.PRIME_2, keypad.PRESS, self.on_prime)
+        self.keypad.on(self.PRIME_2, keypad.RELEASE, self.on_prime_release)
+        self.keypad.on(self.CALIBRATE, keypad.RELEASE, self.on_calibrate)
+        self.pumps = (pump_1, pump_2) # indexed by bath_model.PUMP_1/PUMP_2
+        self.bath = bath_model.BathModel()
+        # Pins can only do whole drips
+        if hasattr(pump_1, 'dose') and hasattr(pump_2, 'dose'):
+            self.dose_resolution = self.DOSE_RESOLUTION
+        else:
+            self.dose_resolution = 1
+        self.ph = None # last pH reading
+        self.probe_fault = False
+        self.response = ProbeResponse() # how the probe follows each dose
+        self.ph_stats = {name: RollingStats(size, period)
+                         for name, size, period in self.STATS_WINDOWS}
+        self.refreshes = 0
+        self.mem = MemMonitor(('buttons', 'display', 'adjust'))
+        self.lcd_rows = [None, None] # what is currently on each row
+        self.screen_lost = 0 # lcd.screen_lost when the rows were last known good
+        self.page = self.PAGE_STATUS
+        self.trend = ReadingHistory(self.TREND_COLUMNS, self.TREND_PERIOD)
+        self.trend_graph = TrendGraph(lcd, 1, self.TREND_COLUMNS)
+        self.power = power
+        self.history = history
+        self.bus = bus
+        self.watchdog = watchdog
+        self.unlogged_doses = [0, 0] # drips given since the last history sample
+        self.total_drips = [0, 0] # since power up, for telemetry
+        self.next_refresh = time.ticks_ms()
+        self.commands_run = 0
+        self.priming = None # pump being primed
+        self.prime_key = None # PRIME button holding it on, None if over serial
+        self.prime_until = 0
+        self.calibration = 6.86 # pH of the buffer being calibrated against
+        self.calibration_readings = array('f', [0.0] * self.CALIBRATION_READINGS)
+        self.calibration_count = 0
+        self.next_calibration_reading = 0
+        self.calibration_reply = False
+        self.export = None # SerialExport in progress
+        self.commands = None
+        if serial is not None:
+            self.commands = CommandInterface(serial)
+            self.commands.on('start', self.cmd_start)
+            self.commands.on('stop', self.cmd_stop)
+            self.commands.on('target', self.cmd_target)
+            self.commands.on('band', self.cmd_band)
+            self.commands.on('interval', self.cmd_interval)
+            self.commands.on('cal', self.cmd_calibrate)
+            self.commands.on('prime', self.cmd_prime)
+            self.commands.on('status', self.cmd_status)
+            self.commands.on('mem', self.cmd_mem)
+            self.commands.on('i2c', self.cmd_i2c)
+            if history is not None:
+                self.commands.on('export', self.cmd_export)
 
-    def drip(self, pump):
-        '''Turn a pump on for a specific amount of time'''
+    def drip(self, pump, drips=1):
+        '''Turn a pump on for long enough to give a number of drips. PWM
+        pumps are given the volume and can do fractions of a drip.'''
+        if hasattr(pump, 'dose'):
+            self.pump_edge(pump, True)
+            pump.dose(drips * self.DRIP_VOLUME)
+            self.pump_edge(pump, False)
+            return
         pump.high()
-        time.sleep_ms(self.DRIP_TIME)
+        self.pump_edge(pump, True)
+        time.sleep_ms(self.DRIP_TIME * drips)
         pump.low()
+        self.pump_edge(pump, False)
+
+    def pump_edge(self, pump, on):
+        '''A pump has just been switched on or off, the pH samples keep
+        clear of it for a while'''
+        if self.blanking is not None:
+            self.blanking.edge(0 if pump is self.pump_1 else 1, on)
+
+    def adjust(self, pH, now):
+        '''Learn from the reading, then dose whatever the bath model says is
+        needed to get to the target, and schedule the next adjustment.
+        While titrating the cycle is short and the dose is capped, once the
+        pH is in band it switches to normal regulation. Returns (pump, drips).'''
+        if self.titrating and abs(pH - self.PH_TARGET) <= self.PH_ERROR:
+            self.titrating = False
+            self.titration_time = time.ticks_diff(now, self.titration_started)
+        if self.titrating:
+            interval, max_drips = self.MIXING_DELAY, self.TITRATION_MAX_DRIPS
+        else:
+            interval, max_drips = self.ADJUSTMENT_INTERVAL, self.MAX_DRIPS
+        if self.response.degraded():
+            # Give a sluggish probe time to catch up, so it isn't overdosed
+            interval *= self.DEGRADED_SLOWDOWN
+            max_drips = max(1, max_drips // self.DEGRADED_SLOWDOWN)
+        if self.last_adjustment is None:
+            elapsed = interval
+        else:
+            elapsed = time.ticks_diff(now, self.last_adjustment)
+        self.last_adjustment = now
+        self.next_adjustment = time.ticks_add(now, interval)
+
+        self.bath.observe(pH, elapsed / 3600000)
+        pump, drips = self.bath.plan(pH, self.PH_TARGET, self.PH_ERROR,
+                                     interval / 3600000, max_drips,
+                                     self.dose_resolution)
+        if drips:
+            self.drip(self.pumps[pump], drips)
+            self.bath.dosed(pump, drips)
+            self.response.dosed(pump, drips, pH, time.ticks_ms())
+            self.unlogged_doses[pump] += drips
+            self.total_drips[pump] += drips
+        return pump, drips
 
     def read_dht(self):
-        '''Return (temperature, humidity) tuple'''
-        self.dht.measure()
-        return self.dht.temperature(), self.dht.humidity()
+        '''Return the last good (temperature, humidity) tuple, the DHT is
+        measured by dht_service.poll() in the loop. (None, None) until the
+        first good measurement, or once it has been failing for too long.'''
+        return self.dht_service.read()
 
-    def calibrate_ph_meter(self, calibration=6.86):
-        '''Record the analogue read value for a known pH'''
-        measured_pH = self.read_ph_meter()
-        print('Error = ', calibration - measured_pH)
-        self.PH_OFFSET += calibration - measured_pH
+    def read_water_temperature(self):
+        '''Last good water temperature, None without a probe or before the
+        first reading'''
+        if self.water is None:
+            return None
+        return self.water.read()
+
+    def calibrate_ph_meter(self, calibration=6.86, value=None):
+        '''Record the analogue read value for a known pH. value is the
+        reading of the buffer, it's read now if not given. Only the offset
+        is corrected, the gradient stays at CALIBRATION_TEMPERATURE.
+        Returns how far out the reading was (pH).'''
+        if value is None:
+            value = self.sampler.read() # a ProbeError is left to the caller
+        measured_pH = self.analogue_to_ph(value)
+        error = calibration - measured_pH
+        water = self.read_water_temperature()
+        if water is not None:
+            # The offset goes in before the slope correction, so undo it
+            self.PH_OFFSET += error * (water + 273.15) / (self.CALIBRATION_TEMPERATURE + 273.15)
+        else:
+            self.PH_OFFSET += error
+        return error
 
     def analogue_to_ph(self, value):
-        return (value * self.PH_GRADIENT) + self.PH_OFFSET
+        '''Convert an analogue read value to pH. With a water temperature the
+        slope is corrected (Nernst, proportional to absolute temperature)
+        around pH 7, where the electrode reads the same at any temperature.'''
+        pH = (value * self.PH_GRADIENT) + self.PH_OFFSET
+        water = self.read_water_temperature()
+        if water is None:
+            return pH
+        return 7 + (pH - 7) * (self.CALIBRATION_TEMPERATURE + 273.15) / (water + 273.15)
 
-    def read_ph_meter(self, repeats=500):
-        '''Average the analogue read value over N repeats'''
+    def read_ph_meter(self, repeats=None):
+        '''Read the pH with the sampler, which raises ProbeError if the probe
+        is disconnected or saturated. If repeats is given just average the
+        analogue read value over N repeats.'''
+        if repeats is None:
+            return self.analogue_to_ph(self.sampler.read())
         total = 0
         for _ in range(repeats):
             total += self.ph_pin.read()
@@ -138,81 +448,578 @@ class PH_Monitor:
 
         return self.analogue_to_ph(value)
 
+    def read_probe(self):
+        '''Read the pH while running and keep it for the statistics. Returns
+        None if the probe is faulty.'''
+        try:
+            pH = self.read_ph_meter()
+        except ProbeError:
+            self.probe_fault = True
+            return None
+        self.probe_fault = False
+        self.record_ph(pH)
+        return pH
+
+    def record_ph(self, pH):
+        '''Keep a pH reading taken while running for the statistics and the
+        history'''
+        self.ph = pH
+        for stats in self.ph_stats.values():
+            stats.update(pH)
+        self.trend.add(pH)
+        self.response.reading(pH, time.ticks_ms())
+        if self.response.failed():
+            self.set_fault(self.response.problem)
+        if self.history is not None:
+            temperature, humidity = self.read_dht()
+            self.history.add(time.time(), pH, temperature, humidity,
+                             self.unlogged_doses[0], self.unlogged_doses[1],
+                             self.read_water_temperature())
+            self.unlogged_doses[0] = self.unlogged_doses[1] = 0
+
+    def status(self):
+        '''Return a dict of the current state, for telemetry'''
+        temperature, humidity = self.read_dht()
+        dht_age = self.dht_service.age()
+        status = {'mode': self.MODE_NAMES[self.mode],
+                  'running': self.running,
+                  'locked': self.dosing_locked,
+                  'titrating': self.titrating,
+                  'titration_time': self.titration_time,
+                  'ph': self.ph,
+                  'probe_fault': self.probe_fault,
+                  'temperature': temperature,
+                  'humidity': humidity,
+                  'dht_age': None if dht_age is None else dht_age // 1000, # (s)
+                  'water_temperature': self.read_water_temperature(),
+                  'drips_1': self.total_drips[0],
+                  'drips_2': self.total_drips[1],
+                  't63': None if self.response.t63 is None else self.response.t63 / 1000,
+                  'strikes': self.response.strikes,
+                  'blanked': self.blanking.rejected if self.blanking else 0,
+                  'awake': self.power.duty_cycle() if self.power else 1.0}
+        for name, stats in self.ph_stats.items():
+            status[name] = (stats.mean(), stats.std(), stats.min(),
+                            stats.max(), stats.slope())
+        return status
+
+    def status_line(self):
+        '''status() as one line of key=value pairs, - for unknown values'''
+        status = self.status()
+        parts = ['STATUS', 'mode=' + status['mode']]
+        for key in ('running', 'locked', 'titrating', 'probe_fault', 'strikes',
+                    'blanked'):
+            parts.append('{}={}'.format(key, int(status[key])))
+        for key in ('ph', 'temperature', 'humidity', 'water_temperature', 'drips_1', 'drips_2',
+                    't63'):
+            value = status[key]
+            parts.append(key + '=' + ('-' if value is None else '{:.2f}'.format(value)))
+        dht_age = status['dht_age']
+        parts.append('dht_age=' + ('-' if dht_age is None else '{:d}'.format(dht_age)))
+        next_adjustment = time.ticks_diff(self.next_adjustment, time.ticks_ms()) // 1000
+        parts.append('next={:d}'.format(max(0, next_adjustment) if self.running else -1))
+        for name, _, _ in self.STATS_WINDOWS:
+            for field, value in zip(('mean', 'sd', 'min', 'max', 'slope'), status[name]):
+                parts.append('{}_{}={}'.format(
+                    name, field, '-' if value is None else '{:.3f}'.format(value)))
+        return ' '.join(parts)
+
     def lcd_write(self, string, row=0):
         '''Print the string on the row. Everything gets centred for ease'''
+        if string == self.lcd_rows[row]:
+            return # already showing, save the formatting and the i2c traffic
+        self.lcd_rows[row] = string
+        self.lcd.begin_frame()
         self.lcd.move_to(0, row)
         self.lcd.putstr('{:^16}'.format(string))
+        if not self.lcd.end_frame():
+            self.lcd_rows = [None, None] # not sure what's showing, redraw it all next time
 
-    def ms_to_hhmmss(self, ms):
+    def check_screen(self, now):
+        '''If the LCD has lost what was on it, e.g. a queued write failed
+        after lcd_write() had finished, or it was re-initialised from
+        bus.service(), forget what is on each row and redraw now'''
+        lost = getattr(self.lcd, 'screen_lost', 0)
+        if lost == self.screen_lost:
+            return
+        self.screen_lost = lost
+        self.lcd_rows = [None, None]
+        self.trend_graph.invalidate()
+        self.next_refresh = now
+
+    def draw_trend(self):
+        '''The trend page, the range on the top row and the graph under it'''
+        trend = self.trend
+        low, high = trend.range()
+        if high - low < self.TREND_MIN_SPAN:
+            middle = (low + high) / 2
+            low, high = middle - self.TREND_MIN_SPAN / 2, middle + self.TREND_MIN_SPAN / 2
+        hours = self.TREND_COLUMNS * self.TREND_PERIOD // 3600000
+        self.lcd_write(self.TREND_ROW_0.format(low, high, hours))
+        if self.lcd_rows[1] is not self.trend_graph:
+            self.trend_graph.invalidate() # something else was written over it
+            self.lcd_rows[1] = self.trend_graph
+        if not self.trend_graph.draw(trend, low, high):
+            self.lcd_rows = [None, None]
+
+    def split_hhmmss(self, ms):
         ms //=1000 # seconds
         hh, ms = divmod(ms, 3600)
         mm, ss = divmod(ms, 60)
-        return '{:02d}:{:02d}:{:02d}'.format(hh, mm, ss)
+        return hh, mm, ss
+
+    def ms_to_hhmmss(self, ms):
+        return '{:02d}:{:02d}:{:02d}'.format(*self.split_hhmmss(ms))
+
+    def pump_for_key(self, key):
+        return self.pump_1 if key == self.PRIME_1 else self.pump_2
+
+    # Modes
+
+    @property
+    def running(self):
+        '''START has been given and not STOPped, even if priming, calibrating
+        or in a fault at the moment'''
+        return (self.mode == self.RUNNING or
+                (self.mode != self.IDLE and self.resume_mode == self.RUNNING))
+
+    def event(self, event):
+        '''Move to the mode TRANSITIONS gives for the event. Returns False,
+        and stays put, if the event isn't allowed in the current mode.'''
+        mode = self.TRANSITIONS.get((self.mode, event))
+        if mode is None:
+            return False
+        if mode == self.RESUME:
+            mode = self.resume_mode
+        if self.mode == self.CALIBRATING and event != self.EV_DONE:
+            self.reply_calibration('STOPPED') # end_calibration() wasn't called
+        if self.mode == self.PRIMING:
+            self.priming.low()
+            self.pump_edge(self.priming, False)
+            self.priming = None
+        if self.mode in (self.IDLE, self.RUNNING):
+            self.resume_mode = self.mode
+        self.mode = mode
+        self.mode_since = time.ticks_ms()
+        self.next_refresh = self.mode_since # show the new mode straight away
+        return True
+
+    def start(self):
+        '''Start regulating. Returns False if that isn't allowed right now.'''
+        if self.mode == self.RUNNING:
+            return True
+        if not self.event(self.EV_START):
+            return False
+        self.bath.restart() # the bath may have changed while stopped
+        self.response.reset() # the probe may have been cleaned
+        self.last_adjustment = None
+        # Titrate to the target straight away
+        self.titrating = True
+        self.titration_started = time.ticks_ms()
+        self.next_adjustment = self.titration_started
+        return True
+
+    def stop(self):
+        '''Stop whatever is going on'''
+        self.event(self.EV_STOP)
+        if self.history is not None:
+            self.history.flush()
+
+    def prime(self, pump, ms, key=None):
+        '''Run a pump for up to ms, at most MAX_PRIME. key is the PRIME
+        button holding it on, None if it was asked for over serial. Returns
+        False if priming isn't allowed right now.'''
+        if not self.event(self.EV_PRIME):
+            return False
+        self.priming = pump
+        self.prime_key = key
+        self.prime_until = time.ticks_add(time.ticks_ms(), min(ms, self.MAX_PRIME))
+        pump.high()
+        self.pump_edge(pump, True)
+        return True
+
+    def calibrate(self, buffer=6.86, reply=False):
+        '''Start calibrating against a buffer of known pH. reply sends the
+        result over serial once done. Returns False if calibrating isn't
+        allowed right now.'''
+        if not self.event(self.EV_CALIBRATE):
+            return False
+        self.calibration = buffer
+        self.calibration_count = 0
+        self.calibration_reply = reply
+        self.next_calibration_reading = self.mode_since
+        return True
+
+    def set_fault(self, fault):
+        if self.event(self.EV_FAULT):
+            self.fault = fault
+            self.next_fault_check = time.ticks_add(time.ticks_ms(), self.REFRESH)
+
+    def show_message(self, row_0, row_1=''):
+        '''Put a message on the screen and leave it there for MESSAGE_TIME'''
+        self.lcd_write(row_0)
+        self.lcd_write(row_1, 1)
+        self.next_refresh = time.ticks_add(time.ticks_ms(), self.MESSAGE_TIME)
+
+    def end_calibration(self, result):
+        self.event(self.EV_DONE)
+        self.show_message(result, 'OFFSET {:.2f}'.format(self.PH_OFFSET))
+        self.reply_calibration(result)
+
+    def reply_calibration(self, result):
+        '''Send the CAL line a serial cal is waiting for, once'''
+        if self.calibration_reply and self.commands is not None:
+            self.commands.reply('CAL {} offset={:.3f}'.format(result, self.PH_OFFSET))
+        self.calibration_reply = False
+
+    # What each mode does with its slice of a pass of the loop
+
+    def tick_idle(self, now):
+        pass
+
+    def tick_running(self, now):
+        if time.ticks_diff(now, self.next_adjustment) < 0:
+            return
+        if self.dosing_locked:
+            self.next_adjustment = time.ticks_add(now, self.ADJUSTMENT_INTERVAL)
+            return
+        # Collect now so the gc can't kick in during the reading or drip
+        self.mem.idle_collect(force=True)
+        self.mem.start(self.PHASE_ADJUST)
+        pH = self.read_probe()
+        if pH is None: # don't dose on a bad reading
+            self.set_fault('PROBE FAULT')
+        elif self.mode == self.RUNNING: # the reading can show up a fault too
+            self.adjust(pH, time.ticks_ms())
+        self.mem.stop()
+
+    def tick_priming(self, now):
+        if time.ticks_diff(now, self.prime_until) < 0:
+            return
+        if self.prime_key is not None and self.keypad.key == self.prime_key:
+            self.set_fault('PRIME TIMEOUT') # stuck button, or the ladder is reading wrong
+        else:
+            self.event(self.EV_DONE)
+
+    def tick_calibrating(self, now):
+        if time.ticks_diff(now, self.next_calibration_reading) < 0:
+            return
+        self.next_calibration_reading = time.ticks_add(now, self.CALIBRATION_INTERVAL)
+        if time.ticks_diff(now, self.mode_since) > self.CALIBRATION_TIMEOUT:
+            self.end_calibration('NOT SETTLED')
+            return
+        try:
+            value = self.sampler.read()
+        except ProbeError:
+            self.end_calibration('PROBE FAULT')
+            return
+        readings = self.calibration_readings
+        readings[self.calibration_count % len(readings)] = value
+        self.calibration_count += 1
+        if self.calibration_count < len(readings):
+            return
+        if (max(readings) - min(readings)) * self.PH_GRADIENT > self.CALIBRATION_SPREAD:
+            return # still settling
+        self.calibrate_ph_meter(self.calibration, sum(readings) / len(readings))
+        self.response.reset()
+        self.end_calibration('CALIBRATED')
+
+    def tick_fault(self, now):
+        if self.fault == 'PRIME TIMEOUT':
+            if self.keypad.key == keypad.NO_KEY:
+                self.event(self.EV_CLEAR) # they've let go
+            return
+        if time.ticks_diff(now, self.next_fault_check) < 0:
+            return
+        self.next_fault_check = time.ticks_add(now, self.REFRESH)
+        if self.fault in self.RESPONSE_FAULTS:
+            return # a reading won't show it's fixed, STOP clears it
+        if self.read_probe() is not None:
+            self.event(self.EV_CLEAR)
+
+    # Button callbacks
+
+    def on_start(self, key):
+        if not self.keypad.was_long(): # let go after swapping the page
+            self.start()
+
+    def on_page(self, key):
+        '''Long press of START, swaps the status screen and the trend graph'''
+        self.page = self.PAGE_TREND if self.page == self.PAGE_STATUS else self.PAGE_STATUS
+        self.next_refresh = time.ticks_ms()
+
+    def on_stop(self, key):
+        if not self.keypad.was_long(): # let go after locking or unlocking
+            self.stop()
+
+    def on_lock(self, key):
+        '''Long press of STOP, toggles the dosing lock out'''
+        self.dosing_locked = not self.dosing_locked
+        self.show_message('DOSING LOCKED' if self.dosing_locked else 'DOSING UNLOCKED')
+
+    def on_prime(self, key):
+        self.prime(self.pump_for_key(key), self.MAX_PRIME, key) # until let go, or MAX_PRIME
+
+    def on_prime_release(self, key):
+        if self.mode == self.PRIMING and self.prime_key == key:
+            self.event(self.EV_DONE)
+
+    def on_calibrate(self, key):
+        self.calibrate()
+
+    # Serial command handlers, args is a list of strings
+
+    def not_now(self):
+        return ValueError('not while ' + self.MODE_NAMES[self.mode])
+
+    def cmd_start(self, args):
+        if not self.start():
+            raise self.not_now()
+
+    def cmd_stop(self, args):
+        self.stop()
+
+    def cmd_target(self, args):
+        '''target <pH>'''
+        target = float(args[0])
+        if not 0 < target < 14:
+            raise ValueError('target out of range')
+        self.PH_TARGET = target
+
+    def cmd_band(self, args):
+        '''band <pH>, how far the pH can move either side of the target'''
+        band = float(args[0])
+        if not 0 < band < 7:
+            raise ValueError('band out of range')
+        self.PH_ERROR = band
+
+    def cmd_interval(self, args):
+        '''interval <minutes> between adjustments'''
+        interval = int(float(args[0]) * 60000)
+        if interval < self.MIXING_DELAY:
+            raise ValueError('interval shorter than the mixing delay')
+        self.ADJUSTMENT_INTERVAL = interval
+        if self.running and not self.titrating and self.last_adjustment is not None:
+            self.next_adjustment = time.ticks_add(self.last_adjustment, interval)
+
+    def cmd_calibrate(self, args):
+        '''cal [pH of the buffer], replies OK now and CAL <result> once the
+        reading has settled, or CAL STOPPED if it's stopped first'''
+        if not self.calibrate(float(args[0]) if args else 6.86, reply=True):
+            raise self.not_now()
+
+    def cmd_prime(self, args):
+        '''prime <1|2> <ms>, runs the pump while the loop carries on'''
+        pump = self.pumps[int(args[0]) - 1] if args[0] in ('1', '2') else None
+        if pump is None:
+            raise ValueError('pump must be 1 or 2')
+        if not self.prime(pump, int(args[1])):
+            raise self.not_now()
+
+    def cmd_status(self, args):
+        return self.status_line()
+
+    def cmd_mem(self, args):
+        '''mem, heap use of each phase of the loop'''
+        return 'MEM ' + self.mem.summary()
+
+    def cmd_i2c(self, args):
+        '''i2c, the bus counters for each device and how the LCD is coping'''
+        parts = ['I2C']
+        if self.bus is not None:
+            parts.append(self.bus.summary())
+        if hasattr(self.lcd, 'send_failures'):
+            lcd = self.lcd
+            parts.append('lcd_send_failures={:d} lcd_dropped={:d} lcd_overruns={:d} '
+                         'lcd_recoveries={:d} lcd_recovery_failures={:d} lcd_degraded={:d}'.format(
+                             lcd.send_failures, lcd.dropped, lcd.overruns, lcd.recoveries,
+                             lcd.recovery_failures, int(lcd.degraded)))
+        return ' '.join(parts)
+
+    def cmd_export(self, args):
+        '''export [minute|hour|day] [days], the history as CSV. The rows
+        follow the OK a chunk per pass of the loop, then a line of END.
+        Commands sent before the END get ERR busy, between rows.'''
+        if self.calibration_reply:
+            raise ValueError('not until the CAL reply') # it would land in the CSV
+        tier = args[0] if args else 'hour'
+        if tier not in self.history.names:
+            raise ValueError('no history called ' + tier)
+        start = 0
+        if len(args) > 1:
+            start = max(0, time.time() - int(float(args[1]) * 86400))
+        rows = csv_rows(self.history, tier, start)
+        self.export = SerialExport(self.commands.stream, CsvStream(rows))
+        self.commands.busy = True
+
+    def time_jump(self, ms):
+        '''ticks_ms stood still for ms while the board was stopped, bring
+        everything that is timed forward to match'''
+        for name in ('next_refresh', 'next_adjustment', 'titration_started', 'mode_since',
+                     'prime_until', 'next_calibration_reading', 'next_fault_check'):
+            setattr(self, name, time.ticks_add(getattr(self, name), -ms))
+        if self.last_adjustment is not None:
+            self.last_adjustment = time.ticks_add(self.last_adjustment, -ms)
+        self.keypad.time_jump(ms)
+        self.dht_service.time_jump(ms)
+        if self.water is not None:
+            self.water.time_jump(ms)
+        for stats in self.ph_stats.values():
+            stats.time_jump(ms)
+        self.trend.time_jump(ms)
+        self.response.time_jump(ms)
+        if hasattr(self.ph_pin, 'recorder'): # a RecordingADC, the trace has to keep time too
+            self.ph_pin.recorder.time_jump(ms)
+
+    def idle(self, now):
+        '''Wait until the next thing needs doing'''
+        if self.power is None:
+            time.sleep_ms(self.SLEEP)
+            return
+        if self.keypad.key != keypad.NO_KEY:
+            self.power.activity()
+        if self.commands is not None and self.commands.lines != self.commands_run:
+            self.commands_run = self.commands.lines
+            self.power.activity()
+        if self.export is not None or (self.bus is not None and self.bus.pending()):
+            wait = 0 # get the export or the queued i2c writes out
+        elif self.keypad.key != keypad.NO_KEY or self.mode == self.PRIMING:
+            wait = self.SLEEP # something is being held or timed
+        else:
+            wait = min(self.MAX_IDLE,
+                       time.ticks_diff(self.next_refresh, now),
+                       self.dht_service.due_in())
+            if self.water is not None:
+                wait = min(wait, self.water.due_in())
+            if self.mode == self.RUNNING:
+                wait = min(wait, time.ticks_diff(self.next_adjustment, now))
+            elif self.mode == self.CALIBRATING:
+                wait = min(wait, time.ticks_diff(self.next_calibration_reading, now))
+            elif self.mode == self.FAULT:
+                wait = min(wait, time.ticks_diff(self.next_fault_check, now))
+            if self.commands is not None and self.commands.connected():
+                wait = min(wait, self.SLEEP) # keep an eye on the serial port
+        # Stop mode would stop the PWM too, so not while a pump is running.
+        # Nor while a key is held, ticks_ms() would stand still under the
+        # keypad's long press timing, and the held key keeps the wake up
+        # pin from seeing another press.
+        stop = self.priming is None and self.keypad.key == keypad.NO_KEY
+        stopped = self.power.idle(max(0, wait), stop=stop)
+        if stopped:
+            self.time_jump(stopped)
+
+    def refresh(self, now):
+        '''Update the screen for the current mode'''
+        mode = self.mode
+        if mode in (self.PRIMING, self.CALIBRATING):
+            self.next_refresh = time.ticks_add(now, self.FAST_REFRESH)
+        else:
+            self.next_refresh = time.ticks_add(now, self.REFRESH)
+        if mode == self.IDLE:
+            self.lcd_write('HELLO')
+            self.lcd_write('NOT RUNNING', 1)
+        elif mode == self.PRIMING:
+            self.lcd_write('PRIMING {:d}'.format(1 if self.priming is self.pump_1 else 2))
+            left = max(0, time.ticks_diff(self.prime_until, now)) // 1000
+            self.lcd_write('STOPS IN {:d}s'.format(left), 1)
+        elif mode == self.CALIBRATING:
+            self.lcd_write('CALIBRATING')
+            count = self.calibration_count
+            if not count:
+                self.lcd_write('SETTLING', 1)
+            else:
+                n = len(self.calibration_readings)
+                value = self.calibration_readings[(count - 1) % n]
+                self.lcd_write('pH {:.2f}  {:d}/{:d}'.format(
+                    self.analogue_to_ph(value), min(count, n), n), 1)
+        elif mode == self.FAULT:
+            self.lcd_write(self.fault)
+            self.lcd_write(self.FAULT_HINTS.get(self.fault, ''), 1)
+        else:
+            temperature, humidity = self.read_dht()
+            water = self.read_water_temperature()
+            pH = self.read_probe()
+            if pH is None:
+                self.set_fault('PROBE FAULT') # shown on the next pass
+                return
+            if self.page == self.PAGE_TREND:
+                self.draw_trend()
+                return
+            self.refreshes += 1
+            hour = self.ph_stats['hour']
+            if self.refreshes & 1 and hour.count > 1:
+                # Every other refresh show how the pH is moving
+                self.lcd_write(self.STATUS_ROW_0_TREND.format(hour.slope(), hour.std()))
+            elif water is not None:
+                if temperature is None:
+                    self.lcd_write(self.STATUS_ROW_0_WATER_NO_DHT.format(water))
+                else:
+                    self.lcd_write(self.STATUS_ROW_0_WATER.format(
+                        temperature, int(humidity), water))
+            elif temperature is None:
+                self.lcd_write(self.STATUS_ROW_0_NO_DHT)
+            else:
+                self.lcd_write(self.STATUS_ROW_0.format(temperature, int(humidity)))
+            if self.dosing_locked:
+                self.lcd_write(self.STATUS_ROW_1_LOCKED.format(pH), 1)
+            else:
+                remaining = max(0, time.ticks_diff(self.next_adjustment, now))
+                hh, mm, ss = self.split_hhmmss(remaining)
+                self.lcd_write(self.STATUS_ROW_1.format(pH, hh, mm, ss), 1)
+
+    def enter_phase(self, phase):
+        if self.watchdog is not None:
+            self.watchdog.enter(phase)
 
     def loop(self):
-        '''Where everything happens'''
-        t = 0
-        running_flag = False
+        '''Where everything happens. Each pass sees to the buttons, the
+        serial port and the sensors, refreshes the screen when it is due,
+        then gives the current mode its slice. The watchdog is fed at the
+        start of each pass, if every phase of the last one was on time.'''
+        if self.watchdog is not None:
+            self.watchdog.start()
+            if self.watchdog.reset_phase is not None:
+                self.show_message('WATCHDOG RESET', self.watchdog.reset_phase.upper())
         while 1:
-            button = self.button_pin.read()
-            time.sleep_ms(self.DEBOUNCE)
-            if button > self.BUTTON_THRESHOLD:
-                pass # nothing pressed, crack on
-            else:
-                button = self.button_pin.read() # update val after debounce time
-                #START
-                if self.BUTTON_1.lower < button <= self.BUTTON_THRESHOLD:
-                    while self.BUTTON_1.lower < button <= self.BUTTON_THRESHOLD:
-                        button = self.button_pin.read()
-                    else:
-                        running_flag = True # Start making adjustments
-                #STOP
-                elif self.BUTTON_2.lower < button <= self.BUTTON_2.upper:
-                    while self.BUTTON_2.lower < button <= self.BUTTON_2.upper:
-                        button = self.button_pin.read()
-                    else:
-                        running_flag = False # Stop making adjustments
-                #PRIME PUMP 1
-                elif self.BUTTON_3.lower < button <= self.BUTTON_3.upper:
-                    while self.BUTTON_3.lower < button <= self.BUTTON_3.upper:
-                        self.pump_1.high()
-                        button = self.button_pin.read()
-                    else:
-                        self.pump_1.low()
-                #PRIME PUMP 2
-                elif self.BUTTON_4.lower < button <= self.BUTTON_4.upper:
-                    while self.BUTTON_4.lower < button <= self.BUTTON_4.upper:
-                        self.pump_2.high()
-                        button = self.button_pin.read()
-                    else:
-                        self.pump_2.low()
-                #CALIBRATE PH METER
-                elif button < self.BUTTON_5.upper:
-                    while button <= self.BUTTON_5.upper:
-                        button = self.button_pin.read()
-                    else:
-                        self.calibrate_ph_meter()
-                        self.lcd_write('CALIBRATED')
-                        time.sleep(1)
+            stalled = self.watchdog is not None and not self.watchdog.feed()
+            if stalled:
+                # A phase hung for a while, the board is about to be reset
+                self.pump_1.low()
+                self.pump_2.low()
+                self.pump_edge(self.pump_1, False)
+                self.pump_edge(self.pump_2, False)
+            self.enter_phase(self.PHASE_BUTTONS)
+            self.mem.start(self.PHASE_BUTTONS)
+            self.keypad.poll()
+            if self.commands is not None:
+                if self.export is None or self.export.between_rows():
+                    try:
+                        self.commands.poll()
+                    except ProbeError:
+                        self.commands.reply('ERR probe fault')
+                if self.export is not None and not self.export.poll():
+                    self.export = None
+                    self.commands.busy = False
+                    self.commands.reply('END')
+            self.dht_service.poll() # only measures when one is due
+            if self.water is not None:
+                self.water.poll() # starts or collects a conversion when due
+            self.mem.stop()
+            now = time.ticks_ms()
 
             #Update LED
-            if not t % 10000: # update the screen every 10 seconds
-                if not running_flag:
-                    self.lcd_write('HELLO')
-                    self.lcd_write('NOT RUNNING', 1)
-                else:
-                    temperature, humidity = self.read_dht()
-                    pH = self.read_ph_meter()
-                    self.lcd_write(u'{:.1f}\xdfC   {:d}%'.format(temperature, int(humidity)))
-                    self.lcd_write('pH {:.1f}  {}'.format(pH, self.ms_to_hhmmss(self.ADJUSTMENT_INTERVAL-t)),1)
-
-            if t > self.ADJUSTMENT_INTERVAL:
-                pH = self.read_ph_meter()
-                if pH > self.PH_TARGET + self.PH_ERROR: # Need to pump from the acidic reservoir
-                    self.drip(self.pump_1)
-                elif pH < self.PH_TARGET - self.PH_ERROR: # Need to pump from the basic reservoir
-                    self.drip(self.pump_2)
-                t = 0 # Reset the timer
-            t += self.SLEEP
-            time.sleep_ms(self.SLEEP)
+            self.enter_phase(self.PHASE_DISPLAY)
+            self.mem.start(self.PHASE_DISPLAY)
+            self.check_screen(now)
+            if time.ticks_diff(now, self.next_refresh) >= 0:
+                self.refresh(now)
+            if self.bus is not None:
+                self.bus.service(self.I2C_BUDGET)
+            self.mem.stop()
 
+            self.enter_phase(self.PHASE_ADJUST)
+            if not stalled: # no dosing in the seconds before the reset
+                self.mode_ticks[self.mode](time.ticks_ms())
+            self.enter_phase(self.PHASE_IDLE)
+            self.mem.idle_collect() # nothing is happening until the next pass
+            self.idle(time.ticks_ms())
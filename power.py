@@ -0,0 +1,113 @@
+'''Saves power between the things the loop has to do.
+
+idle() is called instead of time.sleep_ms() at the end of each pass of the
+loop. If the USB serial port isn't connected the board goes into stop mode
+until the RTC wakes it up, or a button press does, and waits too short to
+stop for are run with the clock turned down. With USB connected stop mode
+would drop the port and changing the clock can upset it, so the CPU just
+waits for interrupts as usual.
+
+ticks_ms() stands still in stop mode. The time actually spent stopped is
+measured with the RTC and returned by idle(), so the caller can bring its
+deadlines forward by that much. The backlight timeout is moved on by it
+here.
+
+The LCD backlight goes off after BACKLIGHT_TIMEOUT ms without activity() and
+comes back on with the next call to activity().
+'''
+
+import time
+import pyb
+
+
+class PowerManager:
+    BACKLIGHT_TIMEOUT = 1000 * 60 * 5 # (ms)
+    MIN_STOP = 50 # (ms) not worth stopping for less than this
+    IDLE_FREQ = 84000000 # (Hz) sysclk when idle, keeps the 48 MHz USB clock
+
+    def __init__(self, lcd, wake_pin=None, usb=None, idle_freq=IDLE_FREQ):
+        '''wake_pin is the button ADC pin, a falling edge on it wakes the
+        board from stop mode. Button 1 only pulls the pin down to ~1.2V which
+        may not count as low, that button is picked up at the next RTC wake
+        up instead. usb is a pyb.USB_VCP.'''
+        self.lcd = lcd
+        self.usb = usb
+        self.idle_freq = idle_freq
+        self.rtc = pyb.RTC()
+        self.wake_pin = wake_pin
+        self.extint = None
+        if wake_pin is not None:
+            self.extint = pyb.ExtInt(wake_pin, pyb.ExtInt.IRQ_FALLING,
+                                     pyb.Pin.PULL_NONE, self._wake)
+            self.extint.disable()
+            wake_pin.init(pyb.Pin.ANALOG) # ExtInt made it an input, put it back for the ADC
+        self.awake_ms = 0
+        self.asleep_ms = 0
+        self.stops = 0
+        self._awake_since = time.ticks_ms()
+        self._last_activity = time.ticks_ms()
+
+    def _wake(self, line):
+        pass # just here to wake the board
+
+    def activity(self):
+        '''Something happened a person would be looking at the screen for'''
+        self._last_activity = time.ticks_ms()
+        if not self.lcd.backlight:
+            self.lcd.backlight_on()
+
+    def _rtc_ms(self):
+        '''ms since midnight from the RTC, subseconds count down from 255'''
+        _, _, _, _, hh, mm, ss, sub = self.rtc.datetime()
+        return ((hh * 60 + mm) * 60 + ss) * 1000 + (255 - sub) * 1000 // 256
+
+    def _stop(self, ms):
+        '''Stop mode for up to ms, returns the ms actually spent stopped'''
+        start = self._rtc_ms()
+        self.rtc.wakeup(ms)
+        if self.extint is not None:
+            self.wake_pin.init(pyb.Pin.IN)
+            self.extint.enable()
+        pyb.stop()
+        if self.extint is not None:
+            self.extint.disable()
+            self.wake_pin.init(pyb.Pin.ANALOG)
+        self.rtc.wakeup(None)
+        self.stops += 1
+        return (self._rtc_ms() - start) % 86400000
+
+    def idle(self, ms, stop=True):
+        '''Wait for up to ms, as cheaply as possible. Returns the ms spent in
+        stop mode, which ticks_ms() doesn't include. stop=False keeps the
+        clocks running at full speed, e.g. while a pump is on PWM.'''
+        now = time.ticks_ms()
+        self.awake_ms += time.ticks_diff(now, self._awake_since)
+        if (self.lcd.backlight and
+                time.ticks_diff(now, self._last_activity) > self.BACKLIGHT_TIMEOUT):
+            self.lcd.backlight_off()
+
+        stopped = 0
+        # The clock is left alone with USB connected, and while a pump is on
+        # PWM, as Timer 2 runs off it
+        slow = stop and (self.usb is None or not self.usb.isconnected())
+        if slow and ms >= self.MIN_STOP:
+            stopped = self._stop(ms)
+            self.asleep_ms += stopped
+            # ticks_ms() stood still, so the time since the last activity didn't
+            self._last_activity = time.ticks_add(self._last_activity, -stopped)
+        elif ms > 0:
+            freq = pyb.freq()[0]
+            if slow and self.idle_freq and self.idle_freq < freq:
+                pyb.freq(self.idle_freq)
+                time.sleep_ms(ms)
+                pyb.freq(freq)
+            else:
+                time.sleep_ms(ms)
+            self.asleep_ms += ms
+        self._awake_since = time.ticks_ms()
+        return stopped
+
+    def duty_cycle(self):
+        '''Fraction of the time spent awake'''
+        total = self.awake_ms + self.asleep_ms
+        return self.awake_ms / total if total else 1.0
@@ -0,0 +1,150 @@
+'''Watches how quickly and how far the pH electrode follows each dose.
+
+A fouled or dying electrode is slow to follow a change in the bath, and
+shows less of it. Nothing extra is sampled for this, the readings the loop
+takes anyway while running are used. After a dose the readings over the
+next WINDOW ms are kept. The change is the mean of the last SETTLED of them
+less the reading the dose was worked out from. t63 is when the readings
+first got 63% of the way there, interpolated between readings. A dose
+less than ISOLATION after the one before is skipped, the earlier one will
+still be mixing in and would make it look bigger than it is.
+
+Each response is compared with a baseline: an exponentially weighted mean of
+the earlier good ones, of t63 and of the change per drip of each pump. A
+response much slower (SLOW) or smaller (WEAK) than the baseline is a
+strike and is left out of the baseline. Doses too small to see past the
+noise aren't judged at all. degraded() is True after a strike, failed()
+after STRIKES in a row, and problem says what was wrong with the last one.
+'''
+
+import time
+from array import array
+
+DIRECTION = (-1, 1) # sign of the change from each pump, acid then base
+
+
+class ProbeResponse:
+    WINDOW = 1000 * 60 * 10 # (ms) readings after a dose that make up its response
+    ISOLATION = 1000 * 60 * 20 # (ms) a dose this soon after another isn't used
+    MAX_READINGS = 80
+    MIN_READINGS = 6 # fewer than this in the window and the response isn't used
+    SETTLED = 3 # readings at the end of the window averaged for the final value
+    MIN_CHANGE = 0.05 # (pH) smaller changes are lost in the noise
+    LEARN = 3 # responses in the baseline before any are judged
+    ALPHA = 0.2 # weight of a new response in the baseline
+    SLOW = 1.5 # t63 this many times the baseline's is slow...
+    MIN_SLOWER = 30000 # (ms) ...as long as it is this much longer too
+    WEAK = 0.5 # a change per drip under this fraction of the baseline's is weak
+    STRIKES = 3 # bad responses in a row before failed()
+
+    def __init__(self):
+        self.values = array('f', [0.0] * self.MAX_READINGS)
+        self.times = array('l', [0] * self.MAX_READINGS) # ms after the dose
+        self.count = 0
+        self.active = False # a response is being collected
+        self.pump = 0
+        self.drips = 0
+        self.start_ph = 0.0
+        self.dosed_at = None
+        self.t63 = None # (ms) baseline
+        self.gain = [None, None] # (pH/drip) baseline for each pump
+        self.learned = 0 # responses in the t63 baseline
+        self.last = None # (t63 ms or None, change per drip) of the last judged response
+        self.strikes = 0
+        self.problem = None # 'SLOW PROBE' or 'WEAK RESPONSE'
+
+    def dosed(self, pump, drips, pH, now):
+        '''A dose of drips was given from pump at ticks_ms now, worked out
+        from the reading pH'''
+        if self.active:
+            self._finish()
+        # Only follow doses into a bath that has had time to settle
+        self.active = (self.dosed_at is None or
+                       time.ticks_diff(now, self.dosed_at) >= self.ISOLATION)
+        self.pump = pump
+        self.drips = drips
+        self.start_ph = pH
+        self.dosed_at = now
+        self.count = 0
+
+    def reading(self, pH, now):
+        '''A pH reading at ticks_ms now. Returns True if it finished off a
+        response.'''
+        if not self.active:
+            return False
+        after = time.ticks_diff(now, self.dosed_at)
+        if after > self.WINDOW:
+            return self._finish()
+        if self.count < self.MAX_READINGS:
+            self.values[self.count] = pH
+            self.times[self.count] = after
+            self.count += 1
+        return False
+
+    def time_jump(self, ms):
+        '''ticks_ms stood still for ms (the board was stopped)'''
+        if self.dosed_at is not None:
+            self.dosed_at = time.ticks_add(self.dosed_at, -ms)
+
+    def reset(self):
+        '''Forget any strikes, e.g. once the probe has been seen to'''
+        self.strikes = 0
+        self.problem = None
+        self.active = False
+
+    def degraded(self):
+        return self.strikes > 0
+
+    def failed(self):
+        return self.strikes >= self.STRIKES
+
+    def _t63(self, change):
+        '''ms after the dose the readings got 63% of the way to change'''
+        last_time, last_fraction = 0, 0.0
+        for i in range(self.count):
+            fraction = (self.values[i] - self.start_ph) / change
+            if fraction >= 0.63:
+                return last_time + ((0.63 - last_fraction) * (self.times[i] - last_time)
+                                    / (fraction - last_fraction))
+            last_time, last_fraction = self.times[i], fraction
+        return None
+
+    def _finish(self):
+        '''Judge the response collected so far. Returns True if it was.'''
+        self.active = False
+        n = self.count
+        if n < self.MIN_READINGS or not self.drips:
+            return False
+        settled = 0.0
+        for i in range(n - self.SETTLED, n):
+            settled += self.values[i]
+        change = settled / self.SETTLED - self.start_ph
+        per_drip = change / self.drips
+        pump = self.pump
+        expected = self.gain[pump]
+        if expected is None:
+            if change * DIRECTION[pump] < self.MIN_CHANGE:
+                return False # too small, or the wrong way, to start a baseline on
+        elif abs(expected * self.drips) < self.MIN_CHANGE:
+            return False # the dose was too small to tell anything from
+        t63 = self._t63(change) if abs(change) >= self.MIN_CHANGE else None
+        self.last = (t63, per_drip)
+
+        judged = self.learned >= self.LEARN
+        weak = judged and expected is not None and per_drip / expected < self.WEAK
+        slow = (judged and not weak and
+                (t63 is None or t63 > max(self.t63 * self.SLOW, self.t63 + self.MIN_SLOWER)))
+        if weak or slow:
+            self.strikes += 1
+            self.problem = 'WEAK RESPONSE' if weak else 'SLOW PROBE'
+            return True
+        self.strikes = 0
+        self.problem = None
+        if t63 is None:
+            return True
+        # A plain mean while learning, weighted after that
+        alpha = max(self.ALPHA, 1 / (self.learned + 1))
+        self.t63 = t63 if self.t63 is None else self.t63 + alpha * (t63 - self.t63)
+        self.gain[pump] = per_drip if expected is None else expected + alpha * (per_drip - expected)
+        self.learned += 1
+        return True
@@ -0,0 +1,94 @@
+'''Peristaltic pump driven from a timer PWM channel.
+
+With a plain output pin the smallest dose is one DRIP_TIME pulse at full speed.
+Running the pump off PWM lets it be slowed down, so a dose can be a fraction
+of a drip, and the duty is ramped up and down so the pump doesn't take its
+full current in one go.
+
+PwmPump has high() and low() like a Pin, so it can be used anywhere a pump
+pin is, plus dose() which gives a volume in ml. The flow at each duty is
+calibrated in ml per ms of pulse, measured by running the pump into a
+measuring cylinder.
+'''
+
+import time
+from pyb import Timer
+
+
+class PwmPump:
+    RAMP = 10 # (ms) time to ramp between 0 and the running duty
+    RAMP_STEPS = 5
+    # (duty %, ml per ms), sorted by duty. 100% is one 0.05 ml drip per 20 ms.
+    CALIBRATION = ((40, 0.0008), (70, 0.0017), (100, 0.0025))
+    MIN_PULSE = 5 # (ms) shorter pulses don't turn the rotor reliably
+
+    def __init__(self, timer, channel, pin, calibration=CALIBRATION):
+        '''timer is a pyb.Timer already set to the PWM frequency, channel the
+        timer channel number for pin. On the pyboard Y9 is timer 2 channel 3
+        and Y10 timer 2 channel 4.'''
+        self.channel = timer.channel(channel, Timer.PWM, pin=pin,
+                                     pulse_width_percent=0)
+        self.calibration = calibration
+        self.duty = calibration[-1][0] # duty used by high()
+        self.running_duty = 0
+        self.total_ml = 0.0
+
+    def _ramp(self, end, ramp=True):
+        start = self.running_duty
+        if ramp and self.RAMP:
+            step_time = self.RAMP // self.RAMP_STEPS
+            for i in range(1, self.RAMP_STEPS):
+                self.channel.pulse_width_percent(start + (end - start) * i // self.RAMP_STEPS)
+                time.sleep_ms(step_time)
+        self.channel.pulse_width_percent(end)
+        self.running_duty = end
+
+    def high(self, duty=None, ramp=True):
+        '''Run the pump at duty, self.duty if not given'''
+        self._ramp(self.duty if duty is None else duty, ramp)
+
+    def low(self, ramp=True):
+        '''Stop the pump'''
+        self._ramp(0, ramp)
+
+    def value(self, value=None):
+        if value is None:
+            return int(self.running_duty > 0)
+        if value:
+            self.high()
+        else:
+            self.low()
+
+    def flow(self, duty):
+        '''ml per ms at a duty, interpolated from the calibration'''
+        cal = self.calibration
+        if duty <= cal[0][0]:
+            return cal[0][1] * duty / cal[0][0]
+        for (d0, f0), (d1, f1) in zip(cal, cal[1:]):
+            if duty <= d1:
+                return f0 + (f1 - f0) * (duty - d0) / (d1 - d0)
+        return cal[-1][1]
+
+    def plan(self, ml):
+        '''Return (duty, ms) for a dose. Uses the highest calibrated duty
+        which still gives a pulse of at least MIN_PULSE ms, so small doses
+        run slowly and big ones quickly.'''
+        for duty, flow in reversed(self.calibration):
+            ms = ml / flow
+            if ms >= self.MIN_PULSE:
+                return duty, int(ms + 0.5)
+        return self.calibration[0][0], self.MIN_PULSE # as small as it goes
+
+    def dose(self, ml):
+        '''Pump a volume in ml. Returns the volume given according to the
+        calibration.'''
+        duty, ms = self.plan(ml)
+        # A linear ramp up and down together deliver about one ramp time at
+        # full flow. Pulses too short to fit the ramps in aren't ramped.
+        ramp = ms > 2 * self.RAMP
+        self.high(duty, ramp)
+        time.sleep_ms(ms - self.RAMP if ramp else ms)
+        self.low(ramp)
+        given = self.flow(duty) * ms
+        self.total_ml += given
+        return given
@@ -1,7 +1,7 @@
 """Implements a HD44780 character LCD connected via PCF8574 on I2C."""
 
 from lcd_api import LcdApi
-from pyb import I2C, delay
+from pyb import I2C, delay, millis, elapsed_millis
 
 # The PCF8574 has a jumper selectable address: 0x20 - 0x27
 DEFAULT_I2C_ADDR = 0x3F
@@ -16,12 +16,65 @@ SHIFT_DATA = 4
 
 
 class I2cLcd(LcdApi):
-    """Implements a HD44780 character LCD connected via PCF8574 on I2C."""
+    """Implements a HD44780 character LCD connected via PCF8574 on I2C.
+
+    A failing LCD mustn't take anything else down with it. Each send has a
+    short timeout and is retried, the bus and LCD are re-initialised after
+    repeated failures, and if that doesn't work the LCD goes into degraded
+    mode where writes are dropped until it is time to try again. Writes made
+    between begin_frame() and end_frame() are also dropped once the frame has
+    used up its time budget.
+
+    If it is given an i2c_bus.I2cBus rather than an I2C the writes are queued
+    on the bus at low priority and go out when the loop calls
+    bus.service(), a frame's worth in as few transactions as possible. A
+    queued write that fails isn't known about until the next end_frame().
+    """
+
+    SEND_TIMEOUT = 10       # ms allowed for one i2c.send
+    RETRIES = 2             # extra attempts at a failed send
+    RECOVER_AFTER = 3       # sends failing in a row before re-initialising
+    RECOVER_INTERVAL = 30000  # ms between attempts to leave degraded mode
+    FRAME_BUDGET = 50       # ms default time budget for a frame
 
     def __init__(self, i2c, i2c_addr, num_lines, num_columns):
         self.i2c = i2c
         self.i2c_addr = i2c_addr
-        self.i2c.send(0, self.i2c_addr)
+        self.bus = i2c if hasattr(i2c, 'submit') else None
+        if self.bus is not None:
+            self.bus.device(i2c_addr, 'lcd')
+        self._batch = bytearray(self.bus.MAX_BATCH if self.bus else 0)
+        self._batch_len = 0
+        self._queued_ok = True # every queued write since end_frame() made it
+        self.num_lines = num_lines
+        self.num_columns = num_columns
+        # Counters, for anyone who wants to know how the LCD is doing
+        self.send_failures = 0      # failed attempts at a send
+        self.dropped = 0            # sends given up on or skipped
+        self.overruns = 0           # frames that ran out of time
+        self.recoveries = 0
+        self.recovery_failures = 0
+        # Goes up whenever the screen may no longer show what was written,
+        # a failed queued write or a re-initialise, for callers that cache it
+        self.screen_lost = 0
+        self.degraded = False
+        self.backlight = True
+        self._failed_in_row = 0
+        self._degraded_at = 0
+        self._frame_start = 0
+        self._frame_budget = 0      # 0 means not in a frame
+        self._frame_ok = True
+        self._recovering = True # let the first failure go straight to degraded
+        try:
+            self.init_lcd()
+        except OSError:
+            self._enter_degraded()
+        finally:
+            self._recovering = False
+
+    def init_lcd(self):
+        """Runs the power up sequence for the LCD."""
+        self._send(0)
         delay(20)   # Allow LCD time to powerup
         # Send reset 3 times
         self.hal_write_init_nibble(self.LCD_FUNCTION_RESET)
@@ -33,27 +86,137 @@ class I2cLcd(LcdApi):
         # Put LCD into 4 bit mode
         self.hal_write_init_nibble(self.LCD_FUNCTION)
         delay(1)
-        LcdApi.__init__(self, num_lines, num_columns)
+        LcdApi.__init__(self, self.num_lines, self.num_columns)
         cmd = self.LCD_FUNCTION
-        if num_lines > 1:
+        if self.num_lines > 1:
             cmd |= self.LCD_FUNCTION_2LINES
         self.hal_write_command(cmd)
 
+    def _send(self, byte):
+        """Sends one byte to the PCF8574, dealing with any failures."""
+        if self._recovering:
+            # No retries or budget, recover() catches the failure
+            if self.bus is not None:
+                self.bus.write(self.i2c_addr, byte, retries=0)
+            else:
+                self.i2c.send(byte, self.i2c_addr, timeout=self.SEND_TIMEOUT)
+            return
+        if self.degraded or (self._frame_budget and not self._frame_ok):
+            self.dropped += 1
+            return
+        if self._frame_budget and elapsed_millis(self._frame_start) > self._frame_budget:
+            self.overruns += 1
+            self.dropped += 1
+            self._frame_ok = False
+            return
+        if self.bus is not None:
+            self._batch[self._batch_len] = byte
+            self._batch_len += 1
+            if self._batch_len == len(self._batch) or not self._frame_budget:
+                self._submit()
+            return
+        for _ in range(self.RETRIES + 1):
+            try:
+                self.i2c.send(byte, self.i2c_addr, timeout=self.SEND_TIMEOUT)
+                self._failed_in_row = 0
+                return
+            except OSError:
+                self.send_failures += 1
+        self.dropped += 1
+        self._frame_ok = False
+        self._failed_in_row += 1
+        if self._failed_in_row >= self.RECOVER_AFTER:
+            self.recover()
+
+    def _submit(self):
+        """Queue the batched bytes on the bus."""
+        if self._batch_len:
+            self.bus.submit(self.i2c_addr, bytes(self._batch[:self._batch_len]),
+                            done=self._sent)
+            self._batch_len = 0
+
+    def _sent(self, ok):
+        """Called back by the bus once a queued write has been tried."""
+        if ok:
+            self._failed_in_row = 0
+            return
+        self.send_failures += 1
+        self.dropped += 1
+        self._queued_ok = False
+        self.screen_lost += 1
+        self._failed_in_row += 1
+        if self._failed_in_row >= self.RECOVER_AFTER and not self.degraded:
+            self.recover()
+
+    def recover(self):
+        """Re-initialise the bus and the LCD. Goes into degraded mode if
+        that fails. Returns True if the LCD is working again."""
+        self._recovering = True
+        self._frame_ok = False # whatever was on the screen is gone
+        self.screen_lost += 1
+        self.degraded = False
+        backlight = self.backlight
+        try:
+            if self.bus is not None:
+                self.bus.cancel(self.i2c_addr) # they'd only garble the screen now
+                self._batch_len = 0
+                self.bus.reset()
+            else:
+                self.i2c.deinit()
+                self.i2c.init(I2C.MASTER)
+            self.init_lcd()
+            if not backlight:
+                self.backlight_off()
+        except OSError:
+            self.recovery_failures += 1
+            self._enter_degraded()
+            return False
+        finally:
+            self._recovering = False
+        self.recoveries += 1
+        self._failed_in_row = 0
+        return True
+
+    def _enter_degraded(self):
+        self.degraded = True
+        self._degraded_at = millis()
+
+    def begin_frame(self, budget=FRAME_BUDGET):
+        """Start a group of writes which must finish within budget ms. In
+        degraded mode this is where another recovery is attempted."""
+        self._frame_ok = True
+        if self.degraded and elapsed_millis(self._degraded_at) > self.RECOVER_INTERVAL:
+            self.recover()
+        self._frame_start = millis()
+        self._frame_budget = budget
+
+    def end_frame(self):
+        """Returns True if everything written since begin_frame() made it to
+        the LCD. If not, the caller should assume the whole screen needs
+        redrawing."""
+        self._frame_budget = 0
+        if self.bus is not None:
+            self._submit()
+            ok = self._queued_ok
+            self._queued_ok = True
+            return ok and self._frame_ok and not self.degraded
+        return self._frame_ok and not self.degraded
+
     def hal_write_init_nibble(self, nibble):
         """Writes an initialization nibble to the LCD.
         This particular function is only used during intiialization.
         """
         byte = ((nibble >> 4) & 0x0f) << SHIFT_DATA
-        self.i2c.send(byte | MASK_E, self.i2c_addr)
-        self.i2c.send(byte, self.i2c_addr, )
+        self._send(byte | MASK_E)
+        self._send(byte)
 
     def hal_backlight_on(self):
         """Allows the hal layer to turn the backlight on."""
-        self.i2c.send(1 << SHIFT_BACKLIGHT, self.i2c_addr)
+        self._send(1 << SHIFT_BACKLIGHT)
 
     def hal_backlight_off(self):
         """Allows the hal layer to turn the backlight off."""
-        self.i2c.send(0, self.i2c_addr)
+        self._send(0)
 
     def hal_write_command(self, cmd):
         """Writes a command to the LCD.
@@ -61,15 +224,19 @@ class I2cLcd(LcdApi):
         """
         byte = ((self.backlight << SHIFT_BACKLIGHT) |
                 (((cmd >> 4) & 0x0f) << SHIFT_DATA))
-        self.i2c.send(byte | MASK_E, self.i2c_addr)
-        self.i2c.send(byte, self.i2c_addr)
+        self._send(byte | MASK_E)
+        self._send(byte)
         byte = ((self.backlight << SHIFT_BACKLIGHT) |
                 ((cmd & 0x0f) << SHIFT_DATA))
-        self.i2c.send(byte | MASK_E, self.i2c_addr, )
-        self.i2c.send(byte, self.i2c_addr)
-        if cmd <= 3:
+        self._send(byte | MASK_E)
+        self._send(byte)
+        if cmd <= 3 and not self.degraded:
             # The home and clear commands require a worst
             # case delay of 4.1 msec
+            if self.bus is not None and not self._recovering:
+                # Can't wait in the middle of a queued batch, send it now
+                self._submit()
+                self.bus.service()
             delay(5)
 
     def hal_write_data(self, data):
@@ -77,10 +244,10 @@ class I2cLcd(LcdApi):
         byte = (MASK_RS |
                 (self.backlight << SHIFT_BACKLIGHT) |
                 (((data >> 4) & 0x0f) << SHIFT_DATA))
-        self.i2c.send(byte | MASK_E, self.i2c_addr)
-        self.i2c.send(byte, self.i2c_addr)
+        self._send(byte | MASK_E)
+        self._send(byte)
         byte = (MASK_RS |
                 (self.backlight << SHIFT_BACKLIGHT) |
                 ((data & 0x0f) << SHIFT_DATA))
-        self.i2c.send(byte | MASK_E, self.i2c_addr)
-        self.i2c.send(byte, self.i2c_addr)
+        self._send(byte | MASK_E)
+        self._send(byte)
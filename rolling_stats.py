@@ -0,0 +1,188 @@
+'''Statistics over a sliding window of readings, updated in O(1) per reading.
+
+Gives the mean, standard deviation, min, max and least squares slope of the last
+N values without going back over them. Values are kept in a fixed size
+array('f') ring so there is no allocation after construction.
+
+The mean and variance use Welford's method, adding the new value and taking off
+the one falling out of the window. Min and max come from monotonic queues of
+sequence numbers. The slope is worked out from running sums against the sample
+number. Single precision floats drift, so everything is worked out again from
+the ring once per window, which keeps the cost O(1) on average.
+
+If a period is given, readings are averaged over each period and one value per
+period goes into the window, so a day can be covered with a few hundred values.
+'''
+
+import time
+from array import array
+
+
+class RollingStats:
+    def __init__(self, size, period=0):
+        '''size values in the window, each the mean of the readings in period
+        ms. With period 0 every reading goes straight into the window.'''
+        self.size = size
+        self.period = period
+        self.values = array('f', [0.0] * size)
+        self.count = 0
+        self.seq = 0 # number of values pushed so far
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._ref = 0.0 # values are centred on this for the slope sums
+        self._sy = 0.0 # sum of (value - ref)
+        self._sxy = 0.0 # sum of index in window * (value - ref)
+        # Monotonic queues of sequence numbers, as rings
+        self._maxq = array('l', [0] * size)
+        self._minq = array('l', [0] * size)
+        self._maxq_head = self._maxq_len = 0
+        self._minq_head = self._minq_len = 0
+        # Averaging over a period
+        self._acc = 0.0
+        self._acc_n = 0
+        self._due = None
+
+    def update(self, value, now=None):
+        '''Add a reading. Returns True if a value went into the window.'''
+        if not self.period:
+            self.push(value)
+            return True
+        if now is None:
+            now = time.ticks_ms()
+        if self._due is None:
+            self._due = time.ticks_add(now, self.period)
+        self._acc += value
+        self._acc_n += 1
+        if time.ticks_diff(now, self._due) < 0:
+            return False
+        self.push(self._acc / self._acc_n)
+        self._acc = 0.0
+        self._acc_n = 0
+        self._due = time.ticks_add(self._due, self.period)
+        if time.ticks_diff(now, self._due) >= 0:
+            self._due = time.ticks_add(now, self.period) # fell behind, don't try to catch up
+        return True
+
+    def time_jump(self, ms):
+        '''ticks_ms stood still for ms (the board was stopped)'''
+        if self._due is not None:
+            self._due = time.ticks_add(self._due, -ms)
+
+    def push(self, value):
+        '''Put a value straight into the window'''
+        size = self.size
+        seq = self.seq
+        slot = seq % size
+        n = self.count
+        if n == size:
+            old = self.values[slot]
+            # Slide the window, index i becomes i - 1
+            self._sxy += (n - 1) * (value - self._ref) - (self._sy - (old - self._ref))
+            self._sy += value - old
+            self._remove(old)
+        else:
+            self._sxy += n * (value - self._ref)
+            self._sy += value - self._ref
+        self.values[slot] = value
+        self._add(value)
+
+        # Expire from the front, pop dominated values from the back
+        oldest = seq - size
+        q, head, length = self._maxq, self._maxq_head, self._maxq_len
+        if length and q[head] <= oldest:
+            head = (head + 1) % size
+            length -= 1
+        while length and self.values[q[(head + length - 1) % size] % size] <= value:
+            length -= 1
+        q[(head + length) % size] = seq
+        self._maxq_head, self._maxq_len = head, length + 1
+
+        q, head, length = self._minq, self._minq_head, self._minq_len
+        if length and q[head] <= oldest:
+            head = (head + 1) % size
+            length -= 1
+        while length and self.values[q[(head + length - 1) % size] % size] >= value:
+            length -= 1
+        q[(head + length) % size] = seq
+        self._minq_head, self._minq_len = head, length + 1
+
+        self.seq = seq + 1
+        if not self.seq % size:
+            self.recompute()
+
+    def _add(self, value):
+        self.count += 1
+        delta = value - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (value - self._mean)
+
+    def _remove(self, value):
+        n = self.count - 1
+        self.count = n
+        if not n:
+            self._mean = 0.0
+            self._m2 = 0.0
+            return
+        mean = self._mean
+        self._mean = (mean * (n + 1) - value) / n
+        self._m2 -= (value - mean) * (value - self._mean)
+        if self._m2 < 0:
+            self._m2 = 0.0
+
+    def recompute(self):
+        '''Work the running sums out again from the ring'''
+        n = self.count
+        if not n:
+            return
+        start = self.seq - n
+        total = 0.0
+        for i in range(n):
+            total += self.values[(start + i) % self.size]
+        mean = total / n
+        m2 = 0.0
+        sxy = 0.0
+        for i in range(n):
+            d = self.values[(start + i) % self.size] - mean
+            m2 += d * d
+            sxy += i * d
+        self._mean = mean
+        self._m2 = m2
+        self._ref = mean
+        self._sy = 0.0
+        self._sxy = sxy
+
+    def mean(self):
+        return self._mean if self.count else None
+
+    def variance(self):
+        '''Sample variance, None with less than two values'''
+        if self.count < 2:
+            return None
+        return self._m2 / (self.count - 1)
+
+    def std(self):
+        var = self.variance()
+        return None if var is None else var ** 0.5
+
+    def max(self):
+        if not self.count:
+            return None
+        return self.values[self._maxq[self._maxq_head] % self.size]
+
+    def min(self):
+        if not self.count:
+            return None
+        return self.values[self._minq[self._minq_head] % self.size]
+
+    def slope(self, per=3600000):
+        '''Least squares slope of the window, per `per` ms (an hour by
+        default). Per value if there is no period.'''
+        n = self.count
+        if n < 2:
+            return None
+        sx = n * (n - 1) / 2
+        denom = n * n * (n * n - 1) / 12
+        slope = (n * self._sxy - sx * self._sy) / denom
+        if self.period:
+            slope *= per / self.period
+        return slope
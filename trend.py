@@ -0,0 +1,140 @@
+'''The pH over the last few hours, and a bar graph of it for the LCD.
+
+ReadingHistory keeps a fixed number of values in array rings, each the mean
+of the readings taken over one period. The value for the current period is
+in the ring too and is updated as readings come in, so the newest column of
+the graph moves with every reading. Periods with no readings at all, e.g.
+while the unit was stopped, are left empty.
+
+TrendGraph draws the values along one row of the LCD, one column each,
+using the 8 CGRAM characters as bars 1 to 8 pixels high. It remembers what
+each column is showing and only writes the columns that changed.
+'''
+
+import time
+from array import array
+
+EMPTY = 0 # level of a column with nothing in it
+UNKNOWN = 255 # column not drawn since the screen was last lost
+
+
+class ReadingHistory:
+    def __init__(self, size, period):
+        '''size values, each the mean of the readings in period ms'''
+        self.size = size
+        self.period = period
+        self.values = array('f', [0.0] * size)
+        self.counts = array('h', [0] * size) # readings in each value, 0 for an empty period
+        self.seq = 0 # number of values started so far
+        self._due = None # ticks_ms the current value ends at
+
+    def add(self, value, now=None):
+        '''Add a reading to the current value, starting a new one if the
+        period is up'''
+        if now is None:
+            now = time.ticks_ms()
+        if self._due is None or time.ticks_diff(now, self._due) >= 0:
+            self._advance(now)
+        slot = (self.seq - 1) % self.size
+        n = self.counts[slot]
+        self.values[slot] += (value - self.values[slot]) / (n + 1)
+        if n < 32767:
+            self.counts[slot] = n + 1
+
+    def _advance(self, now):
+        '''Start a new value, with empty ones for any periods missed'''
+        if self._due is None:
+            steps = 1
+            self._due = now
+        else:
+            steps = time.ticks_diff(now, self._due) // self.period + 1
+        for _ in range(min(steps, self.size)):
+            slot = self.seq % self.size
+            self.values[slot] = 0.0
+            self.counts[slot] = 0
+            self.seq += 1
+        self._due = time.ticks_add(self._due, steps * self.period)
+
+    def time_jump(self, ms):
+        '''ticks_ms stood still for ms (the board was stopped)'''
+        if self._due is not None:
+            self._due = time.ticks_add(self._due, -ms)
+
+    def get(self, age):
+        '''The value age periods ago (0 is the current one), None if there
+        were no readings then'''
+        if age >= self.size or age >= self.seq:
+            return None
+        slot = (self.seq - 1 - age) % self.size
+        if not self.counts[slot]:
+            return None
+        return self.values[slot]
+
+    def range(self, values=None):
+        '''(lowest, highest) of the newest values (all of them by default),
+        None if they are all empty'''
+        if values is None:
+            values = self.size
+        low = high = None
+        for age in range(values):
+            value = self.get(age)
+            if value is None:
+                continue
+            if low is None or value < low:
+                low = value
+            if high is None or value > high:
+                high = value
+        return None if low is None else (low, high)
+
+
+class TrendGraph:
+    # CGRAM character n is a bar n + 1 pixels high
+    BARS = [bytearray([0x1f if line >= 7 - n else 0 for line in range(8)]) for n in range(8)]
+
+    def __init__(self, lcd, row=1, columns=16):
+        self.lcd = lcd
+        self.row = row
+        self.columns = columns
+        self.shown = bytearray([UNKNOWN] * columns) # level on each column
+        self.loaded = False # the bars are in CGRAM
+
+    def invalidate(self):
+        '''Something else has been on the row, or the screen was lost.
+        Everything is written again next time.'''
+        self.loaded = False
+
+    def level(self, value, low, high):
+        '''Bar height 1-8 for a value, EMPTY for None'''
+        if value is None:
+            return EMPTY
+        if high <= low:
+            return 4
+        level = 1 + int((value - low) * 7 / (high - low) + 0.5)
+        return min(8, max(1, level))
+
+    def draw(self, history, low, high):
+        '''Draw the newest values of history scaled from low to high, oldest
+        on the left. Returns False if the LCD didn't get all of it.'''
+        lcd = self.lcd
+        shown = self.shown
+        lcd.begin_frame()
+        if not self.loaded:
+            for n, bar in enumerate(self.BARS):
+                lcd.custom_char(n, bar)
+            for column in range(self.columns):
+                shown[column] = UNKNOWN
+            self.loaded = True
+        cursor = -1
+        for column in range(self.columns):
+            level = self.level(history.get(self.columns - 1 - column), low, high)
+            if level == shown[column]:
+                continue
+            if column != cursor:
+                lcd.move_to(column, self.row)
+            lcd.putchar(chr(level - 1) if level else ' ')
+            shown[column] = level
+            cursor = column + 1
+        if not lcd.end_frame():
+            self.loaded = False
+            return False
+        return True
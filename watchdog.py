@@ -0,0 +1,183 @@
+'''Resets the board if the loop gets stuck, and leaves a note of where.
+
+The loop is split into phases. enter() is called at the start of each one
+and feed() once a pass. The hardware watchdog (machine.WDT) is only fed if
+every phase of the last pass finished within its deadline. A phase that
+hangs for good stops the feeding by never returning. One that comes back
+late is noted, and the watchdog is left to reset the board.
+
+Every enter() leaves a breadcrumb, the phase and ticks_ms, in a ring in the
+RTC backup registers, which keep their contents through a reset. After a
+watchdog reset the ring shows which phase the board was in when it stopped,
+and is copied to a log on the flash as the board starts up again. Late
+phases are logged straight away.
+
+The watchdog keeps counting in stop mode, so TIMEOUT has to be well over
+the longest the power manager idles for.
+'''
+
+import os
+import time
+from array import array
+
+import machine
+
+try:
+    import stm
+except ImportError: # not a pyboard, keep the breadcrumbs in RAM
+    stm = None
+
+STALL = 0x40 # breadcrumb code flag for a phase that missed its deadline
+BOOT = 0x7f # breadcrumb code for a start up
+
+
+class Breadcrumbs:
+    '''A ring of (code, ticks_ms) in RTC backup registers 0 to SIZE. Register 0
+    holds MAGIC and the index of the next entry. The RTC has to have been
+    set up, e.g. by pyb.RTC(), for the writes to stick.'''
+    MAGIC = 0x5048 # top half of register 0
+    SIZE = 15 # entries, the last 4 of the 20 registers are left alone
+
+    def __init__(self):
+        self.ram = array('L', [0] * (self.SIZE + 1)) if stm is None else None
+
+    def _get(self, i):
+        if stm is None:
+            return self.ram[i]
+        return stm.mem32[stm.RTC + stm.RTC_BKP0R + 4 * i] & 0xffffffff
+
+    def _set(self, i, value):
+        if stm is None:
+            self.ram[i] = value
+        else:
+            stm.mem32[stm.RTC + stm.RTC_BKP0R + 4 * i] = value
+
+    def _head(self):
+        '''Index of the next entry, None if the registers don't hold a ring'''
+        value = self._get(0)
+        if value >> 16 != self.MAGIC or value & 0xffff >= self.SIZE:
+            return None
+        return value & 0xffff
+
+    def add(self, code):
+        head = self._head()
+        if head is None:
+            self.clear()
+            head = 0
+        self._set(1 + head, code << 24 | time.ticks_ms() & 0xffffff)
+        self._set(0, self.MAGIC << 16 | (head + 1) % self.SIZE)
+
+    def read(self):
+        '''The (code, ticks_ms) entries, oldest first. The ticks only have
+        their bottom 24 bits.'''
+        head = self._head()
+        if head is None:
+            return []
+        entries = []
+        for i in range(self.SIZE):
+            value = self._get(1 + (head + i) % self.SIZE)
+            if value:
+                entries.append((value >> 24, value & 0xffffff))
+        return entries
+
+    def clear(self):
+        for i in range(1, self.SIZE + 1):
+            self._set(i, 0)
+        self._set(0, self.MAGIC << 16)
+
+
+class Watchdog:
+    TIMEOUT = 8000 # (ms) the board resets if it isn't fed for this long
+    LOG = '/flash/watchdog.log'
+    LOG_SIZE = 4096 # (bytes) the log is moved to .old past this
+
+    def __init__(self, names, deadlines, timeout=TIMEOUT, log=LOG):
+        '''names of the phases, and the longest each may take (ms). Nothing
+        is reset until start() is called.'''
+        if sum(deadlines) >= timeout:
+            raise ValueError('phase deadlines add up to more than the timeout')
+        self.names = names
+        self.deadlines = deadlines
+        self.timeout = timeout
+        self.log_path = log
+        self.wdt = None
+        self.phase = None # phase the loop is in
+        self.entered = time.ticks_ms()
+        self.stalled = None # first phase that missed its deadline, the board is going to reset
+        self.breadcrumbs = Breadcrumbs()
+        self.reset_phase = None # phase the last watchdog reset happened in
+        if machine.reset_cause() == machine.WDT_RESET:
+            self.reset_phase = self.report()
+        self.breadcrumbs.clear()
+        self.breadcrumbs.add(BOOT)
+
+    def name(self, code):
+        phase = code & ~STALL
+        if code == BOOT:
+            return 'boot'
+        name = self.names[phase] if phase < len(self.names) else str(phase)
+        return name + ' LATE' if code & STALL else name
+
+    def report(self):
+        '''Log the breadcrumbs left before a watchdog reset. Returns the name
+        of the phase it happened in.'''
+        entries = self.breadcrumbs.read()
+        if not entries:
+            self.log('watchdog reset, no breadcrumbs')
+            return '?'
+        last = entries[-1][1]
+        self.log('watchdog reset in {}, before that {}'.format(
+            self.name(entries[-1][0]),
+            ' '.join('{}@-{:d}'.format(self.name(code), (last - ticks) & 0xffffff)
+                     for code, ticks in entries[-2::-1])))
+        return self.name(entries[-1][0])
+
+    def log(self, line):
+        '''Add a line to the log on the flash, never raises'''
+        try:
+            try:
+                if os.stat(self.log_path)[6] > self.LOG_SIZE:
+                    os.rename(self.log_path, self.log_path + '.old')
+            except OSError:
+                pass # no log yet
+            with open(self.log_path, 'a') as f:
+                f.write('{:d} {}\n'.format(int(time.time()), line))
+        except OSError:
+            pass
+
+    def start(self):
+        '''Turn the hardware watchdog on, it can't be turned off again'''
+        if self.wdt is None:
+            self.wdt = machine.WDT(timeout=self.timeout)
+
+    def _leave(self, now):
+        phase = self.phase
+        if phase is None:
+            return
+        took = time.ticks_diff(now, self.entered)
+        if took > self.deadlines[phase] and self.stalled is None:
+            self.stalled = phase
+            self.breadcrumbs.add(STALL | phase)
+            self.log('{} took {:d}ms, over its {:d}ms deadline'.format(
+                self.names[phase], took, self.deadlines[phase]))
+
+    def enter(self, phase):
+        '''The loop is starting phase, and has finished the one before'''
+        now = time.ticks_ms()
+        self._leave(now)
+        self.phase = phase
+        self.entered = now
+        if self.stalled is None: # leave the stall as the last breadcrumb
+            self.breadcrumbs.add(phase)
+
+    def feed(self):
+        '''Once a pass. Feeds the watchdog if every phase since the last
+        feed was on time. Returns False once a phase has stalled, the board
+        will reset within TIMEOUT.'''
+        self._leave(time.ticks_ms())
+        self.phase = None
+        if self.stalled is not None:
+            return False
+        if self.wdt is not None:
+            self.wdt.feed()
+        return True
@@ -0,0 +1,84 @@
+'''Reads a DS18B20 water temperature probe without holding up the loop.
+
+A 12 bit conversion takes up to 750ms. Rather than wait for it, poll() starts
+a conversion and returns, and a later poll() once the time is up reads the
+result. Like the DHT, failures are retried with a growing back off and never
+raised, and the last good reading is kept.
+'''
+
+import time
+
+
+class WaterTemperature:
+    CONVERSION_TIME = 750 # (ms) for a 12 bit conversion
+    INTERVAL = 10000 # (ms) time between measurements when all is well
+    MAX_BACKOFF = 60000 # (ms) longest wait between retries after failures
+    POWER_ON = 85.0 # what the DS18B20 reads if it lost power mid conversion
+
+    def __init__(self, ds, interval=INTERVAL):
+        '''ds is a ds18x20.DS18X20, the first probe found on it is used'''
+        self.ds = ds
+        self.interval = max(interval, self.CONVERSION_TIME)
+        self.rom = None
+        self.temperature = None
+        self.measured_at = None # ticks_ms of the last good reading
+        self.converting = False
+        self.failures = 0 # in a row
+        self.total_failures = 0
+        self._next = time.ticks_ms() # start a conversion on the first poll
+
+    def poll(self):
+        '''Start a conversion or collect one if either is due. Returns True if
+        a new reading was taken.'''
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self._next) < 0:
+            return False
+        try:
+            if self.rom is None:
+                roms = self.ds.scan()
+                if not roms:
+                    raise OSError('no DS18B20')
+                self.rom = roms[0]
+            if not self.converting:
+                self.ds.convert_temp()
+                self.converting = True
+                self._next = time.ticks_add(now, self.CONVERSION_TIME)
+                return False
+            self.converting = False
+            temperature = self.ds.read_temp(self.rom)
+            if temperature == self.POWER_ON:
+                raise OSError('power on value')
+        except Exception: # onewire.OneWireError, and ds18x20 raises a plain Exception on a bad CRC
+            self.converting = False
+            self.rom = None # look for the probe again next time
+            self.failures += 1
+            self.total_failures += 1
+            backoff = min(self.CONVERSION_TIME << min(self.failures - 1, 8), self.MAX_BACKOFF)
+            self._next = time.ticks_add(now, backoff)
+            return False
+        self.temperature = temperature
+        self.measured_at = now
+        self.failures = 0
+        self._next = time.ticks_add(now, self.interval - self.CONVERSION_TIME)
+        return True
+
+    def due_in(self):
+        '''ms until the next conversion starts or finishes'''
+        return max(0, time.ticks_diff(self._next, time.ticks_ms()))
+
+    def time_jump(self, ms):
+        '''ticks_ms stood still for ms (the board was stopped), move the
+        schedule to match'''
+        self._next = time.ticks_add(self._next, -ms)
+        if self.measured_at is not None:
+            self.measured_at = time.ticks_add(self.measured_at, -ms)
+
+    def age(self):
+        '''ms since the last good reading, None if there hasn't been one'''
+        if self.measured_at is None:
+            return None
+        return time.ticks_diff(time.ticks_ms(), self.measured_at)
+
+    def read(self):
+        '''Return the last good temperature, None if nothing has been read'''
+        return self.temperature